@@ -22,7 +22,7 @@ def reset_context():
   msgq.context = Context()
 
 
-def log_from_bytes(dat: bytes, struct: capnp.lib.capnp._StructModule = log.Event) -> capnp.lib.capnp._DynamicStructReader:
+def log_from_bytes(dat: Union[bytes, memoryview], struct: capnp.lib.capnp._StructModule = log.Event) -> capnp.lib.capnp._DynamicStructReader:
   with struct.from_bytes(dat, traversal_limit_in_words=NO_TRAVERSAL_LIMIT) as msg:
     return msg
 
@@ -84,6 +84,15 @@ def recv_one_or_none(sock: SubSocket) -> Optional[capnp.lib.capnp._DynamicStruct
   return dat
 
 
+def recv_one_leased_or_none(sock: SubSocket) -> Optional[capnp.lib.capnp._DynamicStructReader]:
+  """Like recv_one_or_none, but the message is parsed in place in the queue instead of being copied.
+  It stays leased, and must no longer be used, once the next message is received from the socket."""
+  dat = sock.receive_lease(non_blocking=True)
+  if dat is not None:
+    dat = log_from_bytes(dat)
+  return dat
+
+
 def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
   """Keep receiving until we get a message"""
   while True:
@@ -138,7 +147,8 @@ class FrequencyTracker:
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
-               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None):
+               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None,
+               zero_copy: bool = False):
     self.frame = -1
     self.services = services
     self.seen = {s: False for s in services}
@@ -163,25 +173,69 @@ class SubMaster:
 
     self.simulation = bool(int(os.getenv("SIMULATION", "0")))
 
+    # parse messages directly from the queues instead of copying them. the message of a service stays leased
+    # until update() receives the next one, so it must not be used after that. the lease is checked whenever
+    # the message is accessed, one the publisher overwrote is replaced by a copy of its newest message
+    self.zero_copy = zero_copy
+    self.leased: set[str] = set()
+    self.non_polled_poller = Poller()
+    self.sock_services: dict[SubSocket, str] = {}
+
     # if freq and poll aren't specified, assume the max to be conservative
     assert frequency is None or poll is None, "Do not specify 'frequency' - frequency of the polled service will be used."
     self.update_freq = frequency or max([SERVICE_LIST[s].frequency for s in polled_services])
 
     for s in services:
       p = self.poller if s not in self.non_polled_services else None
+      if p is None and zero_copy:
+        # only receive from the non-polled services with a new message, so their leases are kept otherwise
+        p = self.non_polled_poller
       self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
+      self.sock_services[self.sock[s]] = s
 
-      try:
-        data = new_message(s)
-      except capnp.lib.capnp.KjException:
-        data = new_message(s, 0) # lists
-
-      self.data[s] = getattr(data.as_reader(), s)
-      self.logMonoTime[s] = 0
-      self.valid[s] = False
+      self._reset_data(s)
       self.freq_tracker[s] = FrequencyTracker(SERVICE_LIST[s].frequency, self.update_freq, s == poll)
 
+  def _reset_data(self, s: str) -> None:
+    try:
+      data = new_message(s)
+    except capnp.lib.capnp.KjException:
+      data = new_message(s, 0) # lists
+
+    self.data[s] = getattr(data.as_reader(), s)
+    self.logMonoTime[s] = 0
+    self.valid[s] = False
+
+  def _recv_leased(self, sock: SubSocket) -> Optional[capnp.lib.capnp._DynamicStructReader]:
+    s = self.sock_services[sock]
+    released = s in self.leased
+    if released:
+      # if the message was overwritten, the socket resumes at the newest one
+      self.leased.remove(s)
+      sock.release()
+
+    msg = recv_one_leased_or_none(sock)
+    if msg is not None:
+      if sock.lease_valid():
+        self.leased.add(s)
+        return msg
+      # overwritten while it was parsed, copy the newest message instead
+      sock.release()
+      msg = recv_one_or_none(sock)
+
+    if msg is None and released:
+      # the released message must no longer be used, and nothing replaces it
+      self._reset_data(s)
+    return msg
+
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
+    if s in self.leased and not self.sock[s].lease_valid():
+      # overwritten by the publisher since update(), fall back to a copy of the newest message
+      msg = self._recv_leased(self.sock[s])
+      if msg is not None:
+        self.data[s] = getattr(msg, s)
+        self.logMonoTime[s] = msg.logMonoTime
+        self.valid[s] = msg.valid
     return self.data[s]
 
   def _check_avg_freq(self, s: str) -> bool:
@@ -189,6 +243,12 @@ class SubMaster:
 
   def update(self, timeout: int = 100) -> None:
     msgs = []
+    if self.zero_copy:
+      for sock in self.poller.poll(timeout) + self.non_polled_poller.poll(0):
+        msgs.append(self._recv_leased(sock))
+      self.update_msgs(time.monotonic(), msgs)
+      return
+
     for sock in self.poller.poll(timeout):
       msgs.append(recv_one_or_none(sock))
 
@@ -0,0 +1,68 @@
+import time
+
+import cereal.messaging as messaging
+
+
+def can_message(dat: bytes):
+  msg = messaging.new_message('can', 1)
+  msg.can[0].dat = dat
+  return msg
+
+
+class TestSubMaster:
+
+  def test_zero_copy(self):
+    pm = messaging.PubMaster(['carState', 'modelV2'])
+    sm = messaging.SubMaster(['carState', 'modelV2'], poll='modelV2', zero_copy=True)
+    time.sleep(0.1)
+
+    for i in range(50):
+      msg = messaging.new_message('modelV2')
+      msg.modelV2.frameId = i
+      pm.send('modelV2', msg)
+      if i % 5 == 0:
+        msg = messaging.new_message('carState')
+        msg.carState.vEgo = float(i)
+        pm.send('carState', msg)
+
+      sm.update(1000)
+      assert sm.updated['modelV2'] and sm['modelV2'].frameId == i
+      assert sm.updated['carState'] == (i % 5 == 0)
+      # the carState of a previous update is still leased
+      assert sm['carState'].vEgo == i // 5 * 5
+
+  def test_zero_copy_overwritten(self):
+    pm = messaging.PubMaster(['can'])
+    sm = messaging.SubMaster(['can'], zero_copy=True)
+    time.sleep(0.1)
+
+    pm.send('can', can_message(b"\x01" * 8))
+    sm.update(1000)
+    assert sm.updated['can'] and sm.valid['can'] is False
+    assert sm['can'][0].dat == b"\x01" * 8
+
+    # not overwritten yet
+    for _ in range(3):
+      sm.update(0)
+      assert not sm.updated['can']
+      assert sm['can'][0].dat == b"\x01" * 8
+
+    # the publisher wraps around the queue while the message is leased, a copy of its newest message is
+    # exposed instead of the overwritten one
+    for i in range(12):
+      pm.send('can', can_message(bytes([i]) * 1024 * 1024))
+    assert sm['can'][0].dat == b"\x0b" * 1024 * 1024
+    sm.update(0)
+    assert not sm.updated['can']
+
+    # the same between updates, where update() receives the newest message
+    for i in range(12, 24):
+      pm.send('can', can_message(bytes([i]) * 1024 * 1024))
+    sm.update(0)
+    assert sm.updated['can'] and sm.logMonoTime['can'] > 0
+    assert sm['can'][0].dat == b"\x17" * 1024 * 1024
+
+    pm.send('can', can_message(b"\x02" * 8))
+    sm.update(1000)
+    assert sm.updated['can']
+    assert sm['can'][0].dat == b"\x02" * 8
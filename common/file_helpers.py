@@ -2,9 +2,11 @@ import io
 import os
 import tempfile
 import contextlib
+from collections.abc import Iterator
 import zstandard as zstd
 
 LOG_COMPRESSION_LEVEL = 10 # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 class CallbackReader:
@@ -26,6 +28,22 @@ class CallbackReader:
     return chunk
 
 
+class ThrottledReader:
+  """Wraps a file, but overrides the read method to call a
+  throttle function with the size of every chunk before returning it."""
+  def __init__(self, f, throttle):
+    self.f = f
+    self.throttle = throttle
+
+  def __getattr__(self, attr):
+    return getattr(self.f, attr)
+
+  def read(self, *args, **kwargs):
+    chunk = self.f.read(*args, **kwargs)
+    self.throttle(len(chunk))
+    return chunk
+
+
 @contextlib.contextmanager
 def atomic_write_in_dir(path: str, mode: str = 'w', buffering: int = -1, encoding: str = None, newline: str = None,
                         overwrite: bool = False):
@@ -52,7 +70,30 @@ def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.Buffered
   compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
 
   with open(filepath, "rb") as f:
-    compressor.copy_stream(f, compressed_stream)
+    compressor.copy_stream(f, compressed_stream, size=os.fstat(f.fileno()).st_size)
     compressed_size = compressed_stream.tell()
     compressed_stream.seek(0)
     return compressed_stream, compressed_size
+
+
+def iter_upload_chunks(filepath: str, should_compress: bool, start: int = 0,
+                       chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[tuple[int, bytes]]:
+  """Read the file in chunks of chunk_size bytes starting at chunk index start, and yield
+  (uncompressed size, data) per chunk. Compressed, the file is a single zstd frame like from
+  get_upload_stream, split into chunks as it is compressed. Compression is deterministic, so
+  to start at a later chunk the chunks before it are compressed again, but not yielded."""
+  with open(filepath, "rb") as f:
+    if not should_compress:
+      f.seek(start * chunk_size)
+      while chunk := f.read(chunk_size):
+        yield len(chunk), chunk
+      return
+
+    compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+    with compressor.stream_reader(f, size=os.fstat(f.fileno()).st_size, closefd=False) as reader:
+      idx, raw_pos = 0, 0
+      while chunk := reader.read(chunk_size):
+        raw_len, raw_pos = f.tell() - raw_pos, f.tell()
+        if idx >= start:
+          yield raw_len, chunk
+        idx += 1
@@ -0,0 +1,87 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+from typing import NamedTuple
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  name: str
+
+
+class Inotify:
+  """Minimal non-blocking inotify wrapper. Raises OSError where inotify isn't available (e.g. macOS)."""
+  def __init__(self):
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError(errno.ENOSYS, "inotify not supported")
+    self._libc = libc
+
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __del__(self):
+    self.close()
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def close(self) -> None:
+    if getattr(self, "fd", -1) >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    self._libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: float = 0) -> list[InotifyEvent]:
+    """Return the pending events, waiting up to timeout seconds for the first one."""
+    if timeout > 0 and not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, READ_SIZE)
+      except BlockingIOError:
+        return events
+
+      pos = 0
+      while pos < len(buf):
+        wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, pos)
+        pos += EVENT_HEADER.size
+        name = buf[pos:pos + name_len].rstrip(b"\0").decode(errors="replace")
+        pos += name_len
+        events.append(InotifyEvent(wd, mask, name))
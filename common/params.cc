@@ -2,10 +2,23 @@
 
 #include <dirent.h>
 #include <sys/file.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#ifdef __linux__
+#include <linux/futex.h>
+#include <sys/syscall.h>
+#endif
 
 #include <algorithm>
+#include <atomic>
 #include <cassert>
+#include <chrono>
+#include <climits>
 #include <csignal>
+#include <cstring>
+#include <mutex>
+#include <thread>
 #include <unordered_map>
 
 #include "common/params_keys.h"
@@ -88,12 +101,312 @@ private:
   int fd_ = -1;
 };
 
+uint64_t fnv1a(const std::string &str, uint64_t hash = 14695981039346656037ULL) {
+  for (unsigned char c : str) {
+    hash = (hash ^ c) * 1099511628211ULL;
+  }
+  return hash;
+}
+
+// snapshot slot of every key, in sorted order so all processes agree on the layout
+const std::unordered_map<std::string, int> &key_slots() {
+  static const std::unordered_map<std::string, int> slots = [] {
+    std::vector<std::string> names;
+    for (auto &[name, _] : keys) names.push_back(name);
+    std::sort(names.begin(), names.end());
+
+    std::unordered_map<std::string, int> ret;
+    for (size_t i = 0; i < names.size(); ++i) ret[names[i]] = i;
+    return ret;
+  }();
+  return slots;
+}
+
+// identifies the key table a snapshot was populated with, never 0
+uint64_t key_layout() {
+  static const uint64_t layout = [] {
+    std::vector<std::pair<int, std::string>> names;
+    for (auto &[name, slot] : key_slots()) names.push_back({slot, name});
+    std::sort(names.begin(), names.end());
+
+    uint64_t hash = fnv1a("params snapshot v2");
+    for (auto &[_, name] : names) hash = fnv1a(name + '\0', hash);
+    return hash | 1;
+  }();
+  return layout;
+}
+
+// identifies the contents of a param file. Params replaces the file on every write, while writing it in place,
+// e.g. from a shell script, changes its ctime. all 0 if the file doesn't exist
+struct FileStamp {
+  uint64_t ino = 0;
+  uint64_t ctime = 0;
+  uint64_t size = 0;
+
+  bool operator==(const FileStamp &other) const {
+    return ino == other.ino && ctime == other.ctime && size == other.size;
+  }
+};
+
+// never matches a file, for values that can't be trusted
+constexpr FileStamp UNKNOWN_FILE_STAMP = {UINT64_MAX, UINT64_MAX, UINT64_MAX};
+
+FileStamp file_stamp(const std::string &path) {
+  FileStamp stamp;
+  struct stat st;
+  if (stat(path.c_str(), &st) == 0) {
+#ifdef __APPLE__
+    const struct timespec &ctime = st.st_ctimespec;
+#else
+    const struct timespec &ctime = st.st_ctim;
+#endif
+    stamp = {(uint64_t)st.st_ino, (uint64_t)ctime.tv_sec * 1000000000ULL + ctime.tv_nsec, (uint64_t)st.st_size};
+  }
+  return stamp;
+}
+
 } // namespace
 
 
+// values up to SNAPSHOT_VALUE_SIZE are served from the snapshot, larger ones are read from disk
+constexpr uint32_t SNAPSHOT_VALUE_SIZE = 4096 - 16 - sizeof(FileStamp);
+constexpr uint32_t SNAPSHOT_OVERSIZED = UINT32_MAX;
+constexpr int SNAPSHOT_READ_RETRIES = 100;
+
+struct SnapshotSlot {
+  std::atomic<uint32_t> seq;  // odd while the value is being written
+  std::atomic<uint32_t> size;
+  std::atomic<uint64_t> version;
+  FileStamp file;  // the file the value belongs to
+  char value[SNAPSHOT_VALUE_SIZE];
+};
+
+struct alignas(64) SnapshotHeader {
+  std::atomic<uint64_t> layout;  // key_layout() once populated, 0 while (re)populating
+  std::atomic<uint64_t> dir_id;  // params directory the values were loaded from
+  std::atomic<uint32_t> changes;  // bumped on every write, futex word of waitForChange
+  std::atomic<uint32_t> waiters;
+};
+
+static_assert(std::atomic<uint32_t>::is_always_lock_free && std::atomic<uint64_t>::is_always_lock_free);
+static_assert(sizeof(SnapshotSlot) == 4096);
+
+/*
+  Read-mostly copy of all params in shared memory (/dev/shm), so reading a param is a memory copy instead of
+  stat and a memory copy instead of open/read/close. Every writer holds the params file lock and updates the
+  snapshot right after the file, readers don't lock and use a per-slot seqlock. A value is only used while its
+  file is unchanged, files written without Params are read from disk and put into the snapshot again.
+  The snapshot is populated from the files by the first Params that finds it missing or mirroring another
+  directory, e.g. after the params were cleaned up.
+*/
+class ParamsSnapshot {
+public:
+  enum class Read {
+    HIT,
+    DISK,  // not in the snapshot
+    STALE,  // the file changed since the value was stored
+  };
+
+  ParamsSnapshot(const std::string &path, ino_t ino, void *mem, size_t size) : path_(path), ino_(ino), mem_(mem), size_(size) {
+    header_ = (SnapshotHeader *)mem;
+    slots_ = (SnapshotSlot *)((char *)mem + sizeof(SnapshotHeader));
+  }
+  ~ParamsSnapshot() { munmap(mem_, size_); }
+
+  static std::shared_ptr<ParamsSnapshot> get(const std::string &params_dir) {
+    static std::mutex lock;
+    static std::unordered_map<std::string, std::weak_ptr<ParamsSnapshot>> snapshots;
+
+    std::lock_guard lk(lock);
+    auto snapshot = snapshots[params_dir].lock();
+    struct stat st;
+    if (snapshot && (stat(snapshot->path_.c_str(), &st) != 0 || st.st_ino != snapshot->ino_)) {
+      // removed with the prefix it belongs to
+      snapshot.reset();
+    }
+    if (!snapshot && (snapshot = open(params_dir))) {
+      snapshots[params_dir] = snapshot;
+    }
+    return snapshot;
+  }
+
+  inline bool valid() const {
+    return header_->layout.load(std::memory_order_acquire) == key_layout();
+  }
+
+  bool mirrors(const std::string &params_dir) const {
+    uint64_t id = dir_id(params_dir);
+    return valid() && id != 0 && header_->dir_id.load() == id;
+  }
+
+  // the params lock has to be held
+  void load(const std::string &params_dir) {
+    header_->layout.store(0);
+    for (auto &[key, slot] : key_slots()) {
+      update(slot, params_dir + "/" + key);
+    }
+    header_->dir_id.store(dir_id(params_dir));
+    header_->layout.store(key_layout(), std::memory_order_release);
+  }
+
+  // file is the current stamp of the key's file
+  Read read(const std::string &key, const FileStamp &file, std::string &value) const {
+    auto it = key_slots().find(key);
+    if (it == key_slots().end() || !valid()) return Read::DISK;
+
+    SnapshotSlot &slot = slots_[it->second];
+    for (int i = 0; i < SNAPSHOT_READ_RETRIES; ++i) {
+      uint32_t seq = slot.seq.load(std::memory_order_acquire);
+      if (seq & 1) {
+        std::this_thread::yield();
+        continue;
+      }
+      uint32_t value_size = slot.size.load(std::memory_order_relaxed);
+      bool unchanged = slot.file == file;
+      if (unchanged && value_size != SNAPSHOT_OVERSIZED) {
+        value.assign(slot.value, std::min(value_size, SNAPSHOT_VALUE_SIZE));
+      }
+      std::atomic_thread_fence(std::memory_order_acquire);
+      if (slot.seq.load(std::memory_order_relaxed) == seq) {
+        if (!unchanged) return Read::STALE;
+        return value_size == SNAPSHOT_OVERSIZED ? Read::DISK : Read::HIT;
+      }
+    }
+    // a writer died halfway, or is very slow
+    return Read::DISK;
+  }
+
+  // the params lock has to be held
+  void write(const std::string &key, const char *value, size_t value_size, const FileStamp &file) {
+    auto it = key_slots().find(key);
+    if (it != key_slots().end() && valid()) {
+      write(it->second, value, value_size, file);
+    }
+  }
+
+  // stores the value of a file that changed without Params and returns it. the params lock has to be held
+  std::string update(const std::string &key, const std::string &file_path) {
+    auto it = key_slots().find(key);
+    if (it != key_slots().end() && valid()) {
+      return update(it->second, file_path);
+    }
+    return util::read_file(file_path);
+  }
+
+  uint64_t version(const std::string &key) const {
+    if (!valid()) return 0;
+    if (key.empty()) return header_->changes.load(std::memory_order_acquire);
+    auto it = key_slots().find(key);
+    return it != key_slots().end() ? slots_[it->second].version.load(std::memory_order_acquire) : 0;
+  }
+
+  uint32_t changes() const {
+    return header_->changes.load();
+  }
+
+  // wait until changes differs from the given value, or timeout_ms passed
+  void wait(uint32_t changes, int timeout_ms) {
+#ifdef __linux__
+    struct timespec ts = {timeout_ms / 1000, (timeout_ms % 1000) * 1000000L};
+    header_->waiters.fetch_add(1);
+    syscall(SYS_futex, (uint32_t *)&header_->changes, FUTEX_WAIT, changes, &ts, nullptr, 0);
+    header_->waiters.fetch_sub(1);
+#else
+    util::sleep_for(std::min(timeout_ms, 10));
+#endif
+  }
+
+private:
+  // the params directory is recreated under a new name when it's cleaned up, and inodes get reused
+  static uint64_t dir_id(const std::string &params_dir) {
+    struct stat st;
+    char *real_path = realpath(params_dir.c_str(), nullptr);
+    if (real_path == nullptr) return 0;
+
+    uint64_t id = stat(real_path, &st) == 0 ? fnv1a(real_path, st.st_ino) : 0;
+    free(real_path);
+    return id;
+  }
+
+  static std::shared_ptr<ParamsSnapshot> open(const std::string &params_dir) {
+    std::string prefix = Path::openpilot_prefix();
+    std::string dir = Path::shm_path() + (prefix.empty() ? "" : "/" + prefix);
+    std::string path = util::string_format("%s/params_%016llx", dir.c_str(), (unsigned long long)fnv1a(params_dir));
+    if (!util::file_exists(dir) && !util::create_directories(dir, 0775)) return nullptr;
+
+    int fd = HANDLE_EINTR(::open(path.c_str(), O_RDWR | O_CREAT | O_CLOEXEC, 0664));
+    if (fd < 0) return nullptr;
+
+    // only ever grows, in case a build with more keys shares it
+    size_t size = sizeof(SnapshotHeader) + key_slots().size() * sizeof(SnapshotSlot);
+    struct stat st;
+    void *mem = MAP_FAILED;
+    if (fstat(fd, &st) == 0 && (st.st_size >= (off_t)size || ftruncate(fd, size) == 0)) {
+      mem = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if (mem == MAP_FAILED) {
+      LOGW("params snapshot unavailable at %s, errno=%d", path.c_str(), errno);
+      return nullptr;
+    }
+    return std::make_shared<ParamsSnapshot>(path, st.st_ino, mem, size);
+  }
+
+  std::string update(int idx, const std::string &file_path) {
+    FileStamp file = file_stamp(file_path);
+    std::string value = util::read_file(file_path);
+    if (!(file_stamp(file_path) == file)) {
+      // still being written
+      file = UNKNOWN_FILE_STAMP;
+    }
+    write(idx, value.data(), value.size(), file);
+    return value;
+  }
+
+  void write(int idx, const char *value, size_t value_size, const FileStamp &file) {
+    SnapshotSlot &slot = slots_[idx];
+    // stays odd if a previous writer died halfway
+    uint32_t seq = slot.seq.load(std::memory_order_relaxed) | 1;
+    slot.seq.store(seq, std::memory_order_relaxed);
+    std::atomic_thread_fence(std::memory_order_release);
+    if (value_size > SNAPSHOT_VALUE_SIZE) {
+      slot.size.store(SNAPSHOT_OVERSIZED, std::memory_order_relaxed);
+    } else {
+      memcpy(slot.value, value, value_size);
+      slot.size.store(value_size, std::memory_order_relaxed);
+    }
+    slot.file = file;
+    slot.seq.store(seq + 1, std::memory_order_release);
+    slot.version.fetch_add(1, std::memory_order_release);
+
+    header_->changes.fetch_add(1);
+#ifdef __linux__
+    if (header_->waiters.load() > 0) {
+      syscall(SYS_futex, (uint32_t *)&header_->changes, FUTEX_WAKE, INT_MAX, nullptr, nullptr, 0);
+    }
+#endif
+  }
+
+  std::string path_;
+  ino_t ino_;
+  void *mem_;
+  size_t size_;
+  SnapshotHeader *header_;
+  SnapshotSlot *slots_;
+};
+
+
 Params::Params(const std::string &path) {
   params_prefix = "/" + util::getenv("OPENPILOT_PREFIX", "d");
   params_path = ensure_params_path(params_prefix, path);
+
+  // only the default params are shared, copies (e.g. bootlog's) are read from disk
+  if (path.empty() && (snapshot = ParamsSnapshot::get(getParamPath())) && !snapshot->mirrors(getParamPath())) {
+    FileLock file_lock(params_path + "/.lock");
+    if (!snapshot->mirrors(getParamPath())) {
+      snapshot->load(getParamPath());
+    }
+  }
 }
 
 Params::~Params() {
@@ -146,6 +459,7 @@ int Params::put(const char* key, const char* value, size_t value_size) {
 
     // Move temp into place.
     if ((result = rename(tmp_path.c_str(), getParamPath(key).c_str())) < 0) break;
+    if (snapshot) snapshot->write(key, value, value_size, file_stamp(getParamPath(key)));
 
     // fsync parent directory
     result = fsync_dir(getParamPath());
@@ -164,12 +478,33 @@ int Params::remove(const std::string &key) {
   if (result != 0) {
     return result;
   }
+  if (snapshot) snapshot->write(key, nullptr, 0, {});
   return fsync_dir(getParamPath());
 }
 
+std::string Params::read(const std::string &key) {
+  std::string path = getParamPath(key);
+  if (!snapshot) {
+    return util::read_file(path);
+  }
+
+  std::string value;
+  switch (snapshot->read(key, file_stamp(path), value)) {
+    case ParamsSnapshot::Read::HIT:
+      return value;
+    case ParamsSnapshot::Read::STALE: {
+      // written without Params
+      FileLock file_lock(params_path + "/.lock");
+      return snapshot->update(key, path);
+    }
+    default:
+      return util::read_file(path);
+  }
+}
+
 std::string Params::get(const std::string &key, bool block) {
   if (!block) {
-    return util::read_file(getParamPath(key));
+    return read(key);
   } else {
     // blocking read until successful
     params_do_exit = 0;
@@ -177,11 +512,12 @@ std::string Params::get(const std::string &key, bool block) {
     void (*prev_handler_sigterm)(int) = std::signal(SIGTERM, params_sig_handler);
 
     std::string value;
+    uint64_t version = getVersion(key);
     while (!params_do_exit) {
-      if (value = util::read_file(getParamPath(key)); !value.empty()) {
+      if (value = read(key); !value.empty()) {
         break;
       }
-      util::sleep_for(100);  // 0.1 s
+      version = waitForChange(key, version, 100);  // 0.1 s
     }
 
     std::signal(SIGINT, prev_handler_sigint);
@@ -206,7 +542,9 @@ void Params::clearAll(ParamKeyType key_type) {
       if (de->d_type != DT_DIR) {
         auto it = keys.find(de->d_name);
         if (it == keys.end() || (it->second & key_type)) {
-          unlink(getParamPath(de->d_name).c_str());
+          if (unlink(getParamPath(de->d_name).c_str()) == 0 && snapshot) {
+            snapshot->write(de->d_name, nullptr, 0, {});
+          }
         }
       }
     }
@@ -216,6 +554,29 @@ void Params::clearAll(ParamKeyType key_type) {
   fsync_dir(getParamPath());
 }
 
+uint64_t Params::getVersion(const std::string &key) {
+  return snapshot ? snapshot->version(key) : 0;
+}
+
+uint64_t Params::waitForChange(const std::string &key, uint64_t version, int timeout_ms) {
+  auto deadline = std::chrono::steady_clock::now() + std::chrono::milliseconds(timeout_ms);
+  while (true) {
+    // read before the version, so a write in between wakes the wait
+    uint32_t changes = snapshot ? snapshot->changes() : 0;
+    uint64_t current = getVersion(key);
+    int remaining = std::chrono::duration_cast<std::chrono::milliseconds>(deadline - std::chrono::steady_clock::now()).count();
+    if (current != version || remaining <= 0) {
+      return current;
+    }
+
+    if (snapshot && snapshot->valid()) {
+      snapshot->wait(changes, remaining);
+    } else {
+      util::sleep_for(remaining);
+    }
+  }
+}
+
 void Params::putNonBlocking(const std::string &key, const std::string &val) {
    queue.push(std::make_pair(key, val));
   // start thread on demand
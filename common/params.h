@@ -1,7 +1,9 @@
 #pragma once
 
+#include <cstdint>
 #include <future>
 #include <map>
+#include <memory>
 #include <string>
 #include <tuple>
 #include <utility>
@@ -19,6 +21,8 @@ enum ParamKeyType {
   ALL = 0xFFFFFFFF
 };
 
+class ParamsSnapshot;
+
 class Params {
 public:
   explicit Params(const std::string &path = {});
@@ -45,6 +49,12 @@ public:
   }
   std::map<std::string, std::string> readAll();
 
+  // change notifications. the version of a key changes every time it's written or removed,
+  // an empty key is the version of all params. both are 0 if the shared snapshot isn't available
+  uint64_t getVersion(const std::string &key = {});
+  // blocks until the version differs from the given one or timeout_ms passed, returns the current version
+  uint64_t waitForChange(const std::string &key, uint64_t version, int timeout_ms);
+
   // helpers for writing values
   int put(const char *key, const char *val, size_t value_size);
   inline int put(const std::string &key, const std::string &val) {
@@ -60,10 +70,14 @@ public:
 
 private:
   void asyncWriteThread();
+  std::string read(const std::string &key);
 
   std::string params_path;
   std::string params_prefix;
 
+  // in-memory copy of all values shared between processes, the files stay the durable store
+  std::shared_ptr<ParamsSnapshot> snapshot;
+
   // for nonblocking write
   std::future<void> future;
   SafeQueue<std::pair<std::string, std::string>> queue;
@@ -1,5 +1,6 @@
 # distutils: language = c++
 # cython: language_level = 3
+from libc.stdint cimport uint64_t
 from libcpp cimport bool
 from libcpp.string cimport string
 from libcpp.vector cimport vector
@@ -26,6 +27,8 @@ cdef extern from "common/params.h":
     string getParamPath(string) nogil
     void clearAll(ParamKeyType)
     vector[string] allKeys()
+    uint64_t getVersion(string) nogil
+    uint64_t waitForChange(string, uint64_t, int) nogil
 
 
 def ensure_bytes(v):
@@ -121,3 +124,21 @@ cdef class Params:
 
   def all_keys(self):
     return self.p.allKeys()
+
+  def get_version(self, key=""):
+    """
+    Changes every time key is written or removed, or any param if no key is given.
+    This is a memory load, use it to cheaply check whether params have to be read again.
+    Always 0 if the shared snapshot isn't available.
+    """
+    cdef string k = self.check_key(key) if key else b""
+    return self.p.getVersion(k)
+
+  def wait_for_change(self, uint64_t version, key="", float timeout=1.):
+    """Block until get_version(key) differs from version, or timeout seconds passed. Returns the current version."""
+    cdef string k = self.check_key(key) if key else b""
+    cdef int timeout_ms = int(timeout * 1000)
+    cdef uint64_t r
+    with nogil:
+      r = self.p.waitForChange(k, version, timeout_ms)
+    return r
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+from openpilot.common.params import Params, ParamKeyType
+from openpilot.common.prefix import OpenpilotPrefix
+
+
+class TestParams:
+  def setup_method(self):
+    self.prefix = OpenpilotPrefix()
+    self.prefix.__enter__()
+    self.params = Params()
+
+  def teardown_method(self):
+    self.prefix.__exit__(None, None, None)
+
+  def test_params_put_and_get(self):
+    self.params.put("DongleId", "cb38263377b873ee")
+    assert self.params.get("DongleId") == b"cb38263377b873ee"
+    assert self.params.get("DongleId", encoding="utf8") == "cb38263377b873ee"
+    assert self.params.get("CarParams") is None
+
+  def test_coherent_across_instances(self):
+    other = Params()
+    self.params.put("DongleId", "abc")
+    assert other.get("DongleId") == b"abc"
+    other.put("DongleId", "def")
+    assert self.params.get("DongleId") == b"def"
+
+    other.remove("DongleId")
+    assert self.params.get("DongleId") is None
+
+    self.params.put("CurrentRoute", "route")
+    self.params.put("DongleId", "abc")
+    other.clear_all(ParamKeyType.CLEAR_ON_MANAGER_START)
+    assert self.params.get("CurrentRoute") is None
+    assert self.params.get("DongleId") == b"abc"
+
+  def test_oversized_value(self):
+    other = Params()
+    value = os.urandom(64 * 1024)
+    self.params.put("CarParamsCache", value)
+    assert other.get("CarParamsCache") == value
+
+    self.params.put("CarParamsCache", b"small")
+    assert other.get("CarParamsCache") == b"small"
+    self.params.put("CarParamsCache", value)
+    assert other.get("CarParamsCache") == value
+
+  def test_written_without_params(self):
+    self.params.put_bool("IsMetric", True)
+    assert self.params.get_bool("IsMetric")
+    version = self.params.get_version("IsMetric")
+
+    # in place, same size
+    path = self.params.get_param_path("IsMetric")
+    with open(path, "w") as f:
+      f.write("0")
+    assert not self.params.get_bool("IsMetric")
+    assert self.params.get_version("IsMetric") != version
+
+    os.unlink(path)
+    assert self.params.get("IsMetric") is None
+    with open(path, "w") as f:
+      f.write("1")
+    assert Params().get_bool("IsMetric")
+
+  def test_get_version(self):
+    version, key_version = self.params.get_version(), self.params.get_version("IsMetric")
+    self.params.put_bool("IsMetric", True)
+    assert self.params.get_version("IsMetric") == key_version + 1
+    assert self.params.get_version() > version
+
+    # other keys don't change
+    key_version = self.params.get_version("IsMetric")
+    Params().put("DongleId", "abc")
+    assert self.params.get_version("IsMetric") == key_version
+
+  def test_wait_for_change(self):
+    version = self.params.get_version("DongleId")
+    threading.Timer(0.2, lambda: Params().put("DongleId", "abc")).start()
+
+    start = time.monotonic()
+    new_version = self.params.wait_for_change(version, "DongleId", timeout=5)
+    assert 0.1 < time.monotonic() - start < 1
+    assert new_version != version
+    assert self.params.get("DongleId") == b"abc"
+
+  def test_wait_for_change_timeout(self):
+    version = self.params.get_version("DongleId")
+    threading.Timer(0.1, lambda: Params().put("CurrentRoute", "route")).start()
+
+    start = time.monotonic()
+    assert self.params.wait_for_change(version, "DongleId", timeout=0.5) == version
+    assert 0.4 < time.monotonic() - start < 1
+
+  def test_params_get_block(self):
+    threading.Timer(0.2, lambda: Params().put("CarParams", "test")).start()
+    assert self.params.get("CarParams") is None
+    assert self.params.get("CarParams", True) == b"test"
@@ -21,6 +21,14 @@ private:
   Event *recv_ready = nullptr;
   EventState *state = nullptr;
 
+  void waitForRecvReady() {
+    if (this->state->enabled) {
+      this->recv_called->set();
+      this->recv_ready->wait();
+      this->recv_ready->clear();
+    }
+  }
+
 public:
   FakeSubSocket(): TSubSocket() {}
   ~FakeSubSocket() {
@@ -46,14 +54,14 @@ public:
   }
 
   Message *receive(bool non_blocking=false) override {
-    if (this->state->enabled) {
-      this->recv_called->set();
-      this->recv_ready->wait();
-      this->recv_ready->clear();
-    }
-
+    waitForRecvReady();
     return TSubSocket::receive(non_blocking);
   }
+
+  Message *receiveLease(bool non_blocking=false) override {
+    waitForRecvReady();
+    return TSubSocket::receiveLease(non_blocking);
+  }
 };
 
 class FakePoller: public Poller {
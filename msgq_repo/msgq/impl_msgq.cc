@@ -28,8 +28,14 @@ void MSGQMessage::takeOwnership(char * d, size_t sz) {
   data = d;
 }
 
+void MSGQMessage::borrow(char * d, size_t sz) {
+  size = sz;
+  data = d;
+  owner = false;
+}
+
 void MSGQMessage::close() {
-  if (size > 0){
+  if (size > 0 && owner){
     delete[] data;
   }
   size = 0;
@@ -61,12 +67,10 @@ int MSGQSubSocket::connect(Context *context, std::string endpoint, std::string a
 }
 
 
-Message * MSGQSubSocket::receive(bool non_blocking){
-  msgq_msg_t msg;
-
-  MSGQMessage *r = NULL;
+int MSGQSubSocket::receiveRaw(msgq_msg_t *msg, bool non_blocking, bool lease){
+  auto recv = lease ? msgq_msg_lease : msgq_msg_recv;
 
-  int rc = msgq_msg_recv(&msg, q);
+  int rc = recv(msg, q);
 
   // Hack to implement blocking read with a poller. Don't use this
   while (!non_blocking && rc == 0){
@@ -76,7 +80,7 @@ Message * MSGQSubSocket::receive(bool non_blocking){
     int t = (timeout != -1) ? timeout : 100;
 
     int n = msgq_poll(items, 1, t);
-    rc = msgq_msg_recv(&msg, q);
+    rc = recv(msg, q);
 
     // The poll indicated a message was ready, but the receive failed. Try again
     if (n == 1 && rc == 0){
@@ -88,6 +92,15 @@ Message * MSGQSubSocket::receive(bool non_blocking){
     }
   }
 
+  return rc;
+}
+
+Message * MSGQSubSocket::receive(bool non_blocking){
+  msgq_msg_t msg;
+
+  MSGQMessage *r = NULL;
+
+  int rc = receiveRaw(&msg, non_blocking, false);
   if (rc > 0){
     r = new MSGQMessage;
     r->takeOwnership(msg.data, msg.size);
@@ -96,6 +109,28 @@ Message * MSGQSubSocket::receive(bool non_blocking){
   return (Message*)r;
 }
 
+Message * MSGQSubSocket::receiveLease(bool non_blocking){
+  msgq_msg_t msg;
+
+  MSGQMessage *r = NULL;
+
+  int rc = receiveRaw(&msg, non_blocking, true);
+  if (rc > 0){
+    r = new MSGQMessage;
+    r->borrow(msg.data, msg.size);
+  }
+
+  return (Message*)r;
+}
+
+bool MSGQSubSocket::release(){
+  return msgq_msg_release(q);
+}
+
+bool MSGQSubSocket::leaseValid(){
+  return msgq_msg_lease_valid(q);
+}
+
 void MSGQSubSocket::setTimeout(int t){
   timeout = t;
 }
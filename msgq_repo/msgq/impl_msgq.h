@@ -21,10 +21,12 @@ class MSGQMessage : public Message {
 private:
   char * data;
   size_t size;
+  bool owner = true;
 public:
   void init(size_t size);
   void init(char *data, size_t size);
   void takeOwnership(char *data, size_t size);
+  void borrow(char *data, size_t size);
   size_t getSize(){return size;}
   char * getData(){return data;}
   void close();
@@ -35,11 +37,15 @@ class MSGQSubSocket : public SubSocket {
 private:
   msgq_queue_t * q = NULL;
   int timeout;
+  int receiveRaw(msgq_msg_t *msg, bool non_blocking, bool lease);
 public:
   int connect(Context *context, std::string endpoint, std::string address, bool conflate=false, bool check_endpoint=true);
   void setTimeout(int timeout);
   void * getRawSocket() {return (void*)q;}
   Message *receive(bool non_blocking=false);
+  Message *receiveLease(bool non_blocking=false);
+  bool release();
+  bool leaseValid();
   ~MSGQSubSocket();
 };
 
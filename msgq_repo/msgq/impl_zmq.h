@@ -39,6 +39,8 @@ public:
   void setTimeout(int timeout);
   void * getRawSocket() {return sock;}
   Message *receive(bool non_blocking=false);
+  // messages are always copied out of zmq
+  Message *receiveLease(bool non_blocking=false) {return ZMQSubSocket::receive(non_blocking);}
   ~ZMQSubSocket();
 };
 
@@ -40,6 +40,13 @@ public:
   virtual int connect(Context *context, std::string endpoint, std::string address, bool conflate=false, bool check_endpoint=true) = 0;
   virtual void setTimeout(int timeout) = 0;
   virtual Message *receive(bool non_blocking=false) = 0;
+  // Receive without copying the message out of the queue where the implementation supports it. The message
+  // data stays in use until release() or the next receive. release() returns false if it was overwritten
+  // by the publisher in the meantime, anything read from it must then be discarded. leaseValid() checks
+  // that without ending the lease.
+  virtual Message *receiveLease(bool non_blocking=false) { return receive(non_blocking); }
+  virtual bool release() { return true; }
+  virtual bool leaseValid() { return true; }
   virtual void * getRawSocket() = 0;
   static SubSocket * create();
   static SubSocket * create(Context * context, std::string endpoint, std::string address="127.0.0.1", bool conflate=false, bool check_endpoint=true);
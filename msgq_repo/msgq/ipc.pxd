@@ -51,6 +51,9 @@ cdef extern from "msgq/ipc.h":
     SubSocket * create() nogil
     int connect(Context *, string, string, bool) nogil
     Message * receive(bool) nogil
+    Message * receiveLease(bool) nogil
+    bool release() nogil
+    bool leaseValid() nogil
     void setTimeout(int) nogil
 
   cdef cppclass PubSocket:
@@ -7,6 +7,7 @@ from libcpp.vector cimport vector
 from libcpp cimport bool
 from libc cimport errno
 from libc.string cimport strerror
+from cpython.buffer cimport PyBuffer_FillInfo
 from cython.operator import dereference
 
 
@@ -134,9 +135,11 @@ cdef class Context:
 cdef class Poller:
   cdef cppPoller * poller
   cdef list sub_sockets
+  cdef dict sockets_by_ptr
 
   def __cinit__(self):
     self.sub_sockets = []
+    self.sockets_by_ptr = {}
     self.poller = cppPoller.create()
 
   def __dealloc__(self):
@@ -144,23 +147,44 @@ cdef class Poller:
 
   def registerSocket(self, SubSocket socket):
     self.sub_sockets.append(socket)
+    self.sockets_by_ptr[<size_t>socket.socket] = socket
     self.poller.registerSocket(socket.socket)
 
   def poll(self, timeout):
     sockets = []
     cdef int t = timeout
+    cdef SubSocket socket
 
     with nogil:
       result = self.poller.poll(t)
 
     for s in result:
-      socket = SubSocket()
-      socket.setPtr(s)
+      # return the registered sockets, so their leases are kept track of
+      socket = self.sockets_by_ptr.get(<size_t>s)
+      if socket is None:
+        socket = SubSocket()
+        socket.setPtr(s)
       sockets.append(socket)
 
     return sockets
 
 
+cdef class LeasedMessage:
+  # Read-only buffer over a message received with SubSocket.receive_lease
+  cdef cppMessage *msg
+  cdef SubSocket socket  # keeps the queue mapped while the buffer is in use
+
+  def __dealloc__(self):
+    if self.msg != NULL:
+      del self.msg
+
+  def __getbuffer__(self, Py_buffer *buffer, int flags):
+    PyBuffer_FillInfo(buffer, self, self.msg.getData(), self.msg.getSize(), 1, flags)
+
+  def __releasebuffer__(self, Py_buffer *buffer):
+    pass
+
+
 cdef class SubSocket:
   cdef cppSubSocket * socket
   cdef bool is_owner
@@ -216,6 +240,43 @@ cdef class SubSocket:
 
       return m
 
+  def receive_lease(self, bool non_blocking=False):
+    """
+    Receive a message as a read-only memoryview over the queue, without copying it. The message stays leased
+    until release() or the next receive, after which the memoryview must no longer be used.
+    """
+    cdef cppMessage *msg
+    with nogil:
+      msg = self.socket.receiveLease(non_blocking)
+
+    if msg == NULL:
+      return None
+
+    lease = LeasedMessage()
+    lease.msg = msg
+    lease.socket = self
+    return memoryview(lease)
+
+  def release(self):
+    """
+    End the lease of the last message received with receive_lease. Returns False if the publisher overwrote
+    the message while it was leased, in which case anything read from it must be discarded.
+    """
+    cdef bool valid
+    with nogil:
+      valid = self.socket.release()
+    return valid
+
+  def lease_valid(self):
+    """
+    Check that the message received with receive_lease wasn't overwritten by the publisher so far, without
+    ending its lease. Everything read from the message before the check is intact if it returns True.
+    """
+    cdef bool valid
+    with nogil:
+      valid = self.socket.leaseValid()
+    return valid
+
 
 cdef class PubSocket:
   cdef cppPubSocket * socket
@@ -71,6 +71,8 @@ int msgq_msg_close(msgq_msg_t * msg){
 
 void msgq_reset_reader(msgq_queue_t * q){
   int id = q->reader_id;
+  // an outstanding lease is lost, its message may have been overwritten
+  q->leased = false;
   q->read_valids[id]->store(true);
   q->read_pointers[id]->store(*q->write_pointer);
 }
@@ -119,6 +121,7 @@ int msgq_new_queue(msgq_queue_t * q, const char * path, size_t size){
   q->num_readers = reinterpret_cast<std::atomic<uint64_t>*>(&header->num_readers);
   q->write_pointer = reinterpret_cast<std::atomic<uint64_t>*>(&header->write_pointer);
   q->write_uid = reinterpret_cast<std::atomic<uint64_t>*>(&header->write_uid);
+  q->last_write_pointer = reinterpret_cast<std::atomic<uint64_t>*>(&header->last_write_pointer);
 
   for (size_t i = 0; i < NUM_READERS; i++){
     q->read_pointers[i] = reinterpret_cast<std::atomic<uint64_t>*>(&header->read_pointers[i]);
@@ -132,6 +135,7 @@ int msgq_new_queue(msgq_queue_t * q, const char * path, size_t size){
 
   q->endpoint = path;
   q->read_conflate = false;
+  q->leased = false;
 
   return 0;
 }
@@ -288,8 +292,9 @@ int msgq_msg_send(msgq_msg_t * msg, msgq_queue_t *q){
   memcpy(p + sizeof(int64_t), msg->data, msg->size);
   __sync_synchronize();
 
-  // Update write pointer
+  // Update write pointer, and remember where the newest message starts
   uint32_t new_ptr = ALIGN(write_pointer + msg->size + sizeof(int64_t));
+  PACK64(*q->last_write_pointer, write_cycles, write_pointer);
   PACK64(*q->write_pointer, write_cycles, new_ptr);
 
   // Notify readers
@@ -307,6 +312,12 @@ int msgq_msg_ready(msgq_queue_t * q){
   int id = q->reader_id;
   assert(id >= 0); // Make sure subscriber is initialized
 
+  // a leased message that was overwritten is reported as ready, so that its owner
+  // finds out from release() instead of the lease being dropped silently
+  if (q->leased && (q->read_uid_local != *q->read_uids[id] || !*q->read_valids[id])){
+    return 1;
+  }
+
   if (q->read_uid_local != *q->read_uids[id]){
     //std::cout << q->endpoint << ": Reader was evicted, reconnecting" << std::endl;
     msgq_init_subscriber(q);
@@ -320,7 +331,8 @@ int msgq_msg_ready(msgq_queue_t * q){
   }
 
   uint32_t read_cycles, read_pointer;
-  UNPACK64(read_cycles, read_pointer, *q->read_pointers[id]);
+  // a leased message was already received
+  UNPACK64(read_cycles, read_pointer, q->leased ? q->lease_read_pointer : (uint64_t)*q->read_pointers[id]);
   UNUSED(read_cycles);
 
   uint32_t write_cycles, write_pointer;
@@ -331,7 +343,9 @@ int msgq_msg_ready(msgq_queue_t * q){
   return (read_pointer != write_pointer);
 }
 
-int msgq_msg_recv(msgq_msg_t * msg, msgq_queue_t * q){
+// Finds the next message without consuming it. Returns its size and sets data to point at it in the queue,
+// and next_read_pointer to the read pointer after it. Returns 0 if no new message is available.
+static int64_t msgq_msg_peek(msgq_queue_t * q, char ** data, uint64_t * next_read_pointer){
  start:
   int id = q->reader_id;
   assert(id >= 0); // Make sure subscriber is initialized
@@ -359,7 +373,6 @@ int msgq_msg_recv(msgq_msg_t * msg, msgq_queue_t * q){
 
   // Check if new message is available
   if (read_pointer == write_pointer) {
-    msg->size = 0;
     return 0;
   }
 
@@ -396,16 +409,36 @@ int msgq_msg_recv(msgq_msg_t * msg, msgq_queue_t * q){
     }
   }
 
+  *data = p + sizeof(int64_t);
+  PACK64(*next_read_pointer, read_cycles, new_read_pointer);
+  return size;
+}
+
+int msgq_msg_recv(msgq_msg_t * msg, msgq_queue_t * q){
+  if (q->leased){
+    msgq_msg_release(q);
+  }
+
+ start:
+  char * data;
+  uint64_t next_read_pointer;
+  int64_t size = msgq_msg_peek(q, &data, &next_read_pointer);
+  if (size == 0){
+    msg->size = 0;
+    return 0;
+  }
+
   // Copy message
   if (msgq_msg_init_size(msg, size) < 0)
     return -1;
 
   __sync_synchronize();
-  memcpy(msg->data, p + sizeof(int64_t), size);
+  memcpy(msg->data, data, size);
   __sync_synchronize();
 
   // Update read pointer
-  PACK64(*q->read_pointers[id], read_cycles, new_read_pointer);
+  int id = q->reader_id;
+  *q->read_pointers[id] = next_read_pointer;
 
   // Check if the actual data that was copied is valid
   if (!*q->read_valids[id]){
@@ -418,6 +451,50 @@ int msgq_msg_recv(msgq_msg_t * msg, msgq_queue_t * q){
   return msg->size;
 }
 
+int msgq_msg_lease(msgq_msg_t * msg, msgq_queue_t * q){
+  if (q->leased){
+    msgq_msg_release(q);
+  }
+
+  // The read pointer stays at the leased message until it is released, so the
+  // publisher invalidates this reader if it starts overwriting the message
+  int64_t size = msgq_msg_peek(q, &msg->data, &q->lease_read_pointer);
+  msg->size = size;
+  q->leased = size > 0;
+  __sync_synchronize();
+  return size;
+}
+
+bool msgq_msg_release(msgq_queue_t * q){
+  if (!q->leased){
+    return false;
+  }
+  q->leased = false;
+
+  __sync_synchronize();
+  int id = q->reader_id;
+  if (q->read_uid_local != *q->read_uids[id]){
+    return false;
+  }
+
+  if (!*q->read_valids[id]){
+    // resume at the newest message, instead of skipping past it like msgq_reset_reader
+    q->read_pointers[id]->store(*q->last_write_pointer);
+    q->read_valids[id]->store(true);
+    return false;
+  }
+
+  *q->read_pointers[id] = q->lease_read_pointer;
+  return true;
+}
+
+bool msgq_msg_lease_valid(msgq_queue_t * q){
+  // everything read from the leased message before this is intact if it returns true
+  __sync_synchronize();
+  int id = q->reader_id;
+  return q->leased && q->read_uid_local == *q->read_uids[id] && *q->read_valids[id];
+}
+
 
 
 int msgq_poll(msgq_pollitem_t * items, size_t nitems, int timeout){
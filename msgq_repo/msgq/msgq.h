@@ -17,6 +17,7 @@ struct  msgq_header_t {
   uint64_t num_readers;
   uint64_t write_pointer;
   uint64_t write_uid;
+  uint64_t last_write_pointer;
   uint64_t read_pointers[NUM_READERS];
   uint64_t read_valids[NUM_READERS];
   uint64_t read_uids[NUM_READERS];
@@ -26,6 +27,7 @@ struct msgq_queue_t {
   std::atomic<uint64_t> *num_readers;
   std::atomic<uint64_t> *write_pointer;
   std::atomic<uint64_t> *write_uid;
+  std::atomic<uint64_t> *last_write_pointer;
   std::atomic<uint64_t> *read_pointers[NUM_READERS];
   std::atomic<uint64_t> *read_valids[NUM_READERS];
   std::atomic<uint64_t> *read_uids[NUM_READERS];
@@ -38,6 +40,10 @@ struct msgq_queue_t {
 
   bool read_conflate;
   std::string endpoint;
+
+  // a message received with msgq_msg_lease is still in use
+  bool leased;
+  uint64_t lease_read_pointer;
 };
 
 struct msgq_msg_t {
@@ -64,6 +70,9 @@ void msgq_init_subscriber(msgq_queue_t * q);
 
 int msgq_msg_send(msgq_msg_t *msg, msgq_queue_t *q);
 int msgq_msg_recv(msgq_msg_t *msg, msgq_queue_t *q);
+int msgq_msg_lease(msgq_msg_t *msg, msgq_queue_t *q);
+bool msgq_msg_release(msgq_queue_t *q);
+bool msgq_msg_lease_valid(msgq_queue_t *q);
 int msgq_msg_ready(msgq_queue_t * q);
 int msgq_poll(msgq_pollitem_t * items, size_t nitems, int timeout);
 
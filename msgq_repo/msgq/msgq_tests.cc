@@ -422,3 +422,56 @@ TEST_CASE("1 publisher, 2 subscribers", "[integration]")
     msgq_msg_close(&msg2);
   }
 }
+
+TEST_CASE("Lease msg, release", "[integration]")
+{
+  remove("/dev/shm/test_queue");
+  msgq_queue_t writer, reader;
+
+  msgq_new_queue(&writer, "test_queue", 1024);
+  msgq_new_queue(&reader, "test_queue", 1024);
+
+  msgq_init_publisher(&writer);
+  msgq_init_subscriber(&reader);
+
+  uint64_t i = 42;
+  msgq_msg_t outgoing_msg;
+  msgq_msg_init_data(&outgoing_msg, (char *)&i, sizeof(uint64_t));
+  msgq_msg_send(&outgoing_msg, &writer);
+
+  msgq_msg_t msg;
+  REQUIRE(msgq_msg_lease(&msg, &reader) == sizeof(uint64_t));
+  REQUIRE(*(uint64_t *)msg.data == i);
+  REQUIRE(msgq_msg_ready(&reader) == 0);
+
+  REQUIRE(msgq_msg_lease_valid(&reader));
+
+  SECTION("Not overwritten")
+  {
+    REQUIRE(msgq_msg_release(&reader));
+    REQUIRE(!msgq_msg_lease_valid(&reader));
+    REQUIRE(msgq_msg_lease(&msg, &reader) == 0);
+  }
+  SECTION("Overwritten while leased")
+  {
+    for (uint64_t j = 0; j < 100; j++)
+    {
+      msgq_msg_t overwriting_msg;
+      msgq_msg_init_data(&overwriting_msg, (char *)&j, sizeof(uint64_t));
+      msgq_msg_send(&overwriting_msg, &writer);
+      msgq_msg_close(&overwriting_msg);
+    }
+    // reported as ready, so the owner of the lease notices
+    REQUIRE(!msgq_msg_lease_valid(&reader));
+    REQUIRE(msgq_msg_ready(&reader) == 1);
+    REQUIRE(!msgq_msg_release(&reader));
+
+    // the reader resumes at the newest message
+    REQUIRE(msgq_msg_lease(&msg, &reader) == sizeof(uint64_t));
+    REQUIRE(*(uint64_t *)msg.data == 99);
+    REQUIRE(msgq_msg_release(&reader));
+    REQUIRE(msgq_msg_lease(&msg, &reader) == 0);
+  }
+
+  msgq_msg_close(&outgoing_msg);
+}
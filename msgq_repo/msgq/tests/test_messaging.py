@@ -1,4 +1,5 @@
 import os
+import pytest
 import random
 import time
 import string
@@ -69,3 +70,54 @@ class TestPubSubSockets:
       recvd = sub_sock.receive()
       assert (time.monotonic() - start_time) < 0.2
       assert recvd is None
+
+  def test_receive_lease(self):
+    sock = random_sock()
+    pub_sock = msgq.pub_sock(sock)
+    sub_sock = msgq.sub_sock(sock, conflate=False, timeout=None)
+    zmq_sleep(3)
+
+    for _ in range(100):
+      msg = random_bytes()
+      pub_sock.send(msg)
+      recvd = sub_sock.receive_lease()
+      assert recvd.readonly
+      assert recvd == msg
+      assert sub_sock.lease_valid()
+      assert sub_sock.release()
+
+    # the next receive ends the previous lease
+    msgs = [random_bytes() for _ in range(3)]
+    for msg in msgs:
+      pub_sock.send(msg)
+    assert [bytes(sub_sock.receive_lease(non_blocking=True)) for _ in msgs] == msgs
+    assert sub_sock.release()
+    assert sub_sock.receive_lease(non_blocking=True) is None
+
+    # a leased message is no longer pending
+    poller = msgq.Poller()
+    poller.registerSocket(sub_sock)
+    pub_sock.send(msgs[0])
+    assert poller.poll(1000) == [sub_sock]
+    assert sub_sock.receive_lease() == msgs[0]
+    assert poller.poll(0) == []
+
+  @pytest.mark.skipif("ZMQ" in os.environ, reason="zmq messages are always copied")
+  def test_receive_lease_overwritten(self):
+    sock = random_sock()
+    pub_sock = msgq.pub_sock(sock)
+    sub_sock = msgq.sub_sock(sock, conflate=False, timeout=None)
+
+    pub_sock.send(b"a")
+    recvd = sub_sock.receive_lease()
+    assert recvd == b"a"
+
+    # wrap around the queue while the message is leased
+    for i in range(20):
+      pub_sock.send(bytes([i]) * 1024 * 1024)
+    assert not sub_sock.lease_valid()
+    assert not sub_sock.release()
+
+    # the reader resumes at the newest message
+    assert sub_sock.receive(non_blocking=True) == b"\x13" * 1024 * 1024
+    assert sub_sock.receive(non_blocking=True) is None
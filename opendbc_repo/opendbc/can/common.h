@@ -40,6 +40,17 @@ struct CanData {
   std::vector<CanFrame> frames;
 };
 
+// A batch of frames in flat arrays, e.g. a whole log. Consecutive frames with the same
+// nanos belong to the same can event, the data of frame i is dat[dat_offsets[i]:dat_offsets[i+1]]
+struct CanFrameArrays {
+  size_t size;
+  const uint64_t *nanos;
+  const uint32_t *address;
+  const uint32_t *src;
+  const uint8_t *dat;
+  const uint64_t *dat_offsets;
+};
+
 class MessageState {
 public:
   std::string name;
@@ -49,6 +60,8 @@ public:
   std::vector<Signal> parse_sigs;
   std::vector<double> vals;
   std::vector<std::vector<double>> all_vals;
+  std::vector<uint64_t> all_nanos;
+  std::vector<double> tmp_vals;
 
   uint64_t last_seen_nanos;
   uint64_t check_threshold;
@@ -81,10 +94,14 @@ public:
             const std::vector<std::pair<uint32_t, int>> &messages);
   CANParser(int abus, const std::string& dbc_name, bool ignore_checksum, bool ignore_counter);
   std::set<uint32_t> update(const std::vector<CanData> &can_data);
+  std::set<uint32_t> update(const CanFrameArrays &frames);
   MessageState *getMessageState(uint32_t address) { return &message_states.at(address); }
 
 protected:
+  void ClearAllValues();
   void UpdateCans(const CanData &can, std::set<uint32_t> &updated_addresses);
+  void UpdateFrame(uint64_t nanos, uint32_t address, const std::vector<uint8_t> &dat, std::set<uint32_t> &updated_addresses);
+  void UpdateBusTimeout(uint64_t nanos, bool bus_empty);
   void UpdateValid(uint64_t nanos);
 };
 
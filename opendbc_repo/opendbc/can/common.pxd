@@ -63,9 +63,11 @@ cdef extern from "common.h":
   cdef const DBC* dbc_lookup(const string) except +
 
   cdef cppclass MessageState:
+    string name
     vector[Signal] parse_sigs
     vector[double] vals
     vector[vector[double]] all_vals
+    vector[uint64_t] all_nanos
     uint64_t last_seen_nanos
 
   cdef struct CanFrame:
@@ -77,11 +79,20 @@ cdef extern from "common.h":
     uint64_t nanos
     vector[CanFrame] frames
 
+  cdef struct CanFrameArrays:
+    size_t size
+    const uint64_t *nanos
+    const uint32_t *address
+    const uint32_t *src
+    const uint8_t *dat
+    const uint64_t *dat_offsets
+
   cdef cppclass CANParser:
     bool can_valid
     bool bus_timeout
     CANParser(int, string, vector[pair[uint32_t, int]]) except + nogil
     set[uint32_t] update(vector[CanData]&) except + nogil
+    set[uint32_t] update(CanFrameArrays&) except + nogil
     MessageState *getMessageState(uint32_t address) nogil
 
   cdef cppclass CANPacker:
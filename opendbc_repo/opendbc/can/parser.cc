@@ -28,7 +28,7 @@ int64_t get_raw_value(const std::vector<uint8_t> &msg, const Signal &sig) {
 
 
 bool MessageState::parse(uint64_t nanos, const std::vector<uint8_t> &dat) {
-  std::vector<double> tmp_vals(parse_sigs.size());
+  tmp_vals.resize(parse_sigs.size());
   bool checksum_failed = false;
   bool counter_failed = false;
 
@@ -67,6 +67,7 @@ bool MessageState::parse(uint64_t nanos, const std::vector<uint8_t> &dat) {
     vals[i] = tmp_vals[i];
     all_vals[i].push_back(vals[i]);
   }
+  all_nanos.push_back(nanos);
   last_seen_nanos = nanos;
 
   return true;
@@ -152,11 +153,15 @@ CANParser::CANParser(int abus, const std::string& dbc_name, bool ignore_checksum
   }
 }
 
-std::set<uint32_t> CANParser::update(const std::vector<CanData> &can_data) {
-  // Clear all_values
+void CANParser::ClearAllValues() {
   for (auto &state : message_states) {
     for (auto &vals : state.second.all_vals) vals.clear();
+    state.second.all_nanos.clear();
   }
+}
+
+std::set<uint32_t> CANParser::update(const std::vector<CanData> &can_data) {
+  ClearAllValues();
 
   std::set<uint32_t> updated_addresses;
   for (const auto &c : can_data) {
@@ -170,6 +175,37 @@ std::set<uint32_t> CANParser::update(const std::vector<CanData> &can_data) {
   return updated_addresses;
 }
 
+std::set<uint32_t> CANParser::update(const CanFrameArrays &frames) {
+  ClearAllValues();
+
+  std::set<uint32_t> updated_addresses;
+  std::vector<uint8_t> dat;
+  dat.reserve(64);
+
+  size_t i = 0;
+  while (i < frames.size) {
+    const uint64_t nanos = frames.nanos[i];
+    if (first_nanos == 0) {
+      first_nanos = nanos;
+    }
+
+    bool bus_empty = true;
+    for (; i < frames.size && frames.nanos[i] == nanos; i++) {
+      if (frames.src[i] != bus) {
+        continue;
+      }
+      bus_empty = false;
+
+      dat.assign(frames.dat + frames.dat_offsets[i], frames.dat + frames.dat_offsets[i + 1]);
+      UpdateFrame(nanos, frames.address[i], dat, updated_addresses);
+    }
+
+    UpdateBusTimeout(nanos, bus_empty);
+    UpdateValid(nanos);
+  }
+  return updated_addresses;
+}
+
 void CANParser::UpdateCans(const CanData &can, std::set<uint32_t> &updated_addresses) {
   //DEBUG("got %zu messages\n", can.frames.size());
 
@@ -182,32 +218,39 @@ void CANParser::UpdateCans(const CanData &can, std::set<uint32_t> &updated_addre
     }
     bus_empty = false;
 
-    auto state_it = message_states.find(frame.address);
-    if (state_it == message_states.end()) {
-      // DEBUG("skip %d: not specified\n", cmsg.getAddress());
-      continue;
-    }
-    if (frame.dat.size() > 64) {
-      DEBUG("got message longer than 64 bytes: 0x%X %zu\n", frame.address, frame.dat.size());
-      continue;
-    }
+    UpdateFrame(can.nanos, frame.address, frame.dat, updated_addresses);
+  }
 
-    // TODO: this actually triggers for some cars. fix and enable this
-    //if (dat.size() != state_it->second.size) {
-    //  DEBUG("got message with unexpected length: expected %d, got %zu for %d", state_it->second.size, dat.size(), cmsg.getAddress());
-    //  continue;
-    //}
+  UpdateBusTimeout(can.nanos, bus_empty);
+}
 
-    if (state_it->second.parse(can.nanos, frame.dat)) {
-      updated_addresses.insert(state_it->first);
-    }
+void CANParser::UpdateFrame(uint64_t nanos, uint32_t address, const std::vector<uint8_t> &dat, std::set<uint32_t> &updated_addresses) {
+  auto state_it = message_states.find(address);
+  if (state_it == message_states.end()) {
+    // DEBUG("skip %d: not specified\n", address);
+    return;
   }
+  if (dat.size() > 64) {
+    DEBUG("got message longer than 64 bytes: 0x%X %zu\n", address, dat.size());
+    return;
+  }
+
+  // TODO: this actually triggers for some cars. fix and enable this
+  //if (dat.size() != state_it->second.size) {
+  //  DEBUG("got message with unexpected length: expected %d, got %zu for %d", state_it->second.size, dat.size(), address);
+  //  return;
+  //}
+
+  if (state_it->second.parse(nanos, dat)) {
+    updated_addresses.insert(state_it->first);
+  }
+}
 
-  // update bus timeout
+void CANParser::UpdateBusTimeout(uint64_t nanos, bool bus_empty) {
   if (!bus_empty) {
-    last_nonempty_nanos = can.nanos;
+    last_nonempty_nanos = nanos;
   }
-  bus_timeout = (can.nanos - last_nonempty_nanos) > bus_timeout_threshold;
+  bus_timeout = (nanos - last_nonempty_nanos) > bus_timeout_threshold;
 }
 
 void CANParser::UpdateValid(uint64_t nanos) {
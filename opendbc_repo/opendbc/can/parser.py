@@ -1,2 +1,4 @@
-from opendbc.can.parser_pyx import CANParser, CANDefine  # pylint: disable=no-name-in-module, import-error
+from opendbc.can.parser_pyx import CANParser, CANDefine, can_strings_to_arrays, can_strings_to_can_data  # pylint: disable=no-name-in-module, import-error
 assert CANParser, CANDefine
+assert can_strings_to_arrays
+assert can_strings_to_can_data
@@ -1,16 +1,154 @@
 # distutils: language = c++
 # cython: c_string_encoding=ascii, language_level=3
 
+from cpython.pycapsule cimport PyCapsule_GetPointer, PyCapsule_IsValid, PyCapsule_New
 from libcpp.pair cimport pair
+from libcpp.set cimport set as cpp_set
 from libcpp.string cimport string
+from libcpp.unordered_map cimport unordered_map
 from libcpp.vector cimport vector
-from libc.stdint cimport uint32_t, int
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, int
+from libc.string cimport memcpy
 
 from .common cimport CANParser as cpp_CANParser
-from .common cimport dbc_lookup, Msg, DBC, CanData
+from .common cimport dbc_lookup, Msg, DBC, CanData, CanFrameArrays, MessageState
 
 import numbers
 from collections import defaultdict
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def can_strings_to_arrays(strings):
+  # converts the update_strings input format into the flat arrays taken by CANParser.decode_frames
+  if len(strings) and not isinstance(strings[0], (list, tuple)):
+    strings = [strings]
+
+  nanos, address, src, dat, dat_offsets = [], [], [], [], [0]
+  for s in strings:
+    for frame_address, frame_dat, frame_src in s[1]:
+      nanos.append(s[0])
+      address.append(frame_address)
+      src.append(frame_src)
+      dat.append(frame_dat)
+      dat_offsets.append(dat_offsets[-1] + len(frame_dat))
+
+  return (np.array(nanos, dtype=np.uint64), np.array(address, dtype=np.uint32), np.array(src, dtype=np.uint32),
+          np.frombuffer(b"".join(dat), dtype=np.uint8), np.array(dat_offsets, dtype=np.uint64))
+
+
+# name of capsules holding a std::vector<CanData>* of already parsed packets, see can_strings_to_can_data.
+# pandad creates them straight from the capnp can messages
+cdef const char *CAN_DATA_CAPSULE_NAME = "opendbc.can.CanData"
+
+
+cdef void _free_can_data(object capsule) noexcept:
+  cdef vector[CanData] *can_data_array = <vector[CanData]*>PyCapsule_GetPointer(capsule, CAN_DATA_CAPSULE_NAME)
+  del can_data_array
+
+
+def can_strings_to_can_data(strings):
+  # converts the update_strings input format once, so the result can be passed to update_strings of several parsers
+  if PyCapsule_IsValid(strings, CAN_DATA_CAPSULE_NAME):
+    return strings
+
+  cdef vector[CanData] *can_data_array = new vector[CanData]()
+  try:
+    if len(strings) and not isinstance(strings[0], (list, tuple)):
+      strings = [strings]
+
+    can_data_array.reserve(len(strings))
+    for s in strings:
+      can_data = &(can_data_array.emplace_back())
+      can_data.nanos = s[0]
+      can_data.frames.reserve(len(s[1]))
+      for address, dat, src in s[1]:
+        frame = &(can_data.frames.emplace_back())
+        frame.address = address
+        frame.dat = dat
+        frame.src = <uint32_t>src
+  except TypeError:
+    del can_data_array
+    raise RuntimeError("invalid parameter")
+
+  return PyCapsule_New(can_data_array, CAN_DATA_CAPSULE_NAME, _free_can_data)
+
+
+cdef class SignalMapping:
+  # read-only {signal: value} view of one message, used for vl, ts_nanos and vl_all of a parser with use_arrays.
+  # signals can also be read as attributes, e.g. cp.vl["STEERING"].STEER_ANGLE. copy.copy() gives a dict snapshot
+  cdef dict index
+
+  cdef object _get(self, Py_ssize_t i):
+    raise NotImplementedError
+
+  def __getitem__(self, name):
+    return self._get(self.index[name])
+
+  def __getattr__(self, name):
+    try:
+      return self._get(self.index[name])
+    except KeyError:
+      raise AttributeError(name) from None
+
+  def __len__(self):
+    return len(self.index)
+
+  def __iter__(self):
+    return iter(self.index)
+
+  def __contains__(self, name):
+    return name in self.index
+
+  def __eq__(self, other):
+    return isinstance(other, Mapping) and dict(self.items()) == dict(other.items())
+
+  def __copy__(self):
+    return dict(self.items())
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+  def get(self, name, default=None):
+    i = self.index.get(name)
+    return default if i is None else self._get(i)
+
+  def keys(self):
+    return self.index.keys()
+
+  def values(self):
+    return [self._get(i) for i in self.index.values()]
+
+  def items(self):
+    return [(name, self._get(i)) for name, i in self.index.items()]
+
+
+cdef class SignalValues(SignalMapping):
+  cdef double[::1] vals
+
+  cdef object _get(self, Py_ssize_t i):
+    return self.vals[i]
+
+
+cdef class SignalNanos(SignalMapping):
+  cdef uint64_t[::1] nanos
+
+  cdef object _get(self, Py_ssize_t i):
+    return self.nanos[i]
+
+
+cdef class SignalHistory(SignalMapping):
+  # all values of the last update, read from the C++ message state when accessed
+  cdef cpp_CANParser *can
+  cdef object parser  # keeps can alive
+  cdef uint32_t address
+
+  cdef object _get(self, Py_ssize_t i):
+    return self.can.getMessageState(self.address).all_vals[i]
+
+
+Mapping.register(SignalMapping)
 
 
 cdef class CANParser:
@@ -18,6 +156,10 @@ cdef class CANParser:
     cpp_CANParser *can
     const DBC *dbc
     set addresses
+    unordered_map[uint32_t, size_t] offsets
+    double[::1] values_v
+    uint8_t[::1] changed_v
+    uint64_t[::1] nanos_v
 
   cdef readonly:
     dict vl
@@ -25,10 +167,18 @@ cdef class CANParser:
     dict ts_nanos
     string dbc_name
     uint32_t bus
-
-  def __init__(self, dbc_name, messages, bus=0):
+    bint use_arrays
+    # only with use_arrays: the latest value, whether it changed in the last update and the time it was last seen
+    # of every signal, indexed by signals[message][signal]
+    object values
+    object changed
+    object values_nanos
+    dict signals
+
+  def __init__(self, dbc_name, messages, bus=0, use_arrays=False):
     self.dbc_name = dbc_name
     self.bus = bus
+    self.use_arrays = use_arrays
     self.dbc = dbc_lookup(dbc_name)
     if not self.dbc:
       raise RuntimeError(f"Can't find DBC: {dbc_name}")
@@ -37,9 +187,11 @@ cdef class CANParser:
     self.vl_all = {}
     self.ts_nanos = {}
     self.addresses = set()
+    self.signals = {}
 
     # Convert message names into addresses and check existence in DBC
     cdef vector[pair[uint32_t, int]] message_v
+    cdef size_t num_signals = 0
     for i in range(len(messages)):
       c = messages[i]
       try:
@@ -54,6 +206,14 @@ cdef class CANParser:
       name = m.name.decode("utf8")
       signal_names = [sig.name.decode("utf-8") for sig in (<Msg*>m).sigs]
 
+      if use_arrays:
+        # signals of a message are stored next to each other, in the order of MessageState.vals
+        self.offsets[address] = num_signals
+        self.signals[address] = {sig_name: num_signals + j for j, sig_name in enumerate(signal_names)}
+        self.signals[name] = self.signals[address]
+        num_signals += len(signal_names)
+        continue
+
       self.vl[address] = {name: 0.0 for name in signal_names}
       self.vl[name] = self.vl[address]
       self.vl_all[address] = defaultdict(list)
@@ -70,6 +230,41 @@ cdef class CANParser:
     with nogil:
       self.can = new cpp_CANParser(cpp_bus, cpp_dbc_name, message_v)
 
+    if use_arrays:
+      self._init_arrays(num_signals)
+
+  cdef _init_arrays(self, size_t num_signals):
+    self.values = np.zeros(num_signals, dtype=np.float64)
+    self.changed = np.zeros(num_signals, dtype=bool)
+    self.values_nanos = np.zeros(num_signals, dtype=np.uint64)
+    self.values_v = self.values
+    self.changed_v = self.changed.view(np.uint8)
+    self.nanos_v = self.values_nanos
+
+    cdef SignalValues vl
+    cdef SignalNanos ts_nanos
+    cdef SignalHistory vl_all
+    cdef size_t offset
+    for address in self.addresses:
+      offset = self.offsets[address]
+      name = self.can.getMessageState(address).name.decode("utf8")
+
+      vl = SignalValues.__new__(SignalValues)
+      vl.index = self.signals[address]
+      vl.vals = self.values_v
+      ts_nanos = SignalNanos.__new__(SignalNanos)
+      ts_nanos.index = self.signals[address]
+      ts_nanos.nanos = self.nanos_v
+      vl_all = SignalHistory.__new__(SignalHistory)
+      vl_all.index = {sig_name: i - offset for sig_name, i in self.signals[address].items()}
+      vl_all.can = self.can
+      vl_all.parser = self
+      vl_all.address = address
+
+      self.vl[address] = self.vl[name] = vl
+      self.ts_nanos[address] = self.ts_nanos[name] = ts_nanos
+      self.vl_all[address] = self.vl_all[name] = vl_all
+
   def __dealloc__(self):
     if self.can:
       with nogil:
@@ -79,10 +274,20 @@ cdef class CANParser:
     # input format:
     # [nanos, [[address, data, src], ...]]
     # [[nanos, [[address, data, src], ...], ...]]
-    for address in self.addresses:
-      self.vl_all[address].clear()
+    # or already parsed packets from can_strings_to_can_data, which are shared by the parsers of all buses
+    if not self.use_arrays:
+      for address in self.addresses:
+        self.vl_all[address].clear()
 
     cdef vector[CanData] can_data_array
+    cdef vector[CanData] *parsed = NULL
+    cdef cpp_set[uint32_t] updated_addrs
+
+    if PyCapsule_IsValid(strings, CAN_DATA_CAPSULE_NAME):
+      parsed = <vector[CanData]*>PyCapsule_GetPointer(strings, CAN_DATA_CAPSULE_NAME)
+      with nogil:
+        updated_addrs = self.can.update(parsed[0])
+      return self._update_vl(updated_addrs)
 
     try:
       if len(strings) and not isinstance(strings[0], (list, tuple)):
@@ -105,7 +310,14 @@ cdef class CANParser:
 
     with nogil:
       updated_addrs = self.can.update(can_data_array)
+    return self._update_vl(updated_addrs)
 
+  cdef _update_vl(self, cpp_set[uint32_t] &updated_addrs):
+    if self.use_arrays:
+      self._update_arrays(updated_addrs)
+      return updated_addrs
+
+    cdef MessageState *state
     for addr in updated_addrs:
       vl = self.vl[addr]
       vl_all = self.vl_all[addr]
@@ -121,6 +333,101 @@ cdef class CANParser:
 
     return updated_addrs
 
+  cdef void _update_arrays(self, cpp_set[uint32_t] &updated_addrs) noexcept nogil:
+    # only writes the signals whose value changed, and flags them in changed
+    cdef const MessageState *state
+    cdef size_t offset, i
+    cdef double val
+    self.changed_v[:] = 0
+    for addr in updated_addrs:
+      state = self.can.getMessageState(addr)
+      offset = self.offsets[addr]
+      for i in range(state.vals.size()):
+        val = state.vals[i]
+        if self.values_v[offset + i] != val:
+          self.values_v[offset + i] = val
+          self.changed_v[offset + i] = 1
+        self.nanos_v[offset + i] = state.last_seen_nanos
+
+  def decode_frames(self, nanos, address, src, dat, dat_offsets):
+    # Decodes a whole batch of frames in one call, e.g. all CAN of a log. Takes flat arrays with one entry per
+    # frame, where the data of frame i is dat[dat_offsets[i]:dat_offsets[i + 1]] (see can_strings_to_arrays).
+    # Returns the timestamps and signal values of every parsed message as NumPy arrays, as two dicts
+    # {message: nanos} and {message: {signal: values}}, keyed by address and name like vl
+    cdef const uint64_t[::1] nanos_v = np.ascontiguousarray(nanos, dtype=np.uint64)
+    cdef const uint32_t[::1] address_v = np.ascontiguousarray(address, dtype=np.uint32)
+    cdef const uint32_t[::1] src_v = np.ascontiguousarray(src, dtype=np.uint32)
+    cdef const uint64_t[::1] dat_offsets_v = np.ascontiguousarray(dat_offsets, dtype=np.uint64)
+    # never empty, so that its data pointer is valid
+    if isinstance(dat, (bytes, bytearray, memoryview)):
+      dat_arr = np.frombuffer(dat, dtype=np.uint8)
+    else:
+      dat_arr = np.ascontiguousarray(dat, dtype=np.uint8)
+    cdef const uint8_t[::1] dat_v = dat_arr if dat_arr.size else np.zeros(1, dtype=np.uint8)
+
+    cdef size_t size = nanos_v.shape[0]
+    if address_v.shape[0] != size or src_v.shape[0] != size or dat_offsets_v.shape[0] != size + 1:
+      raise RuntimeError("invalid parameter")
+    if size and (dat_offsets_v[0] != 0 or np.any(np.diff(dat_offsets_v) < 0) or dat_offsets_v[size] > <uint64_t>dat_arr.size):
+      raise RuntimeError("invalid parameter")
+
+    all_nanos = {}
+    all_vals = {}
+    if size == 0:
+      return all_nanos, all_vals
+
+    cdef CanFrameArrays frames
+    frames.size = size
+    frames.nanos = &nanos_v[0]
+    frames.address = &address_v[0]
+    frames.src = &src_v[0]
+    frames.dat = &dat_v[0]
+    frames.dat_offsets = &dat_offsets_v[0]
+
+    cdef cpp_set[uint32_t] updated_addrs
+    with nogil:
+      updated_addrs = self.can.update(frames)
+
+    cdef uint32_t addr
+    cdef MessageState *state
+    cdef uint64_t[::1] nanos_out
+    cdef double[::1] vals_out
+    cdef size_t n
+    for addr in self.addresses:
+      with nogil:
+        state = self.can.getMessageState(addr)
+      name = state.name.decode("utf8")
+
+      n = state.all_nanos.size()
+      msg_nanos = np.empty(n, dtype=np.uint64)
+      msg_vals = {}
+      if n:
+        nanos_out = msg_nanos
+        memcpy(&nanos_out[0], state.all_nanos.data(), n * sizeof(uint64_t))
+      for i in range(state.parse_sigs.size()):
+        sig_vals = np.empty(n, dtype=np.float64)
+        if n:
+          vals_out = sig_vals
+          memcpy(&vals_out[0], state.all_vals[i].data(), n * sizeof(double))
+        msg_vals[<unicode>state.parse_sigs[i].name] = sig_vals
+
+      all_nanos[addr] = all_nanos[name] = msg_nanos
+      all_vals[addr] = all_vals[name] = msg_vals
+
+      # keep the latest values like update_strings
+      if updated_addrs.count(addr) and not self.use_arrays:
+        vl = self.vl[addr]
+        ts_nanos = self.ts_nanos[addr]
+        for i in range(state.parse_sigs.size()):
+          sig_name = <unicode>state.parse_sigs[i].name
+          vl[sig_name] = state.vals[i]
+          ts_nanos[sig_name] = state.last_seen_nanos
+
+    if self.use_arrays:
+      with nogil:
+        self._update_arrays(updated_addrs)
+    return all_nanos, all_vals
+
   @property
   def can_valid(self):
     cdef bint valid
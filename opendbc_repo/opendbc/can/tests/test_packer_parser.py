@@ -1,7 +1,9 @@
+import copy
+import numpy as np
 import pytest
 import random
 
-from opendbc.can.parser import CANParser
+from opendbc.can.parser import CANParser, can_strings_to_arrays, can_strings_to_can_data
 from opendbc.can.packer import CANPacker
 from opendbc.can.tests import TEST_DBC
 
@@ -176,6 +178,110 @@ class TestCanParserPacker:
         for sig in ("STEER_TORQUE", "STEER_TORQUE_REQUEST", "COUNTER", "CHECKSUM"):
           assert parser.vl["STEERING_CONTROL"][sig] == parser.vl[228][sig]
 
+  def test_decode_frames(self):
+    msgs = [("STEERING_CONTROL", 0), ("GAS_PEDAL_2", 0)]
+    dbc = "honda_civic_touring_2016_can_generated"
+    packer = CANPacker(dbc)
+
+    strings = []
+    for i in range(500):
+      frames = [packer.make_can_msg("STEERING_CONTROL", 0, {"STEER_TORQUE": i, "COUNTER": i % 4}),
+                packer.make_can_msg("STEERING_CONTROL", 1, {"STEER_TORQUE": -i})]
+      if i % 50 == 0:
+        # bad checksum
+        addr, dat, bus = frames[0]
+        frames[0] = (addr, dat[:4] + bytes([dat[4] ^ 1]) + dat[5:], bus)
+      if i % 3 == 0:
+        frames.append(packer.make_can_msg("GAS_PEDAL_2", 0, {"CAR_GAS": i / 2}))
+      strings.append([int(i * 1e7), frames])
+
+    # decoding everything at once should match updating one event at a time
+    expected_nanos, expected_vals = {}, {}
+    parser = CANParser(dbc, msgs, 0)
+    for s in strings:
+      for addr in parser.update_strings(s):
+        expected_nanos.setdefault(addr, []).append(s[0])
+        for name, vals in parser.vl_all[addr].items():
+          expected_vals.setdefault(addr, {}).setdefault(name, []).extend(vals)
+
+    batch_parser = CANParser(dbc, msgs, 0)
+    all_nanos, all_vals = batch_parser.decode_frames(*can_strings_to_arrays(strings))
+    assert set(all_nanos) == set(all_vals) == {0xe4, 0x130, "STEERING_CONTROL", "GAS_PEDAL_2"}
+    for addr in expected_nanos:
+      assert all_nanos[addr].dtype == np.uint64
+      assert all_nanos[addr].tolist() == expected_nanos[addr]
+      assert all_vals[addr].keys() == expected_vals[addr].keys()
+      for name, vals in expected_vals[addr].items():
+        assert all_vals[addr][name].tolist() == vals
+
+    assert len(all_nanos["STEERING_CONTROL"]) == 490
+    assert batch_parser.vl == parser.vl
+    assert batch_parser.can_valid == parser.can_valid
+
+    # empty and invalid input
+    assert batch_parser.decode_frames([], [], [], b"", [0]) == ({}, {})
+    with pytest.raises(RuntimeError):
+      batch_parser.decode_frames([0], [0xe4], [0], b"", [0, 8])
+
+  def test_shared_can_data(self):
+    # packets parsed once and shared by the parsers of all buses update them like the original packets
+    msgs = [("STEERING_CONTROL", 100), ("GAS_PEDAL_2", 0)]
+    dbc = "honda_civic_touring_2016_can_generated"
+    packer = CANPacker(dbc)
+    parsers = [CANParser(dbc, msgs, bus) for bus in (0, 1)]
+    shared_parsers = [CANParser(dbc, msgs, bus) for bus in (0, 1)]
+
+    for i in range(200):
+      strings = [[int((i * 2 + j) * 1e7), [packer.make_can_msg("STEERING_CONTROL", j, {"STEER_TORQUE": i, "COUNTER": i % 4}),
+                                           packer.make_can_msg("GAS_PEDAL_2", 0, {"CAR_GAS": i + j})]] for j in (0, 1)]
+      if i % 20 == 0:
+        # empty packet
+        strings.append([int((i * 2 + 1) * 1e7), []])
+
+      can_data = can_strings_to_can_data(strings)
+      assert can_strings_to_can_data(can_data) is can_data
+      for parser, shared_parser in zip(parsers, shared_parsers, strict=True):
+        assert parser.update_strings(strings) == shared_parser.update_strings(can_data)
+        assert parser.vl == shared_parser.vl
+        assert parser.vl_all == shared_parser.vl_all
+        assert parser.ts_nanos == shared_parser.ts_nanos
+        assert parser.can_valid == shared_parser.can_valid
+        assert parser.bus_timeout == shared_parser.bus_timeout
+
+    with pytest.raises(RuntimeError):
+      can_strings_to_can_data([[0, [(0xe4, 1, 0)]]])
+
+  def test_use_arrays(self):
+    # the array backed parser reads the same as the dict one, and flags the signals that changed
+    msgs = [("STEERING_CONTROL", 100), ("GAS_PEDAL_2", 0)]
+    dbc = "honda_civic_touring_2016_can_generated"
+    packer = CANPacker(dbc)
+    parser = CANParser(dbc, msgs, 0)
+    array_parser = CANParser(dbc, msgs, 0, use_arrays=True)
+    steer_torque = array_parser.signals["STEERING_CONTROL"]["STEER_TORQUE"]
+    assert array_parser.signals[0xe4] is array_parser.signals["STEERING_CONTROL"]
+    assert array_parser.vl == parser.vl
+
+    for i in range(100):
+      strings = [int(i * 1e7), [packer.make_can_msg("STEERING_CONTROL", 0, {"STEER_TORQUE": i // 2, "COUNTER": i % 4})]]
+      if i % 10 == 0:
+        strings[1].append(packer.make_can_msg("GAS_PEDAL_2", 0, {"CAR_GAS": i}))
+
+      prev = copy.copy(array_parser.vl["STEERING_CONTROL"])
+      assert parser.update_strings(strings) == array_parser.update_strings(strings)
+      assert array_parser.vl == parser.vl
+      assert array_parser.ts_nanos == parser.ts_nanos
+      for msg, sig_vals in array_parser.vl_all.items():
+        assert all(vals == parser.vl_all[msg][sig] for sig, vals in sig_vals.items())
+      assert array_parser.vl["STEERING_CONTROL"].STEER_TORQUE == array_parser.values[steer_torque] == i // 2
+      assert array_parser.changed[steer_torque] == (i % 2 == 0 and i > 0)
+      assert array_parser.changed[array_parser.signals["GAS_PEDAL_2"]["CAR_GAS"]] == (i % 10 == 0 and i > 0)
+      assert isinstance(prev, dict) and prev != array_parser.vl["STEERING_CONTROL"]
+
+    all_nanos, all_vals = array_parser.decode_frames(*can_strings_to_arrays([[0, [packer.make_can_msg("STEERING_CONTROL", 0, {"STEER_TORQUE": 5})]]]))
+    assert array_parser.vl["STEERING_CONTROL"]["STEER_TORQUE"] == all_vals["STEERING_CONTROL"]["STEER_TORQUE"][-1] == 5
+    assert array_parser.changed[steer_torque]
+
   def test_scale_offset(self):
     """Test that both scale and offset are correctly preserved"""
     dbc_file = "honda_civic_touring_2016_can_generated"
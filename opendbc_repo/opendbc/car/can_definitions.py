@@ -1,5 +1,5 @@
 from collections.abc import Callable
-from typing import NamedTuple, Protocol
+from typing import NamedTuple, NewType, Protocol
 
 
 class CanData(NamedTuple):
@@ -8,6 +8,11 @@ class CanData(NamedTuple):
   src: int
 
 
+# packets already parsed by can_strings_to_can_data (or pandad's can_capnp_to_can_data), an opaque
+# capsule the CANParsers of all buses take without converting the packets again
+ParsedCanPackets = NewType('ParsedCanPackets', object)
+CanPackets = list[tuple[int, list[CanData]]] | ParsedCanPackets
+
 CanSendCallable = Callable[[list[CanData]], None]
 
 
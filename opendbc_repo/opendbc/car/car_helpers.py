@@ -7,7 +7,7 @@ from opendbc.car import gen_empty_fingerprint
 from opendbc.car.can_definitions import CanRecvCallable, CanSendCallable
 from opendbc.car.carlog import carlog
 from opendbc.car.structs import CarParams, CarParamsT
-from opendbc.car.fingerprints import eliminate_incompatible_cars, all_legacy_fingerprint_cars
+from opendbc.car.fingerprints import ALL_FINGERPRINT_CARS_MASK, cars_from_mask, compatible_cars_mask
 from opendbc.car.fw_versions import ObdCallback, get_fw_versions_ordered, get_present_ecus, match_fw_to_car
 from opendbc.car.mock.values import CAR as MOCK
 from opendbc.car.values import BRANDS
@@ -45,7 +45,8 @@ interfaces = load_interfaces(interface_names)
 
 def can_fingerprint(can_recv: CanRecvCallable) -> tuple[str | None, dict[int, dict]]:
   finger = gen_empty_fingerprint()
-  candidate_cars = {i: all_legacy_fingerprint_cars() for i in [0, 1]}  # attempt fingerprint on both bus 0 and 1
+  # attempt fingerprint on both bus 0 and 1, candidates are bitmasks from the precompiled fingerprint index
+  candidate_cars = {i: ALL_FINGERPRINT_CARS_MASK for i in [0, 1]}
   frame = 0
   car_fingerprint = None
   done = False
@@ -62,20 +63,20 @@ def can_fingerprint(can_recv: CanRecvCallable) -> tuple[str | None, dict[int, di
             finger[can.src] = {}
           finger[can.src][can.address] = len(can.dat)
 
-        for b in candidate_cars:
-          # Ignore extended messages and VIN query response.
-          if can.src == b and can.address < 0x800 and can.address not in (0x7df, 0x7e0, 0x7e8):
-            candidate_cars[b] = eliminate_incompatible_cars(can, candidate_cars[b])
+        # Ignore extended messages and VIN query response.
+        if can.src in candidate_cars and can.address < 0x800 and can.address not in (0x7df, 0x7e0, 0x7e8):
+          candidate_cars[can.src] &= compatible_cars_mask(can.address, len(can.dat))
 
       # if we only have one car choice and the time since we got our first
       # message has elapsed, exit
-      for b in candidate_cars:
-        if len(candidate_cars[b]) == 1 and frame > FRAME_FINGERPRINT:
+      for cc in candidate_cars.values():
+        # single bit set
+        if cc != 0 and cc & (cc - 1) == 0 and frame > FRAME_FINGERPRINT:
           # fingerprint done
-          car_fingerprint = candidate_cars[b][0]
+          car_fingerprint = cars_from_mask(cc)[0]
 
       # bail if no cars left or we've been waiting for more than 2s
-      failed = (all(len(cc) == 0 for cc in candidate_cars.values()) and frame > FRAME_FINGERPRINT) or frame > 200
+      failed = (all(cc == 0 for cc in candidate_cars.values()) and frame > FRAME_FINGERPRINT) or frame > 200
       succeeded = car_fingerprint is not None
       done = failed or succeeded
 
@@ -24,6 +24,36 @@ def is_valid_for_fingerprint(msg, car_fingerprint: dict[int, int]):
   return (adr in car_fingerprint and car_fingerprint[adr] == len(msg.dat)) or adr >= 0x800
 
 
+def _build_fingerprint_index() -> dict[tuple[int, int], int]:
+  """Maps every (address, length) to a bitmask of the cars, by their index in _FINGERPRINT_CARS, that
+     have it in any of their fingerprints."""
+  index: dict[tuple[int, int], int] = {}
+  for i, car_name in enumerate(_FINGERPRINT_CARS):
+    for fingerprint in _FINGERPRINTS[car_name]:
+      # add alien debug address
+      for address, length in (fingerprint | _DEBUG_ADDRESS).items():
+        index[(address, length)] = index.get((address, length), 0) | (1 << i)
+  return index
+
+
+_FINGERPRINT_CARS = list(_FINGERPRINTS.keys())
+_FINGERPRINT_INDEX = _build_fingerprint_index()
+ALL_FINGERPRINT_CARS_MASK = (1 << len(_FINGERPRINT_CARS)) - 1
+
+
+def compatible_cars_mask(address: int, length: int) -> int:
+  """Bitmask of the cars that could have sent a message with this address and length."""
+  # ignore addresses that are more than 11 bits
+  if address >= 0x800:
+    return ALL_FINGERPRINT_CARS_MASK
+  return _FINGERPRINT_INDEX.get((address, length), 0)
+
+
+def cars_from_mask(mask: int) -> list[str]:
+  """Returns the cars in a bitmask from compatible_cars_mask, in all_legacy_fingerprint_cars() order."""
+  return [car_name for i, car_name in enumerate(_FINGERPRINT_CARS) if mask >> i & 1]
+
+
 def eliminate_incompatible_cars(msg, candidate_cars):
   """Removes cars that could not have sent msg.
 
@@ -34,18 +64,8 @@ def eliminate_incompatible_cars(msg, candidate_cars):
      Returns:
       A list containing the subset of candidate_cars that could have sent msg.
   """
-  compatible_cars = []
-
-  for car_name in candidate_cars:
-    car_fingerprints = _FINGERPRINTS[car_name]
-
-    for fingerprint in car_fingerprints:
-      # add alien debug address
-      if is_valid_for_fingerprint(msg, fingerprint | _DEBUG_ADDRESS):
-        compatible_cars.append(car_name)
-        break
-
-  return compatible_cars
+  compatible = set(cars_from_mask(compatible_cars_mask(msg.address, len(msg.dat))))
+  return [car_name for car_name in candidate_cars if car_name in compatible]
 
 
 def all_legacy_fingerprint_cars():
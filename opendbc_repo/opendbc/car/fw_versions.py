@@ -1,5 +1,5 @@
 from collections import defaultdict
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterable, Iterator
 from typing import Protocol, TypeVar
 
 from tqdm import tqdm
@@ -46,25 +46,10 @@ def build_fw_dict(fw_versions: list[CarParams.CarFw], filter_brand: str = None)
   return dict(fw_versions_dict)
 
 
-class MatchFwToCar(Protocol):
-  def __call__(self, live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True) -> set[str]:
-    ...
-
-
-def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True, exclude: str = None) -> set[str]:
-  """Do a fuzzy FW match. This function will return a match, and the number of firmware version
-  that were matched uniquely to that specific car. If multiple ECUs uniquely match to different cars
-  the match is rejected."""
-
-  # Build lookup table from (addr, sub_addr, fw) to list of candidate cars
+def _build_fuzzy_fw_index() -> dict[tuple[int, int | None, bytes], tuple[str, ...]]:
+  # Lookup table from (addr, sub_addr, fw) to all candidate cars with that FW response on that address
   all_fw_versions = defaultdict(list)
   for candidate, fw_by_addr in FW_VERSIONS.items():
-    if not is_brand(MODEL_TO_BRAND[candidate], match_brand):
-      continue
-
-    if candidate == exclude:
-      continue
-
     for addr, fws in fw_by_addr.items():
       # These ECUs are known to be shared between models (EPS only between hybrid/ICE version)
       # Getting this exactly right isn't crucial, but excluding camera and radar makes it almost
@@ -74,6 +59,44 @@ def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = N
         continue
       for f in fws:
         all_fw_versions[(addr[1], addr[2], f)].append(candidate)
+  return {k: tuple(v) for k, v in all_fw_versions.items()}
+
+
+def _build_exact_fw_table() -> dict[str, list[tuple[Ecu, AddrType, frozenset[bytes], bool]]]:
+  # For each candidate, the ECUs that need to match: (ecu type, address, expected versions, can be missing)
+  table = {}
+  for candidate, fws in FW_VERSIONS.items():
+    config = FW_QUERY_CONFIGS[MODEL_TO_BRAND[candidate]]
+    table[candidate] = []
+    for ecu, expected_versions in fws.items():
+      ecu_type = ecu[0]
+      # Virtual debug ecu doesn't need to match the database
+      if ecu_type == Ecu.debug:
+        continue
+
+      # Some models can sometimes miss an ecu, or show on two different addresses
+      # FIXME: this logic can be improved to be more specific, should require one of the two addresses
+      # Non essential ecus are also ignored if missing
+      optional = candidate in config.non_essential_ecus.get(ecu_type, []) or ecu_type not in ESSENTIAL_ECUS
+      table[candidate].append((ecu, ecu[1:], frozenset(expected_versions), optional))
+  return table
+
+
+# built once, matching is called for every brand of every logged set of FW versions in offline regression runs
+FUZZY_FW_INDEX = _build_fuzzy_fw_index()
+EXACT_FW_TABLE = _build_exact_fw_table()
+CARS_BY_BRAND = {brand: [c for c in FW_VERSIONS if MODEL_TO_BRAND[c] == brand] for brand in VERSIONS}
+
+
+class MatchFwToCar(Protocol):
+  def __call__(self, live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True) -> set[str]:
+    ...
+
+
+def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True, exclude: str = None) -> set[str]:
+  """Do a fuzzy FW match. This function will return a match, and the number of firmware version
+  that were matched uniquely to that specific car. If multiple ECUs uniquely match to different cars
+  the match is rejected."""
 
   matched_ecus = set()
   match: str | None = None
@@ -81,7 +104,9 @@ def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = N
     ecu_key = (addr[0], addr[1])
     for version in versions:
       # All cars that have this FW response on the specified address
-      candidates = all_fw_versions[(*ecu_key, version)]
+      candidates = FUZZY_FW_INDEX.get((*ecu_key, version), ())
+      if match_brand is not None or exclude is not None:
+        candidates = tuple(c for c in candidates if is_brand(MODEL_TO_BRAND[c], match_brand) and c != exclude)
 
       if len(candidates) == 1:
         matched_ecus.add(ecu_key)
@@ -109,37 +134,24 @@ def match_fw_to_car_exact(live_fw_versions: LiveFwVersions, match_brand: str = N
   if extra_fw_versions is None:
     extra_fw_versions = {}
 
-  invalid = set()
-  candidates = {c: f for c, f in FW_VERSIONS.items() if
-                is_brand(MODEL_TO_BRAND[c], match_brand)}
-
-  for candidate, fws in candidates.items():
-    config = FW_QUERY_CONFIGS[MODEL_TO_BRAND[candidate]]
-    for ecu, expected_versions in fws.items():
-      expected_versions = expected_versions + extra_fw_versions.get(candidate, {}).get(ecu, [])
-      ecu_type = ecu[0]
-      addr = ecu[1:]
-
+  matches = set()
+  for candidate in (CARS_BY_BRAND.get(match_brand, []) if match_brand is not None else FW_VERSIONS):
+    extra = extra_fw_versions.get(candidate, {})
+    for ecu, addr, expected_versions, optional in EXACT_FW_TABLE[candidate]:
       found_versions = live_fw_versions.get(addr, set())
       if not len(found_versions):
-        # Some models can sometimes miss an ecu, or show on two different addresses
-        # FIXME: this logic can be improved to be more specific, should require one of the two addresses
-        if candidate in config.non_essential_ecus.get(ecu_type, []):
+        if optional:
           continue
+        break
 
-        # Ignore non essential ecus
-        if ecu_type not in ESSENTIAL_ECUS:
-          continue
-
-      # Virtual debug ecu doesn't need to match the database
-      if ecu_type == Ecu.debug:
-        continue
-
-      if not any(found_version in expected_versions for found_version in found_versions):
-        invalid.add(candidate)
+      if ecu in extra:
+        expected_versions = expected_versions.union(extra[ecu])
+      if expected_versions.isdisjoint(found_versions):
         break
+    else:
+      matches.add(candidate)
 
-  return set(candidates.keys()) - invalid
+  return matches
 
 
 def match_fw_to_car(fw_versions: list[CarParams.CarFw], vin: str, allow_exact: bool = True,
@@ -151,11 +163,11 @@ def match_fw_to_car(fw_versions: list[CarParams.CarFw], vin: str, allow_exact: b
   if allow_fuzzy:
     exact_matches.append((False, match_fw_to_car_fuzzy))
 
+  fw_versions_dicts = {brand: build_fw_dict(fw_versions, filter_brand=brand) for brand in VERSIONS.keys()}
   for exact_match, match_func in exact_matches:
     # For each brand, attempt to fingerprint using all FW returned from its queries
     matches: set[str] = set()
-    for brand in VERSIONS.keys():
-      fw_versions_dict = build_fw_dict(fw_versions, filter_brand=brand)
+    for brand, fw_versions_dict in fw_versions_dicts.items():
       matches |= match_func(fw_versions_dict, match_brand=brand, log=log)
 
       # If specified and no matches so far, fall back to brand's fuzzy fingerprinting function
@@ -169,6 +181,21 @@ def match_fw_to_car(fw_versions: list[CarParams.CarFw], vin: str, allow_exact: b
   return True, set()
 
 
+def match_fw_to_cars(fw_versions_list: Iterable[tuple[list[CarParams.CarFw], str]], allow_exact: bool = True,
+                     allow_fuzzy: bool = True) -> list[tuple[bool, set[str]]]:
+  """match_fw_to_car for many (fw_versions, vin) pairs at once, e.g. from logs. Sets of FW versions
+  that are identical for matching are only matched once."""
+  cache: dict[tuple, tuple[bool, set[str]]] = {}
+  results = []
+  for fw_versions, vin in fw_versions_list:
+    key = (vin, frozenset((fw.brand, fw.address, fw.subAddress, fw.fwVersion) for fw in fw_versions if not fw.logging))
+    if key not in cache:
+      cache[key] = match_fw_to_car(fw_versions, vin, allow_exact, allow_fuzzy, log=False)
+    exact_match, matches = cache[key]
+    results.append((exact_match, set(matches)))
+  return results
+
+
 def get_present_ecus(can_recv: CanRecvCallable, can_send: CanSendCallable, set_obd_multiplexing: ObdCallback, num_pandas: int = 1) -> set[EcuAddrBusType]:
   # queries are split by OBD multiplexing mode
   queries: dict[bool, list[list[EcuAddrBusType]]] = {True: [], False: []}
@@ -11,12 +11,12 @@ from functools import cache
 
 from opendbc.car import DT_CTRL, apply_hysteresis, gen_empty_fingerprint, scale_rot_inertia, scale_tire_stiffness, get_friction, STD_CARGO_KG
 from opendbc.car import structs
-from opendbc.car.can_definitions import CanData, CanRecvCallable, CanSendCallable
+from opendbc.car.can_definitions import CanData, CanPackets, CanRecvCallable, CanSendCallable
 from opendbc.car.common.basedir import BASEDIR
 from opendbc.car.common.conversions import Conversions as CV
 from opendbc.car.common.simple_kalman import KF1D, get_kalman_gain
 from opendbc.car.values import PLATFORMS
-from opendbc.can.parser import CANParser
+from opendbc.can.parser import CANParser, can_strings_to_can_data
 
 GearShifter = structs.CarState.GearShifter
 ButtonType = structs.CarState.ButtonEvent.Type
@@ -97,7 +97,7 @@ class RadarInterfaceBase(ABC):
     self.pts: dict[int, structs.RadarData.RadarPoint] = {}
     self.frame = 0
 
-  def update(self, can_packets: list[tuple[int, list[CanData]]]) -> structs.RadarDataT | None:
+  def update(self, can_packets: CanPackets) -> structs.RadarDataT | None:
     self.frame += 1
     if (self.frame % 5) == 0:  # 20 Hz is very standard
       return structs.RadarData()
@@ -242,11 +242,12 @@ class CarInterfaceBase(ABC):
   def _update(self) -> structs.CarState:
     return self.CS.update(self.can_parsers)
 
-  def update(self, can_packets: list[tuple[int, list[CanData]]]) -> structs.CarState:
-    # parse can
+  def update(self, can_packets: CanPackets) -> structs.CarState:
+    # parse can, converting the packets once for the parsers of all buses
+    can_data = can_strings_to_can_data(can_packets)
     for cp in self.can_parsers.values():
       if cp is not None:
-        cp.update_strings(can_packets)
+        cp.update_strings(can_data)
 
     # get CarState
     ret = self._update()
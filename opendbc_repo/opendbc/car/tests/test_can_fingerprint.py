@@ -1,7 +1,8 @@
 import pytest
 from opendbc.car.can_definitions import CanData
 from opendbc.car.car_helpers import FRAME_FINGERPRINT, can_fingerprint
-from opendbc.car.fingerprints import _FINGERPRINTS as FINGERPRINTS
+from opendbc.car.fingerprints import _FINGERPRINTS as FINGERPRINTS, _DEBUG_ADDRESS, all_legacy_fingerprint_cars, \
+                                     eliminate_incompatible_cars, is_valid_for_fingerprint
 
 
 class TestCanFingerprint:
@@ -21,6 +22,18 @@ class TestCanFingerprint:
       assert finger[1] == fingerprint
       assert finger[2] == {}
 
+  def test_fingerprint_index(self):
+    """The precompiled index eliminates the same cars as checking every fingerprint"""
+    all_cars = all_legacy_fingerprint_cars()
+    msgs = {(address, length) for fingerprints in FINGERPRINTS.values() for fingerprint in fingerprints for address, length in fingerprint.items()}
+    msgs |= {(address, length + 1) for address, length in msgs} | {(1, 8), (1880, 8), (2016, 8)}
+
+    for address, length in msgs:
+      can = CanData(address=address, dat=b'\x00' * length, src=0)
+      expected = [car for car in all_cars if any(is_valid_for_fingerprint(can, fp | _DEBUG_ADDRESS) for fp in FINGERPRINTS[car])]
+      assert eliminate_incompatible_cars(can, all_cars) == expected
+      assert eliminate_incompatible_cars(can, expected[::-1]) == expected[::-1]
+
   def test_timing(self, subtests):
     # just pick any CAN fingerprinting car
     car_model = "CHEVROLET_BOLT_EUV"
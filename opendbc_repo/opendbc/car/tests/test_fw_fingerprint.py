@@ -8,7 +8,7 @@ from opendbc.car.car_helpers import interfaces
 from opendbc.car.structs import CarParams
 from opendbc.car.fingerprints import FW_VERSIONS
 from opendbc.car.fw_versions import FW_QUERY_CONFIGS, FUZZY_EXCLUDE_ECUS, VERSIONS, build_fw_dict, \
-                                    match_fw_to_car, get_brand_ecu_matches, get_fw_versions, get_present_ecus
+                                    match_fw_to_car, match_fw_to_cars, get_brand_ecu_matches, get_fw_versions, get_present_ecus
 from opendbc.car.vin import get_vin
 
 CarFw = CarParams.CarFw
@@ -95,6 +95,19 @@ class TestFwFingerprint:
       elif len(matches):
         self.assertFingerprints(matches, car_model)
 
+  def test_batch_match(self):
+    # Batch matching agrees with matching each set of FW versions on its own, also for repeated sets
+    fw_versions_list = []
+    for brand, cars in VERSIONS.items():
+      for ecus in cars.values():
+        fw = [CarFw(ecu=ecu[0], fwVersion=random.choice(fw_versions), brand=brand, address=ecu[1], subAddress=0 if ecu[2] is None else ecu[2])
+              for ecu, fw_versions in ecus.items()]
+        fw_versions_list += [(fw, ""), (fw[1:], ""), (fw, "")]
+
+    results = match_fw_to_cars(fw_versions_list)
+    assert results == [match_fw_to_car(fw, vin, log=False) for fw, vin in fw_versions_list]
+    assert results[0] is not results[2] and results[0][1] is not results[2][1]
+
   def test_fw_version_lists(self, subtests):
     for car_model, ecus in FW_VERSIONS.items():
       with subtests.test(car_model=car_model.value):
@@ -19,7 +19,7 @@ from opendbc.car.fw_versions import ObdCallback
 from opendbc.car.car_helpers import get_car, interfaces
 from opendbc.car.interfaces import CarInterfaceBase, RadarInterfaceBase
 from opendbc.safety import ALTERNATIVE_EXPERIENCE
-from openpilot.selfdrive.pandad import can_capnp_to_list, can_list_to_can_capnp
+from openpilot.selfdrive.pandad import can_capnp_to_can_data, can_list_to_can_capnp
 from openpilot.selfdrive.car.cruise import VCruiseHelper
 from openpilot.selfdrive.car.car_specific import MockCarState
 
@@ -172,15 +172,16 @@ class Car:
     """carState update loop, driven by can"""
 
     can_strs = messaging.drain_sock_raw(self.can_sock, wait_for_one=True)
-    can_list = can_capnp_to_list(can_strs)
+    # parsed once in C++ and shared by the can parsers of all buses and the radar interface
+    can_data = can_capnp_to_can_data(can_strs)
 
     # Update carState from CAN
-    CS = self.CI.update(can_list)
+    CS = self.CI.update(can_data)
     if self.CP.brand == 'mock':
       CS = self.mock_carstate.update(CS)
 
     # Update radar tracks from CAN
-    RD: structs.RadarDataT | None = self.RI.update(can_list)
+    RD: structs.RadarDataT | None = self.RI.update(can_data)
 
     self.sm.update(0)
 
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import numpy as np
+import time
+from tqdm import tqdm
+
+from opendbc.car.can_definitions import CanData
+from opendbc.car.car_helpers import can_fingerprint
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.plotjuggler.juggle import DEMO_ROUTE
+
+N_RUNS = 10
+N_PACKETS = 300  # can_fingerprint gives up after 200 frames
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Replay the startup CAN of a route through CAN fingerprinting")
+  parser.add_argument("route", nargs='?', default=DEMO_ROUTE + "/0")
+  parser.add_argument("--runs", type=int, default=N_RUNS)
+  args = parser.parse_args()
+
+  can_packets = []
+  for msg in LogReader(args.route):
+    if msg.which() == 'can':
+      can_packets.append([CanData(c.address, c.dat, c.src) for c in msg.can])
+      if len(can_packets) == N_PACKETS:
+        break
+
+  ets = []
+  for _ in tqdm(range(args.runs)):
+    frames = 0
+    packets = itertools.cycle(can_packets)
+
+    def can_recv(**kwargs):
+      global frames
+      frames += 1
+      return [next(packets)]  # noqa: B023
+
+    start_t = time.process_time_ns()
+    car_fingerprint, _ = can_fingerprint(can_recv)
+    ets.append((time.process_time_ns() - start_t) * 1e-6)
+
+  print(f'fingerprinted {car_fingerprint} after {frames} CAN packets, {args.runs} runs')
+  print(f'{np.mean(ets):.2f} mean ms, {max(ets):.2f} max ms, {min(ets):.2f} min ms, {np.std(ets):.2f} std ms')
+  print(f'{np.mean(ets) / frames:.4f} mean ms / CAN packet')
@@ -52,25 +52,49 @@ def rotate_std(rot_matrix, std_in):
 
 
 class NPQueue:
-  def __init__(self, maxlen: int, rowsize: int) -> None:
+  """
+  Fixed size FIFO of rows in a preallocated buffer. Every row is written twice, maxlen rows apart, so the
+  rows in insertion order are always the contiguous slice arr, and neither appending nor reading copies.
+  """
+  def __init__(self, maxlen: int, rowsize: int, buf: np.ndarray | None = None) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((2 * maxlen, rowsize)) if buf is None else buf
+    assert self.buf.shape == (2 * maxlen, rowsize)
+    self.start = 0
+    self.size = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.size
+
+  @property
+  def arr(self) -> np.ndarray:
+    # view of the rows, oldest first. only valid until the next append
+    return self.buf[self.start:self.start + self.size]
 
   def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    end = (self.start + self.size) % self.maxlen
+    self.buf[end] = pt
+    self.buf[end + self.maxlen] = pt
+    if self.size < self.maxlen:
+      self.size += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      self.start = (self.start + 1) % self.maxlen
+
+  def extend(self, pts: np.ndarray) -> None:
+    pts = np.asarray(pts, dtype=self.buf.dtype).reshape(-1, self.buf.shape[1])[-self.maxlen:]
+    idx = (self.start + self.size + np.arange(len(pts))) % self.maxlen
+    self.buf[idx] = pts
+    self.buf[idx + self.maxlen] = pts
+    self.start = (self.start + max(self.size + len(pts) - self.maxlen, 0)) % self.maxlen
+    self.size = min(self.size + len(pts), self.maxlen)
 
 
 class PointBuckets:
   def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int) -> None:
     self.x_bounds = x_bounds
-    self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize) for bounds in x_bounds}
+    # the buckets share one buffer, so points can be sampled from all of them at once
+    self.points = np.empty((len(x_bounds), 2 * points_per_bucket, rowsize))
+    self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize, buf=buf) for bounds, buf in zip(x_bounds, self.points, strict=True)}
     self.buckets_min_points = dict(zip(x_bounds, min_points, strict=True))
     self.min_points_total = min_points_total
 
@@ -89,10 +113,17 @@ class PointBuckets:
     raise NotImplementedError
 
   def get_points(self, num_points: int = None) -> Any:
-    points = np.vstack([x.arr for x in self.buckets.values()])
     if num_points is None:
-      return points
-    return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
+      return np.concatenate([x.arr for x in self.buckets.values()])
+
+    # sample the points of all buckets in order, like from a stack of them, but gather them straight from the buffer
+    sizes = np.array([len(x) for x in self.buckets.values()])
+    ends = np.cumsum(sizes)
+    idx = np.random.choice(ends[-1], min(ends[-1], num_points), replace=False)
+    bucket = np.searchsorted(ends, idx, side='right')
+    starts = np.array([x.start for x in self.buckets.values()])
+    rows = bucket * self.points.shape[1] + starts[bucket] + idx - (ends - sizes)[bucket]
+    return self.points.reshape(-1, self.points.shape[2])[rows]
 
   def load_points(self, points: list[list[float]]) -> None:
     for point in points:
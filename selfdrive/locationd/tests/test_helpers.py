@@ -0,0 +1,103 @@
+import numpy as np
+from collections import deque
+
+from openpilot.selfdrive.locationd.helpers import NPQueue
+from openpilot.selfdrive.locationd.torqued import STEER_BUCKET_BOUNDS, TorqueBuckets
+
+
+class AppendOnlyBuckets:
+  """Reference torque buckets: a deque of rows per bucket, one point at a time."""
+  def __init__(self, x_bounds, points_per_bucket):
+    self.buckets = {bounds: deque(maxlen=points_per_bucket) for bounds in x_bounds}
+
+  def add_point(self, x, y):
+    for bound_min, bound_max in self.buckets:
+      if bound_min <= x < bound_max:
+        self.buckets[(bound_min, bound_max)].append([x, 1.0, y])
+        break
+
+  def get_points(self, num_points=None):
+    points = np.array([pt for bucket in self.buckets.values() for pt in bucket]).reshape(-1, 3)
+    if num_points is None:
+      return points
+    return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
+
+
+def make_buckets(points_per_bucket):
+  return TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS, min_points=[1] * len(STEER_BUCKET_BOUNDS), min_points_total=1,
+                       points_per_bucket=points_per_bucket, rowsize=3)
+
+
+class TestNPQueue:
+  def test_append_wraparound(self):
+    q, ref = NPQueue(maxlen=5, rowsize=2), deque(maxlen=5)
+    for i in range(17):
+      q.append([i, -i])
+      ref.append([i, -i])
+      assert len(q) == len(ref)
+      np.testing.assert_array_equal(q.arr, np.array(ref).reshape(-1, 2))
+
+  def test_extend(self):
+    rng = np.random.default_rng(0)
+    q, ref = NPQueue(maxlen=7, rowsize=2), deque(maxlen=7)
+    # empty, partial, wrapping around and larger than the queue
+    for n in (0, 3, 5, 6, 20, 1, 7):
+      pts = rng.normal(size=(n, 2))
+      q.extend(pts)
+      ref.extend(pts.tolist())
+      assert len(q) == len(ref)
+      np.testing.assert_array_equal(q.arr, np.array(ref).reshape(-1, 2))
+
+  def test_extend_mixed_with_append(self):
+    q, ref = NPQueue(maxlen=4, rowsize=1), deque(maxlen=4)
+    for i in range(10):
+      q.append([i])
+      ref.append([i])
+      q.extend([[100 + i], [200 + i]])
+      ref.extend([[100 + i], [200 + i]])
+      np.testing.assert_array_equal(q.arr, np.array(ref))
+
+
+class TestPointBuckets:
+  def test_get_points(self):
+    rng = np.random.default_rng(0)
+    buckets, ref = make_buckets(50), AppendOnlyBuckets(STEER_BUCKET_BOUNDS, 50)
+    for step in range(2000):
+      x, y = rng.uniform(-0.6, 0.6), rng.normal()
+      buckets.add_point(x, y)
+      ref.add_point(x, y)
+
+      if step % 97 == 0:
+        assert len(buckets) == len(ref.get_points())
+        np.testing.assert_array_equal(buckets.get_points(), ref.get_points())
+        # sampling draws the same points for the same seed
+        for num_points in (1, 10, 200, 1000):
+          np.random.seed(step)
+          expected = ref.get_points(num_points)
+          np.random.seed(step)
+          np.testing.assert_array_equal(buckets.get_points(num_points), expected)
+
+  def test_load_points(self):
+    rng = np.random.default_rng(1)
+    # out of bounds points are dropped, a bucket overflows
+    points = np.column_stack([rng.uniform(-0.6, 0.6, size=500), rng.normal(size=500)])
+    points[:100, 0] = 0.05
+
+    buckets, ref = make_buckets(40), AppendOnlyBuckets(STEER_BUCKET_BOUNDS, 40)
+    buckets.load_points(points.tolist())
+    for x, y in points:
+      ref.add_point(x, y)
+    np.testing.assert_array_equal(buckets.get_points(), ref.get_points())
+
+    # loaded on top of existing points
+    more = np.column_stack([rng.uniform(-0.6, 0.6, size=30), rng.normal(size=30)])
+    buckets.load_points(more.tolist())
+    for x, y in more:
+      ref.add_point(x, y)
+    np.testing.assert_array_equal(buckets.get_points(), ref.get_points())
+
+  def test_load_no_points(self):
+    buckets = make_buckets(10)
+    buckets.load_points([])
+    assert len(buckets) == 0
+    assert buckets.get_points().shape == (0, 3)
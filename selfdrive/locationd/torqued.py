@@ -49,6 +49,16 @@ class TorqueBuckets(PointBuckets):
         self.buckets[(bound_min, bound_max)].append([x, 1.0, y])
         break
 
+  def load_points(self, points):
+    points = np.array([list(pt) for pt in points], dtype=np.float64).reshape(-1, 2)
+    x, y = points.T
+    rows = np.column_stack([x, np.ones_like(x), y])
+    unassigned = np.ones(len(x), dtype=bool)
+    for bound_min, bound_max in self.x_bounds:
+      in_bucket = unassigned & (x >= bound_min) & (x < bound_max)
+      self.buckets[(bound_min, bound_max)].extend(rows[in_bucket])
+      unassigned &= ~in_bucket
+
 
 class TorqueEstimator(ParameterEstimator):
 
@@ -159,7 +169,8 @@ class TorqueEstimator(ParameterEstimator):
     try:
       _, _, v = np.linalg.svd(points, full_matrices=False)
       slope, offset = -v.T[0:2, 2] / v.T[2, 2]
-      _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
+      rot = slope2rot(slope)
+      spread = points[:, 0] * rot[0, 1] + points[:, 2] * rot[1, 1]
       friction_coeff = np.std(spread) * FRICTION_FACTOR
     except np.linalg.LinAlgError as e:
       cloudlog.exception(f"Error computing live torque params: {e}")
@@ -1,4 +1,7 @@
 # Cython, now uses scons to build
-from openpilot.selfdrive.pandad.pandad_api_impl import can_list_to_can_capnp, can_capnp_to_list
+from openpilot.selfdrive.pandad.pandad_api_impl import can_list_to_can_capnp, can_capnp_to_list, can_capnp_to_arrays, \
+                                                        can_capnp_to_can_data
 assert can_list_to_can_capnp
 assert can_capnp_to_list
+assert can_capnp_to_arrays
+assert can_capnp_to_can_data
@@ -48,3 +48,26 @@ void can_capnp_to_can_list_cpp(const std::vector<std::string> &strings, std::vec
     }
   }
 }
+
+// Converts a vector of Cap'n Proto serialized can strings into flat frame arrays, as taken by CANParser.decode_frames.
+void can_capnp_to_can_arrays_cpp(const std::vector<std::string> &strings, std::vector<uint64_t> &nanos, std::vector<uint32_t> &address,
+                                 std::vector<uint32_t> &src, std::vector<uint8_t> &dat, std::vector<uint64_t> &dat_offsets, bool sendcan) {
+  AlignedBuffer aligned_buf;
+  dat_offsets.push_back(0);
+
+  for (const auto &str : strings) {
+    capnp::FlatArrayMessageReader reader(aligned_buf.align(str.data(), str.size()));
+    cereal::Event::Reader event = reader.getRoot<cereal::Event>();
+
+    auto frames = sendcan ? event.getSendcan() : event.getCan();
+    for (const auto &frame : frames) {
+      nanos.push_back(event.getLogMonoTime());
+      address.push_back(frame.getAddress());
+      src.push_back(frame.getSrc());
+
+      auto frame_dat = frame.getDat();
+      dat.insert(dat.end(), frame_dat.begin(), frame_dat.end());
+      dat_offsets.push_back(dat.size());
+    }
+  }
+}
@@ -1,10 +1,14 @@
 # distutils: language = c++
 # cython: language_level=3
+from cpython.pycapsule cimport PyCapsule_GetPointer, PyCapsule_New
 from cython.operator cimport dereference as deref, preincrement as preinc
 from libcpp.vector cimport vector
 from libcpp.string cimport string
 from libcpp cimport bool
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.string cimport memcpy
+
+import numpy as np
 
 cdef extern from "opendbc/can/common.h":
   cdef struct CanFrame:
@@ -18,7 +22,9 @@ cdef extern from "opendbc/can/common.h":
 
 cdef extern from "can_list_to_can_capnp.cc":
   void can_list_to_can_capnp_cpp(const vector[CanFrame] &can_list, string &out, bool sendcan, bool valid) nogil
-  void can_capnp_to_can_list_cpp(const vector[string] &strings, vector[CanData] &can_data, bool sendcan)
+  void can_capnp_to_can_list_cpp(const vector[string] &strings, vector[CanData] &can_data, bool sendcan) except +
+  void can_capnp_to_can_arrays_cpp(const vector[string] &strings, vector[uint64_t] &nanos, vector[uint32_t] &address,
+                                   vector[uint32_t] &src, vector[uint8_t] &dat, vector[uint64_t] &dat_offsets, bool sendcan) except +
 
 def can_list_to_can_capnp(can_msgs, msgtype='can', valid=True):
   cdef CanFrame *f
@@ -54,3 +60,39 @@ def can_capnp_to_list(strings, msgtype='can'):
     result.append((d.nanos, frames))
     preinc(it)
   return result
+
+# same name as in opendbc's parser_pyx, whose CANParser.update_strings takes these capsules
+cdef const char *CAN_DATA_CAPSULE_NAME = "opendbc.can.CanData"
+
+cdef void _free_can_data(object capsule) noexcept:
+  cdef vector[CanData] *data = <vector[CanData]*>PyCapsule_GetPointer(capsule, CAN_DATA_CAPSULE_NAME)
+  del data
+
+def can_capnp_to_can_data(strings, msgtype='can'):
+  # parses the can strings once into packets that CANParser.update_strings of every bus takes as they are,
+  # without creating Python objects for the frames
+  cdef vector[CanData] *data = new vector[CanData]()
+  try:
+    can_capnp_to_can_list_cpp(strings, deref(data), msgtype == 'sendcan')
+  except Exception:
+    del data
+    raise
+  return PyCapsule_New(data, CAN_DATA_CAPSULE_NAME, _free_can_data)
+
+cdef _to_array(const void *data, size_t size, dtype):
+  arr = np.empty(size, dtype=dtype)
+  cdef uint8_t[::1] out = arr.view(np.uint8)
+  if size:
+    memcpy(&out[0], data, out.shape[0])
+  return arr
+
+def can_capnp_to_arrays(strings, msgtype='can'):
+  # flat frame arrays of whole can event streams, for CANParser.decode_frames
+  cdef vector[uint64_t] nanos, dat_offsets
+  cdef vector[uint32_t] address, src
+  cdef vector[uint8_t] dat
+  can_capnp_to_can_arrays_cpp(strings, nanos, address, src, dat, dat_offsets, msgtype == 'sendcan')
+
+  return (_to_array(nanos.data(), nanos.size(), np.uint64), _to_array(address.data(), address.size(), np.uint32),
+          _to_array(src.data(), src.size(), np.uint32), _to_array(dat.data(), dat.size(), np.uint8),
+          _to_array(dat_offsets.data(), dat_offsets.size(), np.uint64))
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import os
-import time
 import threading
 
 import cereal.messaging as messaging
@@ -480,11 +479,13 @@ class SelfdriveD:
       return log.LongitudinalPersonality.standard
 
   def params_thread(self, evt):
+    version = self.params.get_version()
     while not evt.is_set():
       self.is_metric = self.params.get_bool("IsMetric")
       self.experimental_mode = self.params.get_bool("ExperimentalMode") and self.CP.openpilotLongitudinalControl
       self.personality = self.read_personality_param()
-      time.sleep(0.1)
+      # wakes up right away when any param is written
+      version = self.params.wait_for_change(version, timeout=0.1)
 
   def run(self):
     e = threading.Event()
@@ -4,12 +4,14 @@ from __future__ import annotations
 import base64
 import hashlib
 import io
+import itertools
 import json
 import os
 import queue
 import random
 import select
 import socket
+import struct
 import sys
 import tempfile
 import threading
@@ -19,9 +21,11 @@ from datetime import datetime
 from functools import partial, total_ordering
 from queue import Queue
 from typing import cast
-from collections.abc import Callable
+from collections import deque
+from collections.abc import Callable, Iterable
 
 import requests
+import zstandard as zstd
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import (ABNF, WebSocket, WebSocketException, WebSocketTimeoutException,
                        create_connection)
@@ -31,9 +35,11 @@ from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
 from openpilot.common.file_helpers import CallbackReader, get_upload_stream
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
+from openpilot.system.loggerd.resumable_upload import ResumableUpload, supports_resumable_upload
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 from openpilot.system.version import get_build_metadata
@@ -52,6 +58,21 @@ RETRY_DELAY = 10  # seconds
 MAX_RETRY_COUNT = 30  # Try for at most 5 minutes if upload fails immediately
 MAX_AGE = 31 * 24 * 3600  # seconds
 WS_FRAME_SIZE = 4096
+LOG_WINDOW = 4  # forwardLogs requests awaiting a response
+LOG_RESPONSE_TIMEOUT_S = 100
+STATS_WINDOW = 4  # storeStats requests waiting to be sent
+STATS_BATCH_BYTES = 512 * 1024
+
+# binary transport, used when the server accepts it in the handshake. messages of at least
+# WS_COMPRESS_MIN_BYTES are zstd compressed and sent in chunks of WS_FRAME_SIZE, each chunk
+# a binary message prefixed with WS_CHUNK_HEADER, so chunks of several messages can be interleaved
+WS_ENCODING_HEADER = "Athena-Encoding"
+WS_ENCODING_ZSTD = "zstd"
+WS_COMPRESS_MIN_BYTES = 1024
+WS_COMPRESSION_LEVEL = 3
+WS_CHUNK_HEADER = struct.Struct("<BI")  # flags, message id
+WS_CHUNK_FINAL = 1
+WS_SEND_POLL_S = 0.05
 DEVICE_STATE_UPDATE_INTERVAL = 1.0  # in seconds
 DEFAULT_UPLOAD_PRIORITY = 99  # higher number = lower priority
 
@@ -151,11 +172,12 @@ class UploadQueueCache:
 
 def handle_long_poll(ws: WebSocket, exit_event: threading.Event | None) -> None:
   end_event = threading.Event()
+  binary = (ws.getheaders() or {}).get(WS_ENCODING_HEADER.lower()) == WS_ENCODING_ZSTD
 
   threads = [
     threading.Thread(target=ws_manage, args=(ws, end_event), name='ws_manage'),
-    threading.Thread(target=ws_recv, args=(ws, end_event), name='ws_recv'),
-    threading.Thread(target=ws_send, args=(ws, end_event), name='ws_send'),
+    threading.Thread(target=ws_recv, args=(ws, end_event, binary), name='ws_recv'),
+    threading.Thread(target=ws_send, args=(ws, end_event, binary), name='ws_send'),
     threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler'),
     threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler2'),
     threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler3'),
@@ -306,6 +328,9 @@ def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.R
     path = strip_zst_extension(path)
     compress = True
 
+  if supports_resumable_upload(upload_item.url):
+    return ResumableUpload(path, upload_item.url, upload_item.headers, compress, timeout=30, callback=callback).upload()
+
   stream = None
   try:
     stream, content_length = get_upload_stream(path, compress)
@@ -562,18 +587,59 @@ def takeSnapshot() -> str | dict[str, str] | None:
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
+class DirectoryTracker:
+  """
+    Names of the files in a directory. The directory is listed once and then kept up to date
+    with inotify events, or listed again every rescan_interval seconds where inotify isn't available.
+  """
+  def __init__(self, path: str, rescan_interval: float = 10.):
+    self.path = path
+    self.rescan_interval = rescan_interval
+    self.names: set[str] = set()
+    self.last_scan: float | None = None
+
+    self.inotify: Inotify | None = None
+    try:
+      self.inotify = Inotify()
+      self.inotify.add_watch(path, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    except OSError:
+      self.inotify = None
+
+  def _list(self) -> None:
+    self.names = set(os.listdir(self.path))
+    self.last_scan = time.monotonic()
+
+  def update(self, timeout: float = 0) -> bool:
+    """Apply the changes since the last update, waiting up to timeout seconds for one. Returns whether anything changed."""
+    if self.last_scan is None or (self.inotify is None and time.monotonic() - self.last_scan > self.rescan_interval):
+      self._list()
+      return True
+    if self.inotify is None:
+      time.sleep(timeout)
+      return False
+
+    events = self.inotify.read(timeout)
+    for event in events:
+      if event.mask & IN_Q_OVERFLOW:
+        self._list()
+      elif event.mask & (IN_CREATE | IN_MOVED_TO):
+        self.names.add(event.name)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self.names.discard(event.name)
+    return len(events) > 0
+
+
+def get_logs_to_send_sorted(log_entries: Iterable[str] | None = None) -> list[str]:
   curr_time = int(time.time())
   logs = []
-  for log_entry in os.listdir(Paths.swaglog_root()):
+  for log_entry in (os.listdir(Paths.swaglog_root()) if log_entries is None else log_entries):
     log_path = os.path.join(Paths.swaglog_root(), log_entry)
     time_sent = 0
     try:
       value = getxattr(log_path, LOG_ATTR_NAME)
       if value is not None:
         time_sent = int.from_bytes(value, sys.byteorder)
-    except (ValueError, TypeError):
+    except (ValueError, TypeError, OSError):
       pass
     # assume send failed and we lost the response if sent more than one hour ago
     if not time_sent or curr_time - time_sent > 3600:
@@ -582,23 +648,47 @@ def get_logs_to_send_sorted() -> list[str]:
   return sorted(logs)[:-1]
 
 
+def read_batch(directory: str, names: list[str], max_bytes: int) -> tuple[list[str], str]:
+  """Read and concatenate files from the end of names (removing them) until max_bytes, but at least one file."""
+  batch, contents, size = [], [], 0
+  while names and (not batch or size < max_bytes):
+    name = names.pop()
+    try:
+      with open(os.path.join(directory, name)) as f:
+        data = f.read()
+    except OSError:
+      continue  # file could be deleted by log rotation
+    batch.append(name)
+    contents.append(data)
+    size += len(data)
+  return batch, "".join(contents)
+
+
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
+  # up to LOG_WINDOW logs are sent without waiting for a response, so the backlog
+  # drains at the link bandwidth rather than one log per round trip
+  tracker = DirectoryTracker(Paths.swaglog_root())
+  log_files: list[str] = []
+  in_flight: dict[str, float] = {}  # log_entry -> send time
   last_scan = 0.
   while not end_event.is_set():
     try:
       curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
+      if tracker.update() or curr_scan - last_scan > 10:
+        log_files = [log_entry for log_entry in get_logs_to_send_sorted(tracker.names) if log_entry not in in_flight]
         last_scan = curr_scan
 
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
+      # stop waiting for lost responses, those logs are sent again once their sent time is old enough
+      for log_entry, sent_time in list(in_flight.items()):
+        if curr_scan - sent_time > LOG_RESPONSE_TIMEOUT_S:
+          del in_flight[log_entry]
+
+      # send one log per request
+      while len(log_files) > 0 and len(in_flight) < LOG_WINDOW:
+        log_entry = log_files.pop()  # newest log file
         cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
         try:
           curr_time = int(time.time())
@@ -614,31 +704,25 @@ def log_handler(end_event: threading.Event) -> None:
               "id": log_entry
             }
             low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
+            in_flight[log_entry] = curr_scan
         except OSError:
           pass  # file could be deleted by log rotation
 
-      # wait for response up to ~100 seconds
       # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
+      try:
+        log_resp = json.loads(log_recv_queue.get(timeout=1))
+        log_entry = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
+        in_flight.pop(log_entry, None)
+        if log_entry and log_success:
+          log_path = os.path.join(Paths.swaglog_root(), log_entry)
+          try:
+            setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+          except OSError:
+            pass  # file could be deleted by log rotation
+      except queue.Empty:
+        pass
 
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
@@ -646,30 +730,32 @@ def log_handler(end_event: threading.Event) -> None:
 
 def stat_handler(end_event: threading.Event) -> None:
   STATS_DIR = Paths.stats_root()
-  last_scan = 0.0
+  tracker = DirectoryTracker(STATS_DIR)
 
   while not end_event.is_set():
-    curr_scan = time.monotonic()
     try:
-      if curr_scan - last_scan > 10:
-        stat_filenames = list(filter(lambda name: not name.startswith(tempfile.gettempprefix()), os.listdir(STATS_DIR)))
-        if len(stat_filenames) > 0:
-          stat_path = os.path.join(STATS_DIR, stat_filenames[0])
-          with open(stat_path) as f:
-            jsonrpc = {
-              "method": "storeStats",
-              "params": {
-                "stats": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": stat_filenames[0]
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-          os.remove(stat_path)
-        last_scan = curr_scan
+      tracker.update(timeout=1)
+      # oldest first, several files per request while the send queue has room
+      stat_filenames = sorted((name for name in tracker.names if not name.startswith(tempfile.gettempprefix())), reverse=True)
+      while len(stat_filenames) > 0 and low_priority_send_queue.qsize() < STATS_WINDOW:
+        batch, stats = read_batch(STATS_DIR, stat_filenames, STATS_BATCH_BYTES)
+        if not batch:
+          break
+        jsonrpc = {
+          "method": "storeStats",
+          "params": {
+            "stats": stats
+          },
+          "jsonrpc": "2.0",
+          "id": batch[0]
+        }
+        low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+        for name in batch:
+          os.remove(os.path.join(STATS_DIR, name))
+          tracker.names.discard(name)
     except Exception:
       cloudlog.exception("athena.stat_handler.exception")
-    time.sleep(0.1)
+      end_event.wait(1)
 
 
 def ws_proxy_recv(ws: WebSocket, local_sock: socket.socket, ssock: socket.socket, end_event: threading.Event, global_end_event: threading.Event) -> None:
@@ -721,14 +807,38 @@ def ws_proxy_send(ws: WebSocket, local_sock: socket.socket, signal_sock: socket.
   cloudlog.debug("athena.ws_proxy_send done closing sockets")
 
 
-def ws_recv(ws: WebSocket, end_event: threading.Event) -> None:
+def encode_binary_message(msg_id: int, data: str) -> list[bytes]:
+  compressed = zstd.compress(data.encode("utf-8"), WS_COMPRESSION_LEVEL)
+  chunks = [compressed[i:i+WS_FRAME_SIZE] for i in range(0, len(compressed), WS_FRAME_SIZE)]
+  return [WS_CHUNK_HEADER.pack(WS_CHUNK_FINAL if i == len(chunks) - 1 else 0, msg_id) + chunk for i, chunk in enumerate(chunks)]
+
+
+class BinaryMessageDecoder:
+  def __init__(self):
+    self.partial: dict[int, list[bytes]] = {}
+
+  def feed(self, data: bytes) -> str | None:
+    """Add a received chunk, returns the message once all of its chunks arrived."""
+    flags, msg_id = WS_CHUNK_HEADER.unpack_from(data)
+    self.partial.setdefault(msg_id, []).append(data[WS_CHUNK_HEADER.size:])
+    if not flags & WS_CHUNK_FINAL:
+      return None
+    return zstd.ZstdDecompressor().decompressobj().decompress(b"".join(self.partial.pop(msg_id))).decode("utf-8")
+
+
+def ws_recv(ws: WebSocket, end_event: threading.Event, binary: bool = False) -> None:
   last_ping = int(time.monotonic() * 1e9)
+  decoder = BinaryMessageDecoder()
   while not end_event.is_set():
     try:
       opcode, data = ws.recv_data(control_frame=True)
       if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
         if opcode == ABNF.OPCODE_TEXT:
           data = data.decode("utf-8")
+        elif binary:
+          data = decoder.feed(data)
+          if data is None:
+            continue
         recv_queue.put_nowait(data)
       elif opcode == ABNF.OPCODE_PING:
         last_ping = int(time.monotonic() * 1e9)
@@ -743,18 +853,41 @@ def ws_recv(ws: WebSocket, end_event: threading.Event) -> None:
       end_event.set()
 
 
-def ws_send(ws: WebSocket, end_event: threading.Event) -> None:
+def ws_send_text(ws: WebSocket, data: str) -> None:
+  for i in range(0, len(data), WS_FRAME_SIZE):
+    frame = data[i:i+WS_FRAME_SIZE]
+    last = i + WS_FRAME_SIZE >= len(data)
+    opcode = ABNF.OPCODE_TEXT if i == 0 else ABNF.OPCODE_CONT
+    ws.send_frame(ABNF.create_frame(frame, opcode, last))
+
+
+def ws_send(ws: WebSocket, end_event: threading.Event, binary: bool = False) -> None:
+  # with the binary transport, chunks of a large low priority message are only sent
+  # while there is nothing in send_queue, so they don't hold up interactive responses
+  msg_ids = itertools.count()
+  low_priority_chunks: deque[bytes] = deque()
   while not end_event.is_set():
     try:
       try:
         data = send_queue.get_nowait()
+        if binary and len(data) >= WS_COMPRESS_MIN_BYTES:
+          for chunk in encode_binary_message(next(msg_ids), data):
+            ws.send_frame(ABNF.create_frame(chunk, ABNF.OPCODE_BINARY))
+        else:
+          ws_send_text(ws, data)
+        continue
       except queue.Empty:
-        data = low_priority_send_queue.get(timeout=1)
-      for i in range(0, len(data), WS_FRAME_SIZE):
-        frame = data[i:i+WS_FRAME_SIZE]
-        last = i + WS_FRAME_SIZE >= len(data)
-        opcode = ABNF.OPCODE_TEXT if i == 0 else ABNF.OPCODE_CONT
-        ws.send_frame(ABNF.create_frame(frame, opcode, last))
+        pass
+
+      if low_priority_chunks:
+        ws.send_frame(ABNF.create_frame(low_priority_chunks.popleft(), ABNF.OPCODE_BINARY))
+        continue
+
+      data = low_priority_send_queue.get(timeout=WS_SEND_POLL_S)
+      if binary and len(data) >= WS_COMPRESS_MIN_BYTES:
+        low_priority_chunks.extend(encode_binary_message(next(msg_ids), data))
+      else:
+        ws_send_text(ws, data)
     except queue.Empty:
       pass
     except Exception:
@@ -815,6 +948,7 @@ def main(exit_event: threading.Event = None):
       cloudlog.event("athenad.main.connecting_ws", ws_uri=ws_uri, retries=conn_retries)
       ws = create_connection(ws_uri,
                              cookie="jwt=" + api.get_token(),
+                             header=[f"{WS_ENCODING_HEADER}: {WS_ENCODING_ZSTD}"],
                              enable_multithread=True,
                              timeout=30.0)
       cloudlog.event("athenad.main.connected_ws", ws_uri=ws_uri, retries=conn_retries,
@@ -58,6 +58,9 @@ class MockWebsocket:
   def send(self, data, opcode):
     self.send_queue.put_nowait((data, opcode))
 
+  def send_frame(self, frame):
+    self.send_queue.put_nowait((frame.data, frame.opcode))
+
   def close(self):
     pass
 
@@ -5,6 +5,8 @@ import multiprocessing
 import os
 import requests
 import shutil
+import sys
+import tempfile
 import time
 import threading
 import queue
@@ -446,3 +448,147 @@ class TestAthenadMethods:
     # ensure the list is all logs except most recent
     sl = athenad.get_logs_to_send_sorted()
     assert sl == fl[:-1]
+
+  def _start_handler(self, handler):
+    athenad.low_priority_send_queue = queue.Queue()
+    athenad.log_recv_queue = queue.Queue()
+    end_event = threading.Event()
+    thread = threading.Thread(target=handler, args=(end_event,), daemon=True)
+    thread.start()
+    return end_event, thread
+
+  @staticmethod
+  def _get_requests(n: int, timeout: float = 3) -> list[dict]:
+    reqs = [json.loads(athenad.low_priority_send_queue.get(timeout=timeout)) for _ in range(n)]
+    with pytest.raises(queue.Empty):
+      athenad.low_priority_send_queue.get(timeout=0.5)
+    return reqs
+
+  def test_log_handler_window(self, mocker):
+    mocker.patch.object(athenad, "PC", False)
+    fl = [self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), data=f'log {i}\n'.encode()) for i in range(10)]
+    names = [os.path.basename(fn) for fn in fl]
+
+    end_event, thread = self._start_handler(athenad.log_handler)
+    try:
+      # one log per request, newest first, up to LOG_WINDOW awaiting a response
+      reqs = self._get_requests(athenad.LOG_WINDOW)
+      assert [r['id'] for r in reqs] == names[-2:-2 - athenad.LOG_WINDOW:-1]
+      assert all(r['method'] == 'forwardLogs' and r['params']['logs'] == f'log {int(r["id"][-10:])}\n' for r in reqs)
+
+      # a response frees a slot for the next log
+      athenad.log_recv_queue.put_nowait(json.dumps({'result': {'success': 1}, 'id': reqs[0]['id'], 'jsonrpc': '2.0'}))
+      assert [r['id'] for r in self._get_requests(1)] == [names[-2 - athenad.LOG_WINDOW]]
+      value = athenad.getxattr(os.path.join(Paths.swaglog_root(), reqs[0]['id']), athenad.LOG_ATTR_NAME)
+      assert value == athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME
+    finally:
+      end_event.set()
+      thread.join()
+
+  def test_log_handler_resend(self, mocker):
+    mocker.patch.object(athenad, "PC", False)
+    mocker.patch.object(athenad, "LOG_WINDOW", 1)
+    mocker.patch.object(athenad, "LOG_RESPONSE_TIMEOUT_S", 0.5)
+    for i in range(3):
+      self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), data=b'log\n')
+
+    end_event, thread = self._start_handler(athenad.log_handler)
+    try:
+      # without a response, the next log is sent after the timeout
+      first = json.loads(athenad.low_priority_send_queue.get(timeout=3))['id']
+      second = json.loads(athenad.low_priority_send_queue.get(timeout=3))['id']
+      assert (first, second) == ('swaglog.0000000001', 'swaglog.0000000000')
+      with pytest.raises(queue.Empty):
+        athenad.low_priority_send_queue.get(timeout=1.5)
+
+      # logs sent over an hour ago are sent again
+      curr_time = int(time.time())
+      athenad.setxattr(os.path.join(Paths.swaglog_root(), first), athenad.LOG_ATTR_NAME, int.to_bytes(curr_time - 3601, 4, sys.byteorder))
+      self._create_file('swaglog.0000000003', Paths.swaglog_root(), data=b'log\n')
+      assert [r['id'] for r in self._get_requests(2)] == ['swaglog.0000000002', first]
+    finally:
+      end_event.set()
+      thread.join()
+
+  def test_stat_handler(self, mocker):
+    for i in range(3):
+      self._create_file(f'stats.{i}', Paths.stats_root(), data=f'stat {i}\n'.encode())
+    self._create_file(f'{tempfile.gettempprefix()}stats', Paths.stats_root(), data=b'partial\n')
+
+    # all stats files in one request, oldest first
+    end_event, thread = self._start_handler(athenad.stat_handler)
+    try:
+      reqs = self._get_requests(1)
+      assert reqs[0]['method'] == 'storeStats'
+      assert reqs[0]['id'] == 'stats.0'
+      assert reqs[0]['params']['stats'] == 'stat 0\nstat 1\nstat 2\n'
+    finally:
+      end_event.set()
+      thread.join()
+    assert os.listdir(Paths.stats_root()) == [f'{tempfile.gettempprefix()}stats']
+
+  def test_stat_handler_window(self, mocker):
+    mocker.patch.object(athenad, "STATS_BATCH_BYTES", 1)
+    mocker.patch.object(athenad, "STATS_WINDOW", 2)
+    for i in range(3):
+      self._create_file(f'stats.{i}', Paths.stats_root(), data=f'stat {i}\n'.encode())
+
+    # batches are queued while the send queue has room
+    end_event, thread = self._start_handler(athenad.stat_handler)
+    try:
+      time.sleep(1)
+      assert athenad.low_priority_send_queue.qsize() == 2
+      assert [r['params']['stats'] for r in self._get_requests(3)] == ['stat 0\n', 'stat 1\n', 'stat 2\n']
+    finally:
+      end_event.set()
+      thread.join()
+
+  def test_directory_tracker(self):
+    self._create_file('swaglog.0000000000', Paths.swaglog_root())
+    tracker = athenad.DirectoryTracker(Paths.swaglog_root())
+    tracker.update()
+    assert 'swaglog.0000000000' in tracker.names
+
+    self._create_file('swaglog.0000000001', Paths.swaglog_root())
+    os.unlink(os.path.join(Paths.swaglog_root(), 'swaglog.0000000000'))
+    tracker.update(timeout=1)
+    assert 'swaglog.0000000000' not in tracker.names
+    assert 'swaglog.0000000001' in tracker.names
+
+  def test_binary_message(self):
+    data = json.dumps({"result": ["a" * 10000, os.urandom(10000).hex()], "id": 0, "jsonrpc": "2.0"})
+    chunks = athenad.encode_binary_message(7, data)
+    assert len(chunks) > 1
+
+    decoder = athenad.BinaryMessageDecoder()
+    assert [decoder.feed(c) for c in chunks[:-1]] == [None] * (len(chunks) - 1)
+    assert decoder.feed(chunks[-1]) == data
+
+  def test_ws_send_interleaving(self):
+    ws_send = queue.Queue()
+    mock_ws = MockWebsocket(queue.Queue(), ws_send)
+    end_event = threading.Event()
+
+    # a large low priority message doesn't hold up responses queued while it's being sent
+    athenad.low_priority_send_queue.put_nowait(json.dumps({"method": "forwardLogs", "params": {"logs": os.urandom(100000).hex()}}))
+    send_frame = mock_ws.send_frame
+    def send_first_frame(frame):
+      athenad.send_queue.put_nowait(json.dumps({"result": 1, "id": 0, "jsonrpc": "2.0"}))
+      mock_ws.send_frame = send_frame
+      send_frame(frame)
+    mock_ws.send_frame = send_first_frame
+
+    thread = threading.Thread(target=athenad.ws_send, args=(mock_ws, end_event, True))
+    thread.start()
+    try:
+      frames = [ws_send.get(timeout=3)]
+      while not (frames[-1][1] == ABNF.OPCODE_BINARY and frames[-1][0][0] & athenad.WS_CHUNK_FINAL):
+        frames.append(ws_send.get(timeout=3))
+    finally:
+      end_event.set()
+      thread.join()
+
+    opcodes = [opcode for _, opcode in frames]
+    assert len(frames) > 3
+    assert opcodes[1] == ABNF.OPCODE_TEXT
+    assert opcodes.count(ABNF.OPCODE_TEXT) == 1
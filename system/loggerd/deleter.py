@@ -2,11 +2,16 @@
 import os
 import shutil
 import threading
+import time
+from dataclasses import dataclass
+from collections.abc import Callable
 from openpilot.system.hardware.hw import Paths
+from openpilot.common.inotify import IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, \
+                                     IN_ONLYDIR, IN_Q_OVERFLOW, Inotify
 from openpilot.common.swaglog import cloudlog
 from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
-from openpilot.system.loggerd.uploader import listdir_by_creation
-from openpilot.system.loggerd.xattr_cache import getxattr
+from openpilot.system.loggerd.uploader import get_directory_sort, listdir_by_creation
+from openpilot.system.loggerd.xattr_cache import getxattr, invalidate
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
@@ -17,15 +22,25 @@ PRESERVE_ATTR_NAME = 'user.preserve'
 PRESERVE_ATTR_VALUE = b'1'
 PRESERVE_COUNT = 5
 
+# free space is checked this often while above the thresholds. deleting starts early enough
+# that, at the observed write rate, the thresholds aren't crossed before the next check
+CHECK_INTERVAL_S = 30
+PREDICT_HORIZON_S = 2 * CHECK_INTERVAL_S
+WRITE_RATE_ALPHA = 0.3
+
+# without inotify, the catalogue rescans the log root this often
+RESCAN_INTERVAL_S = 60
+LOGDIR_EVENTS = IN_CREATE | IN_DELETE | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+
 
 def has_preserve_xattr(d: str) -> bool:
   return getxattr(os.path.join(Paths.log_root(), d), PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE
 
 
-def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
+def get_preserved_segments(dirs_by_creation: list[str], is_preserved: Callable[[str], bool] = has_preserve_xattr) -> set[str]:
   # skip deleting most recent N preserved segments (and their prior segment)
   preserved = set()
-  for n, d in enumerate(filter(has_preserve_xattr, reversed(dirs_by_creation))):
+  for n, d in enumerate(filter(is_preserved, reversed(dirs_by_creation))):
     if n == PRESERVE_COUNT:
       break
     date_str, _, seg_str = d.rpartition("--")
@@ -45,31 +60,192 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
+@dataclass
+class LogDir:
+  size: int = 0
+  locked: bool = False
+  preserved: bool = False
+
+
+class LogCatalogue:
+  """
+    In-memory catalogue of the log directories with their size on disk, lock and preserve state. The log root is
+    scanned once, after that only directories inotify reports as changed, and the locked ones still being written,
+    are scanned again (or everything every RESCAN_INTERVAL_S where inotify isn't available). Directories that couldn't
+    be watched are scanned every RESCAN_INTERVAL_S, and finished ones aren't watched anymore, except for DELETE_LAST.
+  """
+  def __init__(self, root: str):
+    self.root = root
+    self.dirs: dict[str, LogDir] = {}
+    self.dirty: set[str] = set()
+    self.last_rescan: float | None = None
+
+    self.watches: dict[int, str] = {}
+    self.unwatched: set[str] = set()
+    self.inotify: Inotify | None = None
+    try:
+      self.inotify = Inotify()
+      # IN_ATTRIB on the root watch reports xattr changes of the log directories
+      self.root_wd = self.inotify.add_watch(root, LOGDIR_EVENTS | IN_ATTRIB | IN_ONLYDIR)
+    except OSError:
+      cloudlog.exception("deleter: inotify not available, falling back to rescanning")
+      self.inotify = None
+
+  def _rescan(self) -> None:
+    names = set(listdir_by_creation(self.root))
+    for name in set(self.dirs) - names:
+      self.remove(name)
+    self.dirty.update(names)
+    self.last_rescan = time.monotonic()
+
+  def _watch(self, name: str) -> None:
+    if self.inotify is None or name in self.watches.values():
+      return
+
+    try:
+      self.watches[self.inotify.add_watch(os.path.join(self.root, name), LOGDIR_EVENTS)] = name
+      self.unwatched.discard(name)
+    except OSError:
+      # e.g. out of watches (ENOSPC), scan it every RESCAN_INTERVAL_S instead
+      if name not in self.unwatched:
+        cloudlog.exception(f"deleter: failed to watch {name}")
+      self.unwatched.add(name)
+
+  def _unwatch(self, name: str) -> None:
+    self.unwatched.discard(name)
+    for wd in [wd for wd, n in self.watches.items() if n == name]:
+      del self.watches[wd]
+      if self.inotify is not None:
+        self.inotify.rm_watch(wd)
+
+  def _scan(self, name: str) -> None:
+    path = os.path.join(self.root, name)
+    self._watch(name)
+    try:
+      d = LogDir()
+      has_files = False
+      with os.scandir(path) as it:
+        for e in it:
+          if e.name.endswith(".lock"):
+            d.locked = True
+          elif e.is_file(follow_symlinks=False):
+            d.size += e.stat(follow_symlinks=False).st_blocks * 512
+            has_files = True
+      d.preserved = getxattr(path, PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE
+    except OSError:
+      self.remove(name)
+      return
+    self.dirs[name] = d
+
+    # finished directories don't change anymore, the root watch still reports their preserve xattr.
+    # an empty one could still be getting set up, a logdir is created before its lock file
+    if not d.locked and has_files and name not in DELETE_LAST:
+      self._unwatch(name)
+
+  def refresh(self) -> None:
+    if self.last_rescan is None or (self.inotify is None and time.monotonic() - self.last_rescan > RESCAN_INTERVAL_S):
+      self._rescan()
+    elif self.unwatched and time.monotonic() - self.last_rescan > RESCAN_INTERVAL_S:
+      self.dirty.update(self.unwatched)
+      self.last_rescan = time.monotonic()
+
+    if self.inotify is not None:
+      for event in self.inotify.read():
+        if event.mask & IN_Q_OVERFLOW:
+          self._rescan()
+        elif event.wd == self.root_wd:
+          if not event.mask & IN_ISDIR:
+            continue
+          if event.mask & (IN_DELETE | IN_MOVED_FROM):
+            self.remove(event.name)
+          else:
+            if event.mask & IN_ATTRIB:
+              invalidate(os.path.join(self.root, event.name))
+            self.dirty.add(event.name)
+        elif event.mask & IN_IGNORED:
+          self.watches.pop(event.wd, None)
+        elif event.wd in self.watches:
+          self.dirty.add(self.watches[event.wd])
+
+    # directories being written to don't generate events until their files are closed
+    self.dirty.update(name for name, d in self.dirs.items() if d.locked)
+    for name in self.dirty:
+      self._scan(name)
+    self.dirty.clear()
+
+  def remove(self, name: str) -> None:
+    self.dirs.pop(name, None)
+    self._unwatch(name)
+    invalidate(os.path.join(self.root, name))
+
+  def deletion_order(self) -> list[str]:
+    dirs = sorted(self.dirs, key=get_directory_sort)
+    preserved_dirs = get_preserved_segments(dirs, lambda d: self.dirs[d].preserved)
+    return sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs))
+
+
+class WriteRateEstimator:
+  """Exponentially smoothed rate at which free space shrinks, in bytes/s, not counting space freed by the deleter."""
+  def __init__(self):
+    self.rate = 0.
+    self.last: tuple[float, int] | None = None
+
+  def update(self, available: int, freed: int = 0) -> float:
+    now = time.monotonic()
+    if self.last is not None and now > self.last[0]:
+      written = self.last[1] + freed - available
+      self.rate += WRITE_RATE_ALPHA * (max(written, 0) / (now - self.last[0]) - self.rate)
+    self.last = (now, available)
+    return self.rate
+
+
+def bytes_to_free(available_bytes: int, available_percent: float, write_rate: float) -> int:
+  # free space predicted at the next check, compared to both thresholds
+  predicted = available_bytes - write_rate * PREDICT_HORIZON_S
+  total_bytes = available_bytes * 100 / available_percent if available_percent > 0 else 0
+  return int(max(MIN_BYTES - predicted, total_bytes * MIN_PERCENT / 100 - predicted, 0))
+
+
 def deleter_thread(exit_event: threading.Event):
+  catalogue = LogCatalogue(Paths.log_root())
+  write_rate = WriteRateEstimator()
+  freed = 0
+
   while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+    available_bytes = get_available_bytes(default=MIN_BYTES + 1)
+    available_percent = get_available_percent(default=MIN_PERCENT + 1)
+    rate = write_rate.update(available_bytes, freed)
+    freed = 0
 
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
-      preserved_dirs = get_preserved_segments(dirs)
+    out_of_bytes = available_bytes < MIN_BYTES
+    out_of_percent = available_percent < MIN_PERCENT
+    to_free = bytes_to_free(available_bytes, available_percent, rate)
 
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
+    if out_of_percent or out_of_bytes or to_free > 0:
+      catalogue.refresh()
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+      # remove the earliest directories we can, until enough space is freed
+      deleted = False
+      for delete_dir in catalogue.deletion_order():
+        if catalogue.dirs[delete_dir].locked:
           continue
 
+        delete_path = os.path.join(Paths.log_root(), delete_dir)
         try:
           cloudlog.info(f"deleting {delete_path}")
           shutil.rmtree(delete_path)
-          break
+          freed += catalogue.dirs[delete_dir].size
+          catalogue.remove(delete_dir)
+          deleted = True
         except OSError:
           cloudlog.exception(f"issue deleting {delete_path}")
-      exit_event.wait(.1)
+
+        if freed >= to_free:
+          break
+      # only keep at it while actually out of space when there was nothing left to delete
+      exit_event.wait(.1 if deleted or out_of_percent or out_of_bytes else CHECK_INTERVAL_S)
     else:
-      exit_event.wait(30)
+      exit_event.wait(CHECK_INTERVAL_S)
 
 
 def main():
@@ -0,0 +1,111 @@
+import base64
+import io
+import json
+import os
+import urllib.parse
+from collections.abc import Callable
+
+import requests
+import zstandard as zstd
+
+from openpilot.common.file_helpers import UPLOAD_CHUNK_SIZE, CallbackReader, ThrottledReader, iter_upload_chunks
+from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
+
+UPLOAD_PROGRESS_ATTR_NAME = 'user.upload_progress'
+RESUMABLE_HOST_SUFFIX = ".blob.core.windows.net"
+
+
+def supports_resumable_upload(url: str) -> bool:
+  # upload urls pointing to Azure blob storage can be uploaded in blocks
+  return (urllib.parse.urlsplit(url).hostname or "").endswith(RESUMABLE_HOST_SUFFIX)
+
+
+def block_id(idx: int) -> str:
+  # all block ids of a blob must have the same length
+  return base64.b64encode(f"{idx:08d}".encode()).decode()
+
+
+def _with_query(url: str, **params: str) -> str:
+  return url + ("&" if urllib.parse.urlsplit(url).query else "?") + urllib.parse.urlencode(params)
+
+
+class ResumableUpload:
+  """
+    Uploads a file to a block blob, one UPLOAD_CHUNK_SIZE block at a time. The file is compressed into a single
+    zstd frame while it is sent, so the upload starts right away and only one block is held in memory. The number
+    of blocks the server has staged is stored in an xattr of the file, so an interrupted upload continues from the
+    next block. Staged blocks become the blob once the block list is committed at the end.
+  """
+  def __init__(self, fn: str, url: str, headers: dict[str, str], compress: bool, timeout: float,
+               callback: Callable | None = None, throttle: Callable[[int], None] | None = None,
+               chunk_size: int = UPLOAD_CHUNK_SIZE):
+    self.fn = fn
+    self.url = url
+    self.headers = headers
+    self.compress = compress
+    self.timeout = timeout
+    self.callback = callback
+    self.throttle = throttle
+    self.chunk_size = chunk_size
+    self.bytes_sent = 0
+
+    st = os.stat(fn)
+    self.size = st.st_size
+    # progress is only valid for the same file, destination and block layout
+    self.state = {
+      "blob": url.split("?", 1)[0],
+      "size": st.st_size,
+      "mtime": st.st_mtime_ns,
+      "compress": compress,
+      "chunk_size": chunk_size,
+      # resuming compresses the file again, which has to give the same blocks
+      "zstd": ".".join(map(str, zstd.ZSTD_VERSION)) if compress else None,
+    }
+
+  def load_progress(self) -> int:
+    try:
+      progress = json.loads(getxattr(self.fn, UPLOAD_PROGRESS_ATTR_NAME) or b"{}")
+    except (OSError, ValueError):
+      return 0
+    return progress.get("blocks", 0) if progress.get("state") == self.state else 0
+
+  def save_progress(self, blocks: int) -> None:
+    value = json.dumps({"state": self.state, "blocks": blocks}).encode() if blocks > 0 else b""
+    try:
+      setxattr(self.fn, UPLOAD_PROGRESS_ATTR_NAME, value)
+    except OSError:
+      pass
+
+  def _put_block(self, idx: int, raw_len: int, data: bytes) -> requests.Response:
+    stream: io.BufferedIOBase = io.BytesIO(data)
+    if self.callback is not None:
+      # report progress in uncompressed bytes, the compressed size of the whole file isn't known upfront
+      offset = idx * self.chunk_size
+      stream = CallbackReader(stream, lambda cur: self.callback(self.size, offset + cur * raw_len // max(len(data), 1)))
+    if self.throttle is not None:
+      stream = ThrottledReader(stream, self.throttle)
+
+    headers = {k: v for k, v in self.headers.items() if k.lower() != 'x-ms-blob-type'}
+    return requests.put(_with_query(self.url, comp="block", blockid=block_id(idx)), data=stream,
+                        headers={**headers, 'Content-Length': str(len(data))}, timeout=self.timeout)
+
+  def upload(self) -> requests.Response:
+    start = self.load_progress()
+    num_blocks = start
+    for idx, (raw_len, data) in enumerate(iter_upload_chunks(self.fn, self.compress, start, self.chunk_size), start):
+      response = self._put_block(idx, raw_len, data)
+      if response.status_code not in (200, 201):
+        return response
+      self.bytes_sent += len(data)
+      num_blocks = idx + 1
+      self.save_progress(num_blocks)
+
+    block_list = "".join(f"<Latest>{block_id(i)}</Latest>" for i in range(num_blocks))
+    body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'.encode()
+    response = requests.put(_with_query(self.url, comp="blocklist"), data=body,
+                            headers={**self.headers, 'Content-Length': str(len(body))}, timeout=self.timeout)
+
+    # once committed the staged blocks are gone. a rejected block list means they expired, so start over
+    if response.status_code in (200, 201, 400):
+      self.save_progress(0)
+    return response
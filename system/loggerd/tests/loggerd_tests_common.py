@@ -70,6 +70,8 @@ class UploaderTestCase:
     uploader.fake_upload = True
     uploader.force_wifi = True
     uploader.allow_sleep = False
+    # upload one file at a time, so the upload order is deterministic
+    uploader.UPLOAD_WORKERS = {False: 1, True: 1}
     self.seg_num = random.randint(1, 300)
     self.seg_format = "00000004--0ac3964c96--{}"
     self.seg_format2 = "00000005--4c4e99b08b--{}"
@@ -1,3 +1,5 @@
+import errno
+import os
 import time
 import threading
 from collections import namedtuple
@@ -6,6 +8,7 @@ from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.system.hardware.hw import Paths
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
@@ -115,3 +118,62 @@ class TestDeleter(UploaderTestCase):
     self.join_thread()
 
     assert f_path.exists(), "File deleted when locked"
+
+  def test_bytes_to_free(self):
+    gb = 1024 ** 3
+    assert deleter.bytes_to_free(10 * gb, 50, 0) == 0
+    assert deleter.bytes_to_free(deleter.MIN_BYTES - gb, 50, 0) == gb
+    # the percent threshold applies as well
+    assert deleter.bytes_to_free(10 * gb, 5, 0) == 10 * gb
+    # start deleting before the threshold is crossed when writing fast enough to get there by the next check
+    rate = 2 * gb / deleter.PREDICT_HORIZON_S
+    assert deleter.bytes_to_free(deleter.MIN_BYTES + gb, 50, rate) == gb
+
+  def test_write_rate(self, mocker):
+    t = mocker.patch.object(deleter.time, "monotonic", return_value=0.)
+    est = deleter.WriteRateEstimator()
+    est.update(100_000)
+    for i in range(1, 20):
+      t.return_value = float(i)
+      rate = est.update(100_000 - 1000 * i)
+    assert abs(rate - 1000) < 10
+
+    # space freed by the deleter isn't mistaken for a slower write rate
+    t.return_value = 20.
+    assert abs(est.update(100_000 - 1000 * 20 + 5000, freed=5000) - 1000) < 10
+
+  def test_catalogue_without_watches(self, mocker):
+    for i in range(5):
+      self.make_file_with_data(self.seg_format.format(i), self.f_type)
+    catalogue = deleter.LogCatalogue(Paths.log_root())
+    assert catalogue.inotify is not None
+    mocker.patch.object(catalogue.inotify, "add_watch", side_effect=OSError(errno.ENOSPC, "No space left on device"))
+    mocker.patch.object(deleter, "RESCAN_INTERVAL_S", 0)
+
+    catalogue.refresh()
+    assert catalogue.deletion_order() == [self.seg_format.format(i) for i in range(5)]
+
+    # a new directory that can't be watched is scanned periodically
+    new_dir = Path(Paths.log_root()) / self.seg_format.format(5)
+    new_dir.mkdir()
+    catalogue.refresh()
+    assert catalogue.dirs[new_dir.name].size == 0
+    assert new_dir.name in catalogue.unwatched
+
+    self.make_file_with_data(new_dir.name, self.f_type)
+    catalogue.refresh()
+    assert catalogue.dirs[new_dir.name].size > 0
+
+  def test_catalogue_unwatch_finished(self):
+    self.make_file_with_data(self.seg_format.format(0), self.f_type)
+    self.make_file_with_data(self.seg_format.format(1), self.f_type, lock=True)
+    self.make_file_with_data("boot", "0")
+    catalogue = deleter.LogCatalogue(Paths.log_root())
+    catalogue.refresh()
+    assert set(catalogue.watches.values()) == {self.seg_format.format(1), "boot"}
+
+    # unlocked and finished
+    os.unlink(Path(Paths.log_root()) / self.seg_format.format(1) / f"{self.f_type}.lock")
+    catalogue.refresh()
+    assert set(catalogue.watches.values()) == {"boot"}
+    assert len(catalogue.dirs) == 3
@@ -0,0 +1,84 @@
+import base64
+import os
+
+import pytest
+import zstandard as zstd
+
+from openpilot.common.file_helpers import get_upload_stream
+from openpilot.system.loggerd.resumable_upload import ResumableUpload, block_id, supports_resumable_upload
+
+URL = "https://account.blob.core.windows.net/container/route/rlog.zst?sig=abc"
+
+
+class FakeBlobServer:
+  def __init__(self, fail_at_block=None):
+    self.blocks: dict[str, bytes] = {}
+    self.blob = None
+    self.fail_at_block = fail_at_block
+
+  def put(self, url, data, headers, timeout):
+    query = dict(p.split("=", 1) for p in url.split("?", 1)[1].split("&"))
+    assert query["sig"] == "abc"
+    status_code = 201
+    if query["comp"] == "block":
+      block = base64.b64decode(query["blockid"].replace("%3D", "="))
+      if self.fail_at_block is not None and int(block) == self.fail_at_block:
+        self.fail_at_block = None
+        status_code = 500
+      else:
+        body = data.read()
+        assert len(body) == int(headers['Content-Length'])
+        self.blocks[query["blockid"].replace("%3D", "=")] = body
+    else:
+      ids = [b.split("</Latest>")[0] for b in data.decode().split("<Latest>")[1:]]
+      self.blob = b"".join(self.blocks[i] for i in ids)
+
+    return type("Response", (), {"status_code": status_code})()
+
+
+class TestResumableUpload:
+  def test_supported_urls(self):
+    assert supports_resumable_upload(URL)
+    assert not supports_resumable_upload("http://localhost:1234/qlog.zst")
+
+  @pytest.mark.parametrize("compress", [True, False])
+  def test_resume(self, mocker, tmp_path, compress):
+    fn = str(tmp_path / "rlog")
+    data = os.urandom(1024 * 64) + bytes(1024 * 64)
+    with open(fn, "wb") as f:
+      f.write(data)
+
+    server = FakeBlobServer(fail_at_block=3)
+    put = mocker.patch("requests.put", side_effect=server.put)
+
+    upload = ResumableUpload(fn, URL, {"x-ms-blob-type": "BlockBlob"}, compress, timeout=10, chunk_size=10 * 1024)
+    assert upload.upload().status_code == 500
+    assert upload.load_progress() == 3
+
+    # only the missing blocks are sent again
+    put.reset_mock()
+    upload = ResumableUpload(fn, URL, {}, compress, timeout=10, chunk_size=10 * 1024)
+    assert upload.upload().status_code == 201
+    num_blocks = len(server.blocks)
+    assert num_blocks == (7 if compress else 13)
+    assert put.call_count == num_blocks - 3 + 1
+    assert upload.load_progress() == 0
+
+    assert set(server.blocks) == {block_id(i) for i in range(num_blocks)}
+    if compress:
+      # a single frame, the same as a whole file upload
+      assert server.blob == get_upload_stream(fn, True)[0].read()
+      assert zstd.ZstdDecompressor().stream_reader(server.blob).read() == data
+    else:
+      assert server.blob == data
+
+  def test_progress_invalidated(self, mocker, tmp_path):
+    fn = str(tmp_path / "rlog")
+    with open(fn, "wb") as f:
+      f.write(os.urandom(50 * 1024))
+
+    mocker.patch("requests.put", side_effect=FakeBlobServer(fail_at_block=2).put)
+    ResumableUpload(fn, URL, {}, True, timeout=10, chunk_size=10 * 1024).upload()
+    assert ResumableUpload(fn, URL, {}, True, timeout=10, chunk_size=10 * 1024).load_progress() == 2
+    assert ResumableUpload(fn, URL.replace("rlog", "qlog"), {}, True, timeout=10, chunk_size=10 * 1024).load_progress() == 0
+    assert ResumableUpload(fn, URL, {}, False, timeout=10, chunk_size=10 * 1024).load_progress() == 0
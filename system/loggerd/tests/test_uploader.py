@@ -7,7 +7,9 @@ from pathlib import Path
 from openpilot.system.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
+import openpilot.system.loggerd.uploader as uploader
 from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.xattr_cache import setxattr
 
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
@@ -104,6 +106,43 @@ class TestUploader(UploaderTestCase):
 
     assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
 
+  def test_upload_concurrent(self):
+    uploader.UPLOAD_WORKERS = {False: 3, True: 1}
+    for i in range(10):
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files(boot=False)
+
+    self.start_thread()
+    # allow enough time that files could upload twice if there is a bug in the logic
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order(list(range(10)), [], boot=False)
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Files not uploaded exactly once"
+
+  def test_upload_new_segments(self):
+    self.start_thread()
+    time.sleep(0.25)
+
+    # segments created after the initial scan are picked up
+    self.gen_files(boot=False)
+    time.sleep(1)
+    self.join_thread()
+
+    assert log_handler.upload_order == self.gen_order([self.seg_num], [], boot=False)
+
+  def test_token_bucket(self):
+    bucket = uploader.TokenBucket(rate=1e6)
+    start = time.monotonic()
+    for _ in range(15):
+      bucket.consume(100_000)
+    assert 1.4 < time.monotonic() - start < 2.0
+
+    bucket.set_rate(None)
+    start = time.monotonic()
+    bucket.consume(10_000_000)
+    assert time.monotonic() - start < 0.1
+
   def test_upload_ignored(self):
     self.set_ignore()
     self.gen_files(lock=False)
@@ -182,3 +221,56 @@ class TestUploader(UploaderTestCase):
     for f_path in f_paths:
       lock_path = f_path.with_suffix(f_path.suffix + ".lock")
       assert not lock_path.is_file(), "File lock not cleared on startup"
+
+  def _index(self) -> uploader.UploadIndex:
+    up = uploader.Uploader("0000000000000000", Paths.log_root())
+    return up.index
+
+  def test_index_without_watches(self, mocker):
+    f_path = self.make_file_with_data(self.seg_dir, "qlog", lock=True)
+    index = self._index()
+    assert index.inotify is not None
+    mocker.patch.object(index.inotify, "add_watch", side_effect=OSError(28, "No space left on device"))
+    mocker.patch.object(uploader, "INDEX_RESCAN_S", 0.)
+
+    index.update()
+    assert self.seg_dir in index.unwatched
+    assert index.pending[self.seg_dir] == {}
+
+    # the logdir is rescanned without inotify telling us it changed
+    os.unlink(f"{f_path}.lock")
+    index.update()
+    assert list(index.pending[self.seg_dir]) == ["qlog"]
+
+  def test_index_unwatch_uploaded(self):
+    self.gen_files(boot=False)
+    self.make_file_with_data("boot", "0", 1)
+    index = self._index()
+    index.update()
+    assert set(index.watches.values()) == {self.seg_dir, "boot"}
+
+    for logdir, name in [(self.seg_dir, "qlog"), ("boot", "0")]:
+      fn = os.path.join(Paths.log_root(), logdir, name)
+      setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+      index.finish(fn, True)
+    assert set(index.watches.values()) == {"boot"}
+
+    # new boot logs are still picked up
+    self.make_file_with_data("boot", "1", 1)
+    time.sleep(0.1)
+    index.update()
+    assert list(index.pending["boot"]) == ["1"]
+
+  def test_worker_step_exception(self, mocker):
+    up = uploader.Uploader("0000000000000000", Paths.log_root())
+    up.update_network(uploader.NetworkType.wifi, uploader.NetworkType.wifi, False, True)
+    step = mocker.patch.object(up, "step", side_effect=Exception("step failed"))
+
+    exit_event = threading.Event()
+    t = threading.Thread(target=up.worker, args=(0, exit_event), daemon=True)
+    t.start()
+    time.sleep(0.2)
+    assert t.is_alive()
+    exit_event.set()
+    t.join()
+    assert step.call_count > 1
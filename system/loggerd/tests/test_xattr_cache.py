@@ -0,0 +1,81 @@
+import os
+
+import pytest
+import xattr
+
+import openpilot.system.loggerd.xattr_cache as xattr_cache
+
+ATTR = 'user.test'
+
+
+class TestXattrCache:
+  def _make_dir(self, path, n):
+    os.makedirs(path)
+    for i in range(n):
+      fn = os.path.join(path, f"f{i}")
+      open(fn, "wb").close()
+      if i % 2 == 0:
+        xattr_cache.setxattr(fn, ATTR, b'1')
+
+  def test_prefetch_dir(self, tmp_path, mocker):
+    path = str(tmp_path / "seg")
+    self._make_dir(path, 10)
+
+    attrs = xattr_cache.prefetch_dir(path, ATTR)
+    assert attrs == {f"f{i}": b'1' if i % 2 == 0 else None for i in range(10)}
+
+    # everything is served from the cache afterwards
+    read = mocker.spy(xattr_cache, "_read")
+    assert xattr_cache.prefetch_dir(path, ATTR) == attrs
+    assert all(xattr_cache.getxattr(os.path.join(path, name), ATTR) == value for name, value in attrs.items())
+    assert read.call_count == 0
+
+    xattr_cache.setxattr(os.path.join(path, "f1"), ATTR, b'1')
+    assert xattr_cache.getxattr(os.path.join(path, "f1"), ATTR) == b'1'
+    assert read.call_count == 1
+
+  def test_bounded(self, tmp_path, mocker):
+    mocker.patch.object(xattr_cache, "MAX_CACHED_ATTRIBUTES", 8)
+    path = str(tmp_path / "seg")
+    self._make_dir(path, 20)
+
+    xattr_cache.prefetch_dir(path, ATTR, [f"f{i}" for i in range(20)])
+    assert len(xattr_cache._cached_attributes) == 8
+    # least recently used entries are evicted first
+    assert (os.path.join(path, "f19"), ATTR) in xattr_cache._cached_attributes
+
+  def test_invalidate(self, tmp_path):
+    self._make_dir(str(tmp_path / "seg1"), 3)
+    self._make_dir(str(tmp_path / "seg10"), 3)
+    xattr_cache.prefetch_dir(str(tmp_path / "seg1"), ATTR)
+    xattr_cache.prefetch_dir(str(tmp_path / "seg10"), ATTR)
+
+    xattr_cache.invalidate(str(tmp_path / "seg1"))
+    cached = {os.path.dirname(p) for p, _ in xattr_cache._cached_attributes}
+    assert str(tmp_path / "seg1") not in cached
+    assert str(tmp_path / "seg10") in cached
+
+  @pytest.mark.parametrize("invalidate", [False, True])
+  def test_changed_during_read(self, tmp_path, mocker, invalidate):
+    path = str(tmp_path / "seg")
+    self._make_dir(path, 2)
+    fn = os.path.join(path, "f1")
+
+    read = xattr_cache._read
+    def read_then_change(p, attr_name):
+      # the attribute changes after it was read, but before the value is cached
+      value = read(p, attr_name)
+      if p == fn and invalidate:
+        xattr.setxattr(fn, ATTR, (value or b'') + b'1')
+        xattr_cache.invalidate(path)
+      elif p == fn:
+        xattr_cache.setxattr(fn, ATTR, (value or b'') + b'1')
+      return value
+    mocker.patch.object(xattr_cache, "_read", side_effect=read_then_change)
+
+    assert xattr_cache.getxattr(fn, ATTR) is None
+    assert xattr_cache.prefetch_dir(path, ATTR)["f1"] == b'1'
+    mocker.stopall()
+
+    assert xattr_cache.getxattr(fn, ATTR) == b'11'
+    assert xattr_cache.getxattr(os.path.join(path, "f0"), ATTR) == b'1'
@@ -7,16 +7,19 @@ import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+from collections.abc import Callable, Collection, Iterator
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import get_upload_stream
+from openpilot.common.file_helpers import ThrottledReader, get_upload_stream
+from openpilot.common.inotify import (IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO,
+                                      IN_ONLYDIR, IN_Q_OVERFLOW, Inotify)
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
-from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
+from openpilot.system.loggerd.resumable_upload import ResumableUpload, supports_resumable_upload
+from openpilot.system.loggerd.xattr_cache import invalidate, prefetch_dir, setxattr
 from openpilot.common.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
@@ -29,6 +32,14 @@ MAX_UPLOAD_SIZES = {
   "qcam": 5*1e6,
 }
 
+# concurrent uploads and bandwidth budget in bytes/s (None is unlimited), by whether the network is metered
+UPLOAD_WORKERS = {False: 3, True: 1}
+UPLOAD_BANDWIDTH = {False: None, True: 250e3}
+
+# without inotify, the upload index rescans the log root this often
+INDEX_RESCAN_S = 10.
+LOGDIR_EVENTS = IN_CREATE | IN_DELETE | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
@@ -73,6 +84,179 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class TokenBucket:
+  """Bandwidth budget shared by all upload workers. Tokens are bytes, refilled at rate bytes/s up to one second worth."""
+  def __init__(self, rate: float | None = None):
+    self.rate = rate
+    self.tokens = 0.
+    self.last_refill = time.monotonic()
+    self.lock = threading.Lock()
+
+  def set_rate(self, rate: float | None) -> None:
+    with self.lock:
+      self.rate = rate
+      self.tokens = 0.
+
+  def consume(self, n: int) -> None:
+    with self.lock:
+      if self.rate is None:
+        return
+      now = time.monotonic()
+      self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, self.rate)
+      self.last_refill = now
+      # go into debt and wait until it's paid off, so waiting workers are served in order
+      self.tokens -= n
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+
+class UploadIndex:
+  """
+    Files waiting for upload, by log directory. The log root is scanned once, after that only the directories
+    inotify reports as changed are scanned again (or all of them every INDEX_RESCAN_S where inotify isn't available).
+    Logdirs that couldn't be watched are rescanned every INDEX_RESCAN_S, and finished logdirs with everything
+    uploaded aren't watched anymore, except for the always_watch ones new files keep being added to.
+    Only files accepted by should_track are looked at.
+  """
+  def __init__(self, root: str, should_track: Callable[[str, str], bool], always_watch: Collection[str] = ()):
+    self.root = root
+    self.should_track = should_track
+    self.always_watch = always_watch
+    self.lock = threading.RLock()
+
+    self.pending: dict[str, dict[str, float]] = {}  # logdir -> {name: ctime}, empty while the logdir is locked
+    self.uploading: set[str] = set()
+    self.dirty: set[str] = set()
+    self.last_rescan: float | None = None
+
+    self.watches: dict[int, str] = {}
+    self.unwatched: set[str] = set()
+    self.inotify: Inotify | None = None
+    try:
+      self.inotify = Inotify()
+      self.root_wd = self.inotify.add_watch(root, LOGDIR_EVENTS | IN_ONLYDIR)
+    except OSError:
+      cloudlog.exception("uploader: inotify not available, falling back to rescanning")
+      self.inotify = None
+
+  def _drop(self, logdir: str) -> None:
+    self.pending.pop(logdir, None)
+    self.unwatched.discard(logdir)
+    invalidate(os.path.join(self.root, logdir))
+    for wd in [wd for wd, d in self.watches.items() if d == logdir]:
+      del self.watches[wd]
+
+  def _watch(self, logdir: str) -> None:
+    if self.inotify is None or logdir in self.watches.values():
+      return
+
+    try:
+      self.watches[self.inotify.add_watch(os.path.join(self.root, logdir), LOGDIR_EVENTS)] = logdir
+      self.unwatched.discard(logdir)
+    except OSError:
+      # e.g. out of watches (ENOSPC), rescan it every INDEX_RESCAN_S instead
+      if logdir not in self.unwatched:
+        cloudlog.exception(f"uploader: failed to watch {logdir}")
+      self.unwatched.add(logdir)
+
+  def _unwatch(self, logdir: str) -> None:
+    if self.inotify is None or logdir in self.always_watch:
+      return
+
+    self.unwatched.discard(logdir)
+    for wd in [wd for wd, d in self.watches.items() if d == logdir]:
+      del self.watches[wd]
+      self.inotify.rm_watch(wd)
+
+  def _rescan(self) -> None:
+    logdirs = listdir_by_creation(self.root)
+    for logdir in set(self.pending) - set(logdirs):
+      self._drop(logdir)
+    self.dirty.update(logdirs)
+    self.last_rescan = time.monotonic()
+
+  def _scan(self, logdir: str) -> None:
+    path = os.path.join(self.root, logdir)
+    self._watch(logdir)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      self._drop(logdir)
+      return
+
+    files: dict[str, float] = {}
+    locked = any(name.endswith(".lock") for name in names)
+    names = [name for name in names if self.should_track(logdir, name)]
+    if not locked:
+      try:
+        attrs = prefetch_dir(path, UPLOAD_ATTR_NAME, names)
+      except OSError:
+        attrs = {}
+      for name in names:
+        fn = os.path.join(path, name)
+        # skip files already uploaded
+        try:
+          ctime = os.path.getctime(fn)
+          is_uploaded = attrs[name] == UPLOAD_ATTR_VALUE
+        except (OSError, KeyError):
+          cloudlog.event("uploader_getxattr_failed", key=os.path.join(logdir, name), fn=fn)
+          # deleter could have deleted, so skip
+          continue
+        if not is_uploaded:
+          files[name] = ctime
+    self.pending[logdir] = files
+
+    # a finished logdir that's all uploaded won't change anymore. one without tracked files
+    # could still be getting set up, a logdir is created before its lock file
+    if not locked and names and not files:
+      self._unwatch(logdir)
+
+  def update(self) -> None:
+    with self.lock:
+      if self.last_rescan is None or (self.inotify is None and time.monotonic() - self.last_rescan > INDEX_RESCAN_S):
+        self._rescan()
+      elif self.unwatched and time.monotonic() - self.last_rescan > INDEX_RESCAN_S:
+        self.dirty.update(self.unwatched)
+        self.last_rescan = time.monotonic()
+
+      if self.inotify is not None:
+        for event in self.inotify.read():
+          if event.mask & IN_Q_OVERFLOW:
+            self._rescan()
+          elif event.wd == self.root_wd:
+            if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+              self.dirty.add(event.name)
+            elif event.mask & IN_ISDIR and event.mask & (IN_DELETE | IN_MOVED_FROM):
+              self._drop(event.name)
+          elif event.mask & IN_IGNORED:
+            self.watches.pop(event.wd, None)
+          elif event.wd in self.watches:
+            self.dirty.add(self.watches[event.wd])
+
+      for logdir in self.dirty:
+        self._scan(logdir)
+      self.dirty.clear()
+
+  def files(self) -> Iterator[tuple[str, str, float]]:
+    """Pending (logdir, name, ctime) that aren't being uploaded, logdirs in creation order. Call with lock held."""
+    for logdir in sorted((d for d, files in self.pending.items() if files), key=get_directory_sort):
+      for name, ctime in self.pending[logdir].items():
+        if os.path.join(self.root, logdir, name) not in self.uploading:
+          yield logdir, name, ctime
+
+  def finish(self, fn: str, uploaded: bool) -> None:
+    with self.lock:
+      self.uploading.discard(fn)
+      if uploaded:
+        logdir, name = os.path.split(os.path.relpath(fn, self.root))
+        files = self.pending.get(logdir)
+        if files is not None:
+          files.pop(name, None)
+          if not files:
+            self._unwatch(logdir)
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -87,44 +271,36 @@ class Uploader:
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
 
+    self.index = UploadIndex(root, self.should_upload, [f.rstrip("/") for f in self.immediate_folders])
+    self.bucket = TokenBucket()
+    self.network: tuple | None = None  # (network type, raw network type, metered, offroad)
+
+  def should_upload(self, logdir: str, name: str) -> bool:
+    # only files from the immediate folders or with an immediate priority are ever picked
+    return name in self.immediate_priority or any(f in os.path.join(self.root, logdir, name) for f in self.immediate_folders)
+
   def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
     r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
     requested_routes = [] if r is None else r.split(",")
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
+    self.index.update()
+    with self.index.lock:
+      files = sorted(self.index.files(), key=lambda f: (get_directory_sort(f[0]), self.immediate_priority.get(f[1], 1000)))
 
-      if any(name.endswith(".lock") for name in names):
-        continue
+    for logdir, name, ctime in files:
+      key = os.path.join(logdir, name)
+      fn = os.path.join(self.root, logdir, name)
 
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
+      # limit uploading on metered connections
+      if metered:
+        dt = datetime.timedelta(hours=12)
+        if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
           continue
 
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
+        if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          continue
 
-        yield name, key, fn
+      yield name, key, fn
 
   def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
     upload_files = list(self.list_upload_files(metered))
@@ -139,10 +315,18 @@ class Uploader:
 
     return None
 
-  def do_upload(self, key: str, fn: str):
+  def claim_next_file(self, metered: bool) -> tuple[str, str, str] | None:
+    # pick the next file and mark it as being uploaded, so other workers skip it
+    with self.index.lock:
+      d = self.next_file_to_upload(metered)
+      if d is not None:
+        self.index.uploading.add(d[2])
+    return d
+
+  def do_upload(self, key: str, fn: str) -> tuple[requests.Response | FakeResponse, int]:
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
     if url_resp.status_code == 412:
-      return url_resp
+      return url_resp, 0
 
     url_resp_json = json.loads(url_resp.text)
     url = url_resp_json['url']
@@ -150,14 +334,18 @@ class Uploader:
     cloudlog.debug("upload_url v1.4 %s %s", url, str(headers))
 
     if fake_upload:
-      return FakeResponse()
+      return FakeResponse(), 0
+
+    compress = key.endswith('.zst') and not fn.endswith('.zst')
+    if supports_resumable_upload(url):
+      upload = ResumableUpload(fn, url, headers, compress, timeout=10, throttle=self.bucket.consume)
+      return upload.upload(), upload.bytes_sent
 
     stream = None
     try:
-      compress = key.endswith('.zst') and not fn.endswith('.zst')
-      stream, _ = get_upload_stream(fn, compress)
-      response = requests.put(url, data=stream, headers=headers, timeout=10)
-      return response
+      stream, content_length = get_upload_stream(fn, compress)
+      response = requests.put(url, data=ThrottledReader(stream, self.bucket.consume), headers=headers, timeout=10)
+      return response, content_length
     finally:
       if stream:
         stream.close()
@@ -181,9 +369,10 @@ class Uploader:
       start_time = time.monotonic()
 
       stat = None
+      content_length = 0
       last_exc = None
       try:
-        stat = self.do_upload(key, fn)
+        stat, content_length = self.do_upload(key, fn)
       except Exception as e:
         last_exc = (e, traceback.format_exc())
 
@@ -193,7 +382,6 @@ class Uploader:
         if stat.status_code == 412:
           cloudlog.event("upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
         else:
-          content_length = int(stat.request.headers.get("Content-Length", 0))
           speed = (content_length / 1e6) / dt
           cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
                          network_type=network_type, metered=metered, speed=speed)
@@ -213,7 +401,7 @@ class Uploader:
 
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
+    d = self.claim_next_file(metered)
     if d is None:
       return None
 
@@ -223,7 +411,46 @@ class Uploader:
     if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
       key += ".zst"
 
-    return self.upload(name, key, fn, network_type, metered)
+    success = False
+    try:
+      success = self.upload(name, key, fn, network_type, metered)
+    finally:
+      self.index.finish(fn, success)
+    return success
+
+  def worker(self, idx: int, exit_event: threading.Event) -> None:
+    backoff = 0.1
+    while not exit_event.is_set():
+      network_type, network_type_raw, metered, offroad = self.network
+      if idx >= UPLOAD_WORKERS[metered]:
+        exit_event.wait(1)
+        continue
+
+      if network_type == NetworkType.none:
+        if allow_sleep:
+          exit_event.wait(60 if offroad else 5)
+        continue
+
+      try:
+        success = self.step(network_type_raw, metered)
+      except Exception:
+        cloudlog.exception("uploader worker step failed")
+        success = False
+
+      if success is None:
+        backoff = 60 if offroad else 5
+      elif success:
+        backoff = 0.1
+      else:
+        cloudlog.info("upload backoff %r", backoff)
+        backoff = min(backoff*2, 120)
+      if allow_sleep:
+        exit_event.wait(backoff + random.uniform(0, backoff))
+
+  def update_network(self, network_type, network_type_raw: int, metered: bool, offroad: bool) -> None:
+    if self.network is None or self.network[2] != metered:
+      self.bucket.set_rate(UPLOAD_BANDWIDTH[metered])
+    self.network = (network_type, network_type_raw, metered, offroad)
 
 
 def main(exit_event: threading.Event = None) -> None:
@@ -247,26 +474,22 @@ def main(exit_event: threading.Event = None) -> None:
   sm = messaging.SubMaster(['deviceState'])
   uploader = Uploader(dongle_id, Paths.log_root())
 
-  backoff = 0.1
-  while not exit_event.is_set():
+  # workers upload concurrently, this thread keeps them up to date on the network state
+  workers: list[threading.Thread] = []
+  while True:
     sm.update(0)
-    offroad = params.get_bool("IsOffroad")
     network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
-    if network_type == NetworkType.none:
-      if allow_sleep:
-        time.sleep(60 if offroad else 5)
-      continue
-
-    success = uploader.step(sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered)
-    if success is None:
-      backoff = 60 if offroad else 5
-    elif success:
-      backoff = 0.1
-    else:
-      cloudlog.info("upload backoff %r", backoff)
-      backoff = min(backoff*2, 120)
-    if allow_sleep:
-      time.sleep(backoff + random.uniform(0, backoff))
+    uploader.update_network(network_type, sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered, params.get_bool("IsOffroad"))
+
+    if not workers:
+      workers = [threading.Thread(target=uploader.worker, args=(i, exit_event), daemon=True) for i in range(max(UPLOAD_WORKERS.values()))]
+      for w in workers:
+        w.start()
+    if exit_event.wait(1):
+      break
+
+  for w in workers:
+    w.join()
 
 
 if __name__ == "__main__":
@@ -1,23 +1,107 @@
 import errno
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
 
 import xattr
 
-_cached_attributes: dict[tuple, bytes | None] = {}
+MAX_CACHED_ATTRIBUTES = 16384
+
+# LRU of (path, attr_name) -> value, None if the attribute isn't set
+_cached_attributes: OrderedDict[tuple[str, str], bytes | None] = OrderedDict()
+_lock = threading.Lock()
+
+# values are read outside the lock, so a read is only cached if no setxattr or invalidate could have changed
+# the attribute since it started. _bumped has the generation of the last setxattr per key, _invalidated the
+# one of the last invalidate, or of the newest key dropped from _bumped
+_generation = 0
+_bumped: OrderedDict[tuple[str, str], int] = OrderedDict()
+_invalidated = 0
+
+def _read(path: str, attr_name: str) -> bytes | None:
+  try:
+    return xattr.getxattr(path, attr_name)
+  except OSError as e:
+    # ENODATA (Linux) or ENOATTR (macOS) means attribute hasn't been set
+    if e.errno == errno.ENODATA or (hasattr(errno, 'ENOATTR') and e.errno == errno.ENOATTR):
+      return None
+    raise
+
+def _bump(key: tuple[str, str]) -> None:
+  global _generation, _invalidated
+  _generation += 1
+  _bumped[key] = _generation
+  _bumped.move_to_end(key)
+  while len(_bumped) > MAX_CACHED_ATTRIBUTES:
+    _invalidated = _bumped.popitem(last=False)[1]
+
+def _store(key: tuple[str, str], value: bytes | None, generation: int) -> None:
+  if max(_bumped.get(key, 0), _invalidated) > generation:
+    # changed since it was read, the value may be stale
+    return
+  _cached_attributes[key] = value
+  _cached_attributes.move_to_end(key)
+  while len(_cached_attributes) > MAX_CACHED_ATTRIBUTES:
+    _cached_attributes.popitem(last=False)
 
 def getxattr(path: str, attr_name: str) -> bytes | None:
   key = (path, attr_name)
-  if key not in _cached_attributes:
-    try:
-      response = xattr.getxattr(path, attr_name)
-    except OSError as e:
-      # ENODATA (Linux) or ENOATTR (macOS) means attribute hasn't been set
-      if e.errno == errno.ENODATA or (hasattr(errno, 'ENOATTR') and e.errno == errno.ENOATTR):
-        response = None
-      else:
-        raise
-    _cached_attributes[key] = response
-  return _cached_attributes[key]
+  with _lock:
+    if key in _cached_attributes:
+      _cached_attributes.move_to_end(key)
+      return _cached_attributes[key]
+    generation = _generation
+
+  response = _read(path, attr_name)
+  with _lock:
+    _store(key, response, generation)
+  return response
 
 def setxattr(path: str, attr_name: str, attr_value: bytes) -> None:
-  _cached_attributes.pop((path, attr_name), None)
   xattr.setxattr(path, attr_name, attr_value)
+  with _lock:
+    _bump((path, attr_name))
+    _cached_attributes.pop((path, attr_name), None)
+
+def prefetch_dir(path: str, attr_name: str, names: Iterable[str] | None = None) -> dict[str, bytes | None]:
+  """Load the attribute of every entry in a directory (or just the given names) into the cache in one pass,
+  and return it by name. Only entries that aren't cached yet are read, and entries that disappeared are left out."""
+  if names is None:
+    names = os.listdir(path)
+
+  attrs: dict[str, bytes | None] = {}
+  missing = []
+  with _lock:
+    for name in names:
+      key = (os.path.join(path, name), attr_name)
+      if key in _cached_attributes:
+        _cached_attributes.move_to_end(key)
+        attrs[name] = _cached_attributes[key]
+      else:
+        missing.append(name)
+    generation = _generation
+
+  read: dict[str, bytes | None] = {}
+  for name in missing:
+    try:
+      read[name] = _read(os.path.join(path, name), attr_name)
+    except FileNotFoundError:
+      continue
+
+  with _lock:
+    for name, value in read.items():
+      _store((os.path.join(path, name), attr_name), value, generation)
+  attrs.update(read)
+  return attrs
+
+def invalidate(path: str) -> None:
+  """Drop the cached attributes of path and everything below it, e.g. after it was deleted."""
+  global _generation, _invalidated
+  prefix = path.rstrip("/") + "/"
+  with _lock:
+    # reads of the entries below path in progress aren't cached either
+    _generation += 1
+    _invalidated = _generation
+    for key in [k for k in _cached_attributes if k[0] == path or k[0].startswith(prefix)]:
+      del _cached_attributes[key]
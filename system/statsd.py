@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 import os
 import zmq
+import math
 import time
 import uuid
+import atexit
+import struct
+import threading
+from bisect import bisect_left
 from pathlib import Path
 from collections import defaultdict
+from collections.abc import Iterator
 from datetime import datetime, UTC
 from typing import NoReturn
 
@@ -21,12 +27,65 @@ from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET,
 class METRIC_TYPE:
   GAUGE = 'g'
   SAMPLE = 'sa'
+  COUNTER = 'c'
+  HISTOGRAM = 'h'
+
+# binary batch: magic, then per metric a (type, name length) header, the name and the value
+BATCH_MAGIC = b"SB1"
+METRIC_HEADER = struct.Struct("<BB")
+METRIC_VALUE = struct.Struct("<d")
+METRIC_TYPE_CODES = {METRIC_TYPE.GAUGE: 0, METRIC_TYPE.SAMPLE: 1, METRIC_TYPE.COUNTER: 2, METRIC_TYPE.HISTOGRAM: 3}
+METRIC_TYPES_BY_CODE = {v: k for k, v in METRIC_TYPE_CODES.items()}
+
+BATCH_MAX_BYTES = 4096
+BATCH_MAX_AGE_S = 1.0
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 1024
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 50., 100., 500., 1000., 5000.)
+
+
+def encode_metric(metric_type: str, name: str, value: float) -> bytes:
+  # truncated on a character boundary, so the name still decodes
+  name_bytes = name.encode()[:255].decode(errors="ignore").encode()
+  return METRIC_HEADER.pack(METRIC_TYPE_CODES[metric_type], len(name_bytes)) + name_bytes + METRIC_VALUE.pack(value)
+
+
+def decode_metrics(data: bytes) -> Iterator[tuple[str, str, float]]:
+  """
+    Decode a datagram into (metric type, name, value) tuples. Accepts both binary
+    batches and the single "name:value|type" strings sent by older clients.
+  """
+  if not data.startswith(BATCH_MAGIC):
+    metric = data.decode()
+    yield metric.split('|')[1], metric.split(':')[0], float(metric.split('|')[0].split(':')[1])
+    return
+
+  pos = len(BATCH_MAGIC)
+  while pos < len(data):
+    type_code, name_len = METRIC_HEADER.unpack_from(data, pos)
+    pos += METRIC_HEADER.size
+    name = data[pos:pos + name_len].decode()
+    pos += name_len
+    value, = METRIC_VALUE.unpack_from(data, pos)
+    pos += METRIC_VALUE.size
+    yield METRIC_TYPES_BY_CODE.get(type_code, str(type_code)), name, value
+
 
 class StatLog:
+  """
+    Metrics are buffered per process and pushed to statsd as binary batches, once the batch
+    is BATCH_MAX_BYTES large or its oldest metric is BATCH_MAX_AGE_S old. A flusher thread sends
+    the batch when it's due, so rarely logged metrics aren't held back until the next one is logged.
+  """
   def __init__(self):
     self.pid = None
     self.zctx = None
     self.sock = None
+    self.lock = threading.Condition()
+    self.batch = bytearray()
+    self.batch_started = 0.
+    atexit.register(self.flush)
 
   def connect(self) -> None:
     self.zctx = zmq.Context()
@@ -34,6 +93,10 @@ class StatLog:
     self.sock.setsockopt(zmq.LINGER, 10)
     self.sock.connect(STATS_SOCKET)
     self.pid = os.getpid()
+    # the batch, lock and flusher thread of the parent process aren't ours after a fork
+    self.lock = threading.Condition()
+    self.batch = bytearray()
+    threading.Thread(target=self._flush_thread, args=(self.lock,), name='statlog_flush', daemon=True).start()
 
   def __del__(self):
     if self.sock is not None:
@@ -41,23 +104,152 @@ class StatLog:
     if self.zctx is not None:
       self.zctx.term()
 
-  def _send(self, metric: str) -> None:
+  def _send(self, metric_type: str, name: str, value: float) -> None:
     if os.getpid() != self.pid:
       self.connect()
 
+    with self.lock:
+      if not self.batch:
+        self.batch += BATCH_MAGIC
+        self.batch_started = time.monotonic()
+        self.lock.notify()
+      self.batch += encode_metric(metric_type, name, value)
+
+      if len(self.batch) >= BATCH_MAX_BYTES:
+        self._flush()
+
+  def flush(self) -> None:
+    if os.getpid() != self.pid:
+      return
+
+    with self.lock:
+      self._flush()
+
+  def _flush_thread(self, lock: threading.Condition) -> NoReturn:
+    with lock:
+      while True:
+        if not self.batch:
+          lock.wait()
+          continue
+
+        due = self.batch_started + BATCH_MAX_AGE_S - time.monotonic()
+        if due > 0:
+          lock.wait(due)
+        else:
+          self._flush()
+
+  def _flush(self) -> None:
+    if not self.batch:
+      return
+
     try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
+      self.sock.send(bytes(self.batch), zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
+    self.batch.clear()
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    self._send(METRIC_TYPE.GAUGE, name, value)
 
   # Samples will be recorded in a buffer and at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+    self._send(METRIC_TYPE.SAMPLE, name, value)
+
+  # Counters are summed up until aggregation time
+  def counter(self, name: str, value: float = 1.):
+    self._send(METRIC_TYPE.COUNTER, name, value)
+
+  # Histograms count the values falling into each of HISTOGRAM_BUCKETS
+  def histogram(self, name: str, value: float):
+    self._send(METRIC_TYPE.HISTOGRAM, name, value)
+
+
+class QuantileSketch:
+  """
+    DDSketch: values are counted in logarithmically sized bins, so quantiles are estimated within
+    relative_accuracy using constant memory. The lowest bins are collapsed when there are more than max_bins.
+  """
+  def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY, max_bins: int = SKETCH_MAX_BINS):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_bins = max_bins
+    self.positive: dict[int, int] = defaultdict(int)
+    self.negative: dict[int, int] = defaultdict(int)
+    self.zero_count = 0
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def _key(self, value: float) -> int:
+    return math.ceil(math.log(value) / self.log_gamma)
+
+  def _value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def _collapse(self, bins: dict[int, int]) -> None:
+    keys = sorted(bins)
+    collapsed = keys[:len(keys) - self.max_bins + 1]
+    for k in collapsed[:-1]:
+      bins[collapsed[-1]] += bins.pop(k)
+
+  def add(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+    if value > 1e-9:
+      bins, key = self.positive, self._key(value)
+    elif value < -1e-9:
+      bins, key = self.negative, self._key(-value)
+    else:
+      self.zero_count += 1
+      return
+
+    bins[key] += 1
+    if len(bins) > self.max_bins:
+      self._collapse(bins)
+
+  def quantile(self, q: float) -> float:
+    rank = int(round(q * (self.count - 1)))
+    seen = 0
+    for key in sorted(self.negative, reverse=True):
+      seen += self.negative[key]
+      if seen > rank:
+        return max(-self._value(key), self.min)
+    seen += self.zero_count
+    if seen > rank:
+      return 0.
+    for key in sorted(self.positive):
+      seen += self.positive[key]
+      if seen > rank:
+        return min(self._value(key), self.max)
+    return self.max
+
+
+class Histogram:
+  def __init__(self, buckets: tuple[float, ...] = HISTOGRAM_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.
+
+  def add(self, value: float) -> None:
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def stats(self) -> dict[str, float]:
+    # cumulative counts of values less than or equal to each bucket bound
+    stats: dict[str, float] = {'count': self.count, 'sum': self.sum}
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.counts, strict=False):
+      cumulative += count
+      stats[f"le_{bound:g}"] = cumulative
+    return stats
 
 
 def main() -> NoReturn:
@@ -106,7 +298,9 @@ def main() -> NoReturn:
   boot_uid = str(uuid.uuid4())[:8]
   last_flush_time = time.monotonic()
   gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  counters: dict[str, float] = defaultdict(float)
+  samples: dict[str, QuantileSketch] = defaultdict(QuantileSketch)
+  histograms: dict[str, Histogram] = defaultdict(Histogram)
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,20 +309,21 @@ def main() -> NoReturn:
       # Update metrics
       while True:
         try:
-          metric = sock.recv_string(zmq.NOBLOCK)
+          metrics = sock.recv(zmq.NOBLOCK)
           try:
-            metric_type = metric.split('|')[1]
-            metric_name = metric.split(':')[0]
-            metric_value = float(metric.split('|')[0].split(':')[1])
-
-            if metric_type == METRIC_TYPE.GAUGE:
-              gauges[metric_name] = metric_value
-            elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
-            else:
-              cloudlog.event("unknown metric type", metric_type=metric_type)
+            for metric_type, metric_name, metric_value in decode_metrics(metrics):
+              if metric_type == METRIC_TYPE.GAUGE:
+                gauges[metric_name] = metric_value
+              elif metric_type == METRIC_TYPE.SAMPLE:
+                samples[metric_name].add(metric_value)
+              elif metric_type == METRIC_TYPE.COUNTER:
+                counters[metric_name] += metric_value
+              elif metric_type == METRIC_TYPE.HISTOGRAM:
+                histograms[metric_name].add(metric_value)
+              else:
+                cloudlog.event("unknown metric type", metric_type=metric_type)
           except Exception:
-            cloudlog.event("malformed metric", metric=metric)
+            cloudlog.event("malformed metric", metric=repr(metrics))
         except zmq.error.Again:
           break
 
@@ -141,26 +336,29 @@ def main() -> NoReturn:
         for key, value in gauges.items():
           result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
 
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
+        for key, value in counters.items():
+          result += get_influxdb_line(f"counter.{key}", value, current_time, tags)
 
+        for key, sketch in samples.items():
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
           for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
-            stats[f"p{int(percentile * 100)}"] = value
+            stats[f"p{int(percentile * 100)}"] = sketch.quantile(percentile)
 
           result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
 
+        for key, histogram in histograms.items():
+          result += get_influxdb_line(f"histogram.{key}", histogram.stats(), current_time, tags)
+
         # clear intermediate data
         gauges.clear()
+        counters.clear()
         samples.clear()
+        histograms.clear()
         last_flush_time = time.monotonic()
 
         # check that we aren't filling up the drive
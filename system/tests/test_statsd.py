@@ -0,0 +1,107 @@
+import threading
+import time
+import numpy as np
+import zmq
+
+import openpilot.system.statsd as statsd
+from openpilot.system.statsd import METRIC_TYPE, BATCH_MAGIC, Histogram, QuantileSketch, StatLog, decode_metrics, encode_metric
+
+
+class TestStatsd:
+  def test_decode_batch(self):
+    metrics = [(METRIC_TYPE.GAUGE, "cpu0_temperature", 45.5), (METRIC_TYPE.SAMPLE, "power_draw", 6.25),
+               (METRIC_TYPE.COUNTER, "uploads", 1.), (METRIC_TYPE.HISTOGRAM, "upload_time", 0.3)]
+    data = BATCH_MAGIC + b"".join(encode_metric(*m) for m in metrics)
+    assert list(decode_metrics(data)) == metrics
+
+  def test_encode_long_name(self):
+    # truncated to 255 bytes without splitting a character
+    (_, name, _), = decode_metrics(BATCH_MAGIC + encode_metric(METRIC_TYPE.GAUGE, "é" * 200, 1.))
+    assert name == "é" * 127
+
+  def test_decode_string(self):
+    assert list(decode_metrics(b"free_space_percent:12.5|g")) == [(METRIC_TYPE.GAUGE, "free_space_percent", 12.5)]
+
+  def test_quantile_sketch(self):
+    values = np.random.default_rng(0).lognormal(size=10000) - 0.5
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for v in values:
+      sketch.add(v)
+
+    values.sort()
+    assert sketch.count == len(values)
+    assert sketch.min == values[0] and sketch.max == values[-1]
+    for q in (0.05, 0.5, 0.95):
+      expected = values[int(round(q * (len(values) - 1)))]
+      assert abs(sketch.quantile(q) - expected) <= 0.01 * abs(expected) + 1e-9
+
+  def test_quantile_sketch_bounded(self):
+    # only the lowest quantiles lose accuracy when bins are collapsed
+    values = np.geomspace(1e-6, 1e6, 5000)
+    sketch = QuantileSketch(max_bins=256)
+    for v in values:
+      sketch.add(v)
+    assert len(sketch.positive) <= 256
+    assert abs(sketch.quantile(0.95) / values[4749] - 1) < 0.02
+
+  def test_histogram(self):
+    hist = Histogram(buckets=(1., 10.))
+    for v in (0.5, 1., 5., 50.):
+      hist.add(v)
+    assert hist.stats() == {'count': 4, 'sum': 56.5, 'le_1': 2, 'le_10': 3}
+
+  def _recv_metrics(self, sock, timeout_ms):
+    metrics = []
+    while sock.poll(timeout_ms):
+      metrics += decode_metrics(sock.recv())
+    return metrics
+
+  def test_statlog_flushed_on_age(self, tmp_path, mocker):
+    mocker.patch.object(statsd, "STATS_SOCKET", f"ipc://{tmp_path}/stats")
+    mocker.patch.object(statsd, "BATCH_MAX_AGE_S", 0.1)
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(statsd.STATS_SOCKET)
+    def flush_threads():
+      return [t for t in threading.enumerate() if t.name == 'statlog_flush']
+    threads_before = len(flush_threads())
+    try:
+      # sent without another metric being logged after it
+      statlog = StatLog()
+      for i in range(3):
+        start = time.monotonic()
+        statlog.gauge("free_space_percent", 12.5 + i)
+        assert sock.poll(2000)
+        assert time.monotonic() - start >= 0.1
+        assert list(decode_metrics(sock.recv())) == [(METRIC_TYPE.GAUGE, "free_space_percent", 12.5 + i)]
+
+      # by the same thread for every batch
+      assert len(flush_threads()) == threads_before + 1
+    finally:
+      ctx.destroy(linger=0)
+
+  def test_statlog_threads(self, tmp_path, mocker):
+    mocker.patch.object(statsd, "STATS_SOCKET", f"ipc://{tmp_path}/stats")
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(statsd.STATS_SOCKET)
+    try:
+      statlog = StatLog()
+      def log(name):
+        for i in range(2000):
+          statlog.counter(name)
+          if i % 50 == 0:
+            statlog.flush()
+      threads = [threading.Thread(target=log, args=(f"thread{i}",)) for i in range(4)]
+      for t in threads:
+        t.start()
+      metrics = []
+      while any(t.is_alive() for t in threads):
+        metrics += self._recv_metrics(sock, 10)
+      statlog.flush()
+      metrics += self._recv_metrics(sock, 200)
+
+      assert len(metrics) == 4 * 2000
+      assert {name for _, name, _ in metrics} == {f"thread{i}" for i in range(4)}
+    finally:
+      ctx.destroy(linger=0)
@@ -0,0 +1,201 @@
+import fcntl
+import os
+import struct
+import threading
+import zlib
+from dataclasses import asdict, dataclass
+
+from openpilot.system.hardware.hw import Paths
+
+DEFAULT_MAX_CACHE_BYTES = int(os.getenv("FILEREADER_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+# check the cache size after this many bytes were written by this process
+EVICT_INTERVAL_BYTES = 64 * 1024 * 1024
+
+# <hash>.meta layout: header, then one (stored size, crc32) entry per chunk. a size of 0 marks a missing chunk
+MAGIC = b"UFC1"
+HEADER = struct.Struct("<4sQI")  # magic, file length, chunk size
+CHUNK_ENTRY = struct.Struct("<II")
+META_EXT = ".meta"
+DATA_EXT = ".data"
+EVICT_LOCK = ".evict.lock"
+
+
+@dataclass
+class CacheStats:
+  hits: int = 0
+  misses: int = 0
+  corrupted: int = 0
+  bytes_read: int = 0
+  bytes_written: int = 0
+  evicted_files: int = 0
+  evicted_bytes: int = 0
+
+
+_stats = CacheStats()
+_stats_lock = threading.Lock()
+_written_since_evict = 0
+
+
+def _count(**kwargs) -> None:
+  with _stats_lock:
+    for k, v in kwargs.items():
+      setattr(_stats, k, getattr(_stats, k) + v)
+
+
+def cache_stats() -> dict[str, int]:
+  """Hit/miss statistics of the download cache for this process."""
+  with _stats_lock:
+    return asdict(_stats)
+
+
+class CachedFile:
+  """
+    Download cache entry for a single remote file, shared between processes. The chunks are stored in one
+    sparse <hash>.data file of the full file length, next to a <hash>.meta table recording which chunks are
+    present and their checksum. Chunk data is written before its table entry, so readers never see a chunk
+    as present before its data is, and a torn or corrupted chunk fails its checksum and is downloaded again.
+  """
+  def __init__(self, key: str, chunk_size: int, cache_dir: str | None = None, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+    self.cache_dir = cache_dir if cache_dir is not None else Paths.download_cache_root()
+    self.chunk_size = chunk_size
+    self.max_bytes = max_bytes
+    self.meta_path = os.path.join(self.cache_dir, key + META_EXT)
+    self.data_path = os.path.join(self.cache_dir, key + DATA_EXT)
+    self.length: int | None = None
+    self._meta_fd: int | None = None
+    self._data_fd: int | None = None
+    self._open_lock = threading.Lock()
+
+  def __del__(self):
+    self.close()
+
+  def close(self) -> None:
+    for fd in (self._meta_fd, self._data_fd):
+      if fd is not None:
+        os.close(fd)
+    self._meta_fd = self._data_fd = None
+
+  def _open(self, length: int | None = None) -> bool:
+    if self._meta_fd is not None:
+      return True
+    with self._open_lock:
+      return self._meta_fd is not None or self._open_locked(length)
+
+  def _open_locked(self, length: int | None) -> bool:
+    flags = os.O_RDWR | (os.O_CREAT if length is not None else 0)
+    try:
+      meta_fd = os.open(self.meta_path, flags, 0o644)
+    except FileNotFoundError:
+      return False
+
+    try:
+      fcntl.flock(meta_fd, fcntl.LOCK_EX)
+      try:
+        header = os.pread(meta_fd, HEADER.size, 0)
+        if len(header) == HEADER.size and HEADER.unpack(header)[0::2] == (MAGIC, self.chunk_size) and os.path.exists(self.data_path):
+          self.length = HEADER.unpack(header)[1]
+        elif length is not None:
+          # new (or unreadable) entry, initialize it
+          num_chunks = (length + self.chunk_size - 1) // self.chunk_size
+          os.ftruncate(meta_fd, 0)
+          os.pwrite(meta_fd, HEADER.pack(MAGIC, length, self.chunk_size) + bytes(CHUNK_ENTRY.size * num_chunks), 0)
+          with open(self.data_path, "wb") as f:
+            f.truncate(length)
+          self.length = length
+      finally:
+        fcntl.flock(meta_fd, fcntl.LOCK_UN)
+
+      if self.length is None:
+        os.close(meta_fd)
+        return False
+      self._data_fd = os.open(self.data_path, os.O_RDWR)
+    except OSError:
+      # evicted by another process in the meantime
+      os.close(meta_fd)
+      self.length = None
+      return False
+
+    # mark as recently used
+    try:
+      os.utime(meta_fd)
+    except OSError:
+      pass
+    self._meta_fd = meta_fd
+    return True
+
+  def get_length(self) -> int | None:
+    return self.length if self._open() else None
+
+  def create(self, length: int) -> None:
+    self._open(length)
+    evict(self.cache_dir, self.max_bytes)
+
+  def read_chunk(self, idx: int) -> bytes | None:
+    if not self._open():
+      return None
+
+    size, crc = CHUNK_ENTRY.unpack(os.pread(self._meta_fd, CHUNK_ENTRY.size, HEADER.size + idx * CHUNK_ENTRY.size))
+    if size == 0:
+      _count(misses=1)
+      return None
+
+    data = os.pread(self._data_fd, size, idx * self.chunk_size)
+    if len(data) != size or zlib.crc32(data) != crc:
+      _count(misses=1, corrupted=1)
+      return None
+
+    _count(hits=1, bytes_read=size)
+    return data
+
+  def write_chunk(self, idx: int, data: bytes) -> None:
+    global _written_since_evict
+    if not data or not self._open():
+      return
+
+    os.pwrite(self._data_fd, data, idx * self.chunk_size)
+    os.pwrite(self._meta_fd, CHUNK_ENTRY.pack(len(data), zlib.crc32(data)), HEADER.size + idx * CHUNK_ENTRY.size)
+    _count(bytes_written=len(data))
+
+    with _stats_lock:
+      _written_since_evict += len(data)
+      should_evict = _written_since_evict >= EVICT_INTERVAL_BYTES
+      if should_evict:
+        _written_since_evict = 0
+    if should_evict:
+      evict(self.cache_dir, self.max_bytes)
+
+
+def evict(cache_dir: str, max_bytes: int) -> None:
+  """
+    Delete least recently used entries until the cache fits in max_bytes. Only one process evicts at a time.
+  """
+  with open(os.path.join(cache_dir, EVICT_LOCK), "w") as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return
+
+    entries = []
+    for e in os.scandir(cache_dir):
+      if not e.name.endswith(META_EXT):
+        continue
+      data_path = e.path[:-len(META_EXT)] + DATA_EXT
+      try:
+        meta_st = e.stat()
+        # sparse files only use disk for the chunks that were downloaded
+        size = meta_st.st_size + os.stat(data_path).st_blocks * 512
+      except FileNotFoundError:
+        continue
+      entries.append((meta_st.st_mtime, size, e.path, data_path))
+
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, meta_path, data_path in sorted(entries):
+      if total <= max_bytes:
+        break
+      for path in (meta_path, data_path):
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+      total -= size
+      _count(evicted_files=1, evicted_bytes=size)
@@ -4,37 +4,43 @@ import pickle
 import struct
 import subprocess
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
 import _io
 from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
 from openpilot.tools.lib.exceptions import DataUnreadableError
-from openpilot.tools.lib.vidindex import hevc_index
+from openpilot.tools.lib.vidindex import hevc_index_array
 from openpilot.common.file_helpers import atomic_write_in_dir
 
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 
+try:
+  import av
+except ImportError:
+  av = None
+
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# GOPs are decoded in-process by long-lived libavcodec decoders when PyAV is available
+DECODER_THREADS = int(os.getenv("FRAMEREADER_DECODER_THREADS", str(os.cpu_count() or 1)))
+FRAME_CACHE_BYTES = int(os.getenv("FRAMEREADER_CACHE_BYTES", str(1024 ** 3)))
+
 
 class GOPReader:
   def get_gop(self, num):
     # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
     raise NotImplementedError
 
-
-class DoNothingContextManager:
-  def __enter__(self):
-    return self
-
-  def __exit__(self, *x):
-    pass
+  def get_gop_start(self, num):
+    # returns the number of the first frame of the GOP containing num
+    raise NotImplementedError
 
 
 class FrameType(IntEnum):
@@ -102,8 +108,7 @@ def index_stream(fn, ft):
   if ft != FrameType.h265_stream:
     raise NotImplementedError("Only h265 supported")
 
-  frame_types, dat_len, prefix = hevc_index(fn)
-  index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
+  index, prefix = hevc_index_array(fn)
   probe = ffprobe(fn, "hevc")
 
   return {
@@ -166,6 +171,16 @@ def rgb24tonv12(rgb):
   return nv12.clip(0, 255).astype('uint8')
 
 
+def reshape_frames(dat, pix_fmt, w, h):
+  if pix_fmt == "rgb24":
+    return dat.reshape(-1, h, w, 3)
+  elif pix_fmt in ("nv12", "yuv420p"):
+    return dat.reshape(-1, (h*w*3//2))
+  elif pix_fmt == "yuv444p":
+    return dat.reshape(-1, 3, h, w)
+  raise NotImplementedError
+
+
 def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   threads = os.getenv("FFMPEG_THREADS", "0")
   cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
@@ -182,19 +197,96 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
           "-pix_fmt", pix_fmt,
           "-"]
   dat = subprocess.check_output(args, input=rawdat)
+  return reshape_frames(np.frombuffer(dat, dtype=np.uint8), pix_fmt, w, h)
+
+
+class GOPDecoder:
+  """
+    Long-lived in-process HEVC decoder. The codec context is flushed and reused between GOPs,
+    which avoids starting an ffmpeg process for every GOP.
+  """
+  def __init__(self):
+    self.ctx = av.CodecContext.create("hevc", "r")
+    self.ctx.thread_count = int(os.getenv("FFMPEG_THREADS", "0"))
+    # also output frames with missing references, like ffmpeg -flags2 showall
+    self.ctx.options = {"flags2": "+showall"}
+
+  def decode(self, rawdat, w, h, pix_fmt):
+    frames = []
+    try:
+      # parse(None) flushes the last packet out of the parser
+      for packet in self.ctx.parse(bytes(rawdat)) + self.ctx.parse(None) + [None]:
+        frames.extend(frame.to_ndarray(format=pix_fmt) for frame in self.ctx.decode(packet))
+    finally:
+      self.ctx.flush_buffers()
+    dat = np.stack(frames) if len(frames) else np.empty(0, dtype=np.uint8)
+    return reshape_frames(dat, pix_fmt, w, h)
+
+
+_decoders = threading.local()
+_decoder_pool: ThreadPoolExecutor | None = None
+
+
+def _reset_decoder_pool():
+  global _decoder_pool
+  _decoder_pool = None
 
-  if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
-  elif pix_fmt == "nv12":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  elif pix_fmt == "yuv420p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  elif pix_fmt == "yuv444p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, 3, h, w)
-  else:
-    raise NotImplementedError
 
-  return ret
+def decoder_pool() -> ThreadPoolExecutor:
+  # shared by all frame readers to decode GOPs concurrently
+  global _decoder_pool
+  if _decoder_pool is None:
+    _decoder_pool = ThreadPoolExecutor(max_workers=DECODER_THREADS, thread_name_prefix="gop_decoder")
+  return _decoder_pool
+
+
+os.register_at_fork(after_in_child=_reset_decoder_pool)
+
+
+def decode_gop(rawdat, vid_fmt, w, h, pix_fmt):
+  # hardware decoding is only supported through the ffmpeg binary
+  if av is None or vid_fmt != "hevc" or os.getenv("FFMPEG_CUDA", "0") == "1":
+    return decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt)
+
+  if not hasattr(_decoders, "decoder"):
+    _decoders.decoder = GOPDecoder()
+  return _decoders.decoder.decode(rawdat, w, h, pix_fmt)
+
+
+class FrameCache:
+  """
+    Thread-safe LRU cache of decoded frames, bounded by their size in bytes.
+  """
+  def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._frames = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, key):
+    return key in self._frames
+
+  def __len__(self):
+    return len(self._frames)
+
+  def get(self, key):
+    with self._lock:
+      frame = self._frames.get(key)
+      if frame is not None:
+        self._frames.move_to_end(key)
+      return frame
+
+  def put(self, key, frame):
+    with self._lock:
+      old = self._frames.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes
+      self._frames[key] = frame
+      self.nbytes += frame.nbytes
+      # always keep the newest frame, even if it alone exceeds the budget
+      while self.nbytes > self.max_bytes and len(self._frames) > 1:
+        _, evicted = self._frames.popitem(last=False)
+        self.nbytes -= evicted.nbytes
 
 
 class BaseFrameReader:
@@ -400,21 +492,28 @@ class StreamGOPReader(GOPReader):
 
     return (frame_b, frame_e, offset_b, offset_e)
 
+  def get_gop_start(self, num):
+    return self._lookup_gop(num)[0]
+
   def get_gop(self, num):
     frame_b, frame_e, offset_b, offset_e = self._lookup_gop(num)
     assert frame_b <= num < frame_e
 
     num_frames = frame_e - frame_b
 
+    header = self.prefix
+    if num < self.first_iframe:
+      assert self.prefix_frame_data
+      header = header + self.prefix_frame_data
+
+    # read the GOP straight into its place after the prefix, without intermediate copies
+    rawdat = bytearray(len(header) + offset_e - offset_b)
+    rawdat[:len(header)] = header
     with FileReader(self.fn) as f:
       f.seek(offset_b)
-      rawdat = f.read(offset_e - offset_b)
-
-      if num < self.first_iframe:
-        assert self.prefix_frame_data
-        rawdat = self.prefix_frame_data + rawdat
-
-      rawdat = self.prefix + rawdat
+      bytes_read = f.readinto(memoryview(rawdat)[len(header):])
+    if bytes_read < offset_e - offset_b:
+      rawdat = rawdat[:len(header) + bytes_read]
 
     skip_frames = 0
     if num < self.first_iframe:
@@ -426,23 +525,24 @@ class StreamGOPReader(GOPReader):
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_bytes=FRAME_CACHE_BYTES):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = FrameCache(cache_bytes)
+
+    # one lock per GOP being decoded, so different GOPs are decoded concurrently
+    self.gop_locks = {}
+    self.gop_locks_lock = threading.Lock()
 
     if self.readahead:
-      self.cache_lock = threading.RLock()
       self.readahead_last = None
       self.readahead_len = 30
       self.readahead_c = threading.Condition()
       self.readahead_thread = threading.Thread(target=self._readahead_thread)
       self.readahead_thread.daemon = True
       self.readahead_thread.start()
-    else:
-      self.cache_lock = DoNothingContextManager()
 
   def close(self):
     if not self.open_:
@@ -470,32 +570,50 @@ class GOPFrameReader(BaseFrameReader):
       num, pix_fmt = self.readahead_last
 
       if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
+        self._decode_range(range(num - 1, max(0, num - self.readahead_len), -1), pix_fmt)
       else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
-
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
+        self._decode_range(range(num, min(self.frame_count, num + self.readahead_len)), pix_fmt)
+
+  def _decode_range(self, nums, pix_fmt):
+    # the frames nums, decoding every GOP they fall into at once on the decoder pool
+    frames = {}
+    missing = {}
+    for k in nums:
+      frame = self.frame_cache.get((k, pix_fmt))
+      if frame is not None:
+        frames[k] = frame
+      else:
+        missing.setdefault(self.get_gop_start(k), []).append(k)
+    for gop_frames in decoder_pool().map(lambda ks: self._decode_gop(ks, pix_fmt), missing.values()):
+      frames.update(gop_frames)
+    return frames
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+  def _decode_gop(self, nums, pix_fmt):
+    # the frames nums of one GOP, decoded unless another thread already did
+    gop_key = (self.get_gop_start(nums[0]), pix_fmt)
+    with self.gop_locks_lock:
+      lock = self.gop_locks.setdefault(gop_key, threading.Lock())
 
-    with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+    try:
+      with lock:
+        frames = {k: self.frame_cache.get((k, pix_fmt)) for k in nums}
+        if all(frame is not None for frame in frames.values()):
+          return frames
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+        frame_b, num_frames, skip_frames, rawdat = self.get_gop(nums[0])
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+        ret = decode_gop(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+        ret = ret[skip_frames:]
+        assert ret.shape[0] == num_frames
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+        for i in range(ret.shape[0]):
+          self.frame_cache.put((frame_b+i, pix_fmt), ret[i])
 
-      return self.frame_cache[(num, pix_fmt)]
+        return {k: ret[k - frame_b] for k in nums}
+    finally:
+      with self.gop_locks_lock:
+        if self.gop_locks.get(gop_key) is lock:
+          del self.gop_locks[gop_key]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -506,7 +624,8 @@ class GOPFrameReader(BaseFrameReader):
     if pix_fmt not in ("nv12", "yuv420p", "rgb24", "yuv444p"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
 
-    ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
+    frames = self._decode_range(range(num, num + count), pix_fmt)
+    ret = [frames[num + i] for i in range(count)]
 
     if self.readahead:
       self.readahead_last = (num+count, pix_fmt)
@@ -518,9 +637,9 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, cache_bytes=FRAME_CACHE_BYTES):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, cache_bytes)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
@@ -1,5 +1,19 @@
 import numpy as np
 
+# TODO: support these
+UNSUPPORTED_TYPES = ('qcomGnss', 'ubloxGnss')
+
+# scalar columns are widened to the dtypes NumPy infers from Python values, so arithmetic
+# on them (e.g. differences of unsigned timestamps) behaves the same as with plain lists.
+# uint64 stays unsigned, its values don't all fit into int64
+SCALAR_DTYPES = {
+  'bool': np.bool_,
+  'int8': np.int64, 'int16': np.int64, 'int32': np.int64, 'int64': np.int64,
+  'uint8': np.int64, 'uint16': np.int64, 'uint32': np.int64, 'uint64': np.uint64,
+  'float32': np.float64, 'float64': np.float64,
+}
+OBJECT_TYPES = ('enum', 'text', 'data')
+
 
 def flatten_type_dict(d, sep="/", prefix=None):
   res = {}
@@ -16,35 +30,6 @@ def flatten_type_dict(d, sep="/", prefix=None):
     return {prefix: d}
 
 
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
-
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
-
-
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
-
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
-
-
 def potentially_ragged_array(arr, dtype=None, **kwargs):
   # TODO: is there a better way to detect inhomogeneous shapes?
   try:
@@ -52,28 +37,188 @@ def potentially_ragged_array(arr, dtype=None, **kwargs):
   except ValueError:
     return np.array(arr, dtype=object, **kwargs)
 
-def msgs_to_time_series(msgs):
+
+class Column:
+  """
+    A growable column of per-message values. Numeric fields are stored in a preallocated NumPy array that
+    grows geometrically, everything else (enums, text, lists) in a Python list. Rows that were never set
+    (e.g. inactive union members) are zero for numeric columns and None otherwise.
+  """
+  def __init__(self, dtype=None):
+    self.dtype = dtype
+    self.data = np.zeros(64, dtype=dtype) if dtype is not None else []
+
+  def set(self, row, value):
+    if self.dtype is None:
+      if len(self.data) < row:
+        self.data.extend([None] * (row - len(self.data)))
+      self.data.append(value)
+      return
+
+    if row >= len(self.data):
+      grown = np.zeros(max(row + 1, 2 * len(self.data)), dtype=self.dtype)
+      grown[:len(self.data)] = self.data
+      self.data = grown
+    self.data[row] = value
+
+  def finalize(self, size, order=None):
+    if self.dtype is None:
+      arr = potentially_ragged_array(self.data + [None] * (size - len(self.data)))
+    else:
+      arr = self.data[:size]
+    return arr if order is None else arr[order]
+
+
+def _field_selected(path, selected):
+  if selected is None:
+    return True
+  # select the field itself, everything below a selected struct, and the structs leading to a selected field
+  return any(path == s or path.startswith(s + "/") or s.startswith(path + "/") for s in selected)
+
+
+def _list_converter(element_type):
+  if element_type == 'struct':
+    return lambda lst: np.array([x.to_dict(verbose=True) for x in lst])
+  elif element_type == 'enum':
+    return lambda lst: np.array([str(x) for x in lst])
+  return lambda lst: np.array(list(lst))
+
+
+class StructPlan:
+  """
+    Flattened extraction plan for a capnp struct, built once per message type from its schema.
+    Nested structs are planned lazily the first time they are seen.
+  """
+  def __init__(self, schema, prefix=None, selected=None):
+    self.selected = selected
+    self.union_fields = set(schema.union_fields)
+    self.fields = []  # (name, path, kind, converter or child plan)
+    for name, field in schema.fields.items():
+      path = name if prefix is None else prefix + "/" + name
+      if not _field_selected(path, selected):
+        continue
+
+      if field.proto.which() == 'group':
+        self.fields.append((name, path, 'struct', None))
+        continue
+
+      typ = field.proto.slot.type.which()
+      if typ in SCALAR_DTYPES:
+        self.fields.append((name, path, 'scalar', SCALAR_DTYPES[typ]))
+      elif typ in OBJECT_TYPES:
+        self.fields.append((name, path, 'object', str if typ == 'enum' else None))
+      elif typ == 'struct':
+        self.fields.append((name, path, 'struct', None))
+      elif typ == 'list':
+        self.fields.append((name, path, 'list', _list_converter(field.proto.slot.type.list.elementType.which())))
+
+  def extract(self, reader, row, columns):
+    active = reader.which() if self.union_fields else None
+    for i, (name, path, kind, extra) in enumerate(self.fields):
+      if name in self.union_fields and name != active:
+        continue
+
+      value = getattr(reader, name)
+      if kind == 'struct':
+        if extra is None:
+          extra = StructPlan(value.schema, path, self.selected)
+          self.fields[i] = (name, path, kind, extra)
+        extra.extract(value, row, columns)
+        continue
+
+      if path not in columns:
+        columns[path] = Column(extra if kind == 'scalar' else None)
+      if kind == 'object' and extra is not None:
+        value = extra(value)
+      elif kind == 'list':
+        value = extra(value)
+      columns[path].set(row, value)
+
+
+class MessageColumns:
+  def __init__(self, plan):
+    self.plan = plan
+    self.size = 0
+    self.columns = {"t": Column(np.float64), "_valid": Column(np.bool_)}
+
+  def append(self, msg, typ):
+    row = self.size
+    self.columns["t"].set(row, msg.logMonoTime / 1.0e9)
+    self.columns["_valid"].set(row, msg.valid)
+    self.plan.extract(getattr(msg, typ), row, self.columns)
+    self.size += 1
+
+  def finalize(self):
+    t = self.columns["t"].finalize(self.size)
+    # logs are almost always already in order, only sort when needed
+    order = None if np.all(t[1:] >= t[:-1]) else np.argsort(t, kind='stable')
+    return {name: col.finalize(self.size, order) for name, col in self.columns.items()}
+
+
+def msgs_to_time_series(msgs, msg_types=None, fields=None):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
     Each time series has a value with key "t" which consists of monotonically increasing timestamps
     in seconds.
+
+    msg_types optionally restricts the output to the given message types, and fields optionally maps
+    a message type to the "/"-separated field paths to extract for it (e.g. {"carState": ["vEgo", "cruiseState"]}).
   """
-  values = {}
+  msg_types = set(msg_types) if msg_types is not None else None
+  fields = fields or {}
+
+  values: dict[str, MessageColumns | None] = {}
   for msg in msgs:
     typ = msg.which()
+    if msg_types is not None and typ not in msg_types:
+      continue
+
+    if typ not in values:
+      message = msg._get(typ)
+      if not hasattr(message, 'to_dict') or typ in UNSUPPORTED_TYPES:
+        values[typ] = None
+      else:
+        selected = fields.get(typ)
+        values[typ] = MessageColumns(StructPlan(message.schema, selected=list(selected) if selected is not None else None))
+
+    if values[typ] is not None:
+      values[typ].append(msg, typ)
 
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
+  return {typ: group.finalize() for typ, group in values.items() if group is not None}
 
-  # Sort values by time.
-  for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
 
-  return values
+def _concat_columns(parts, sizes):
+  present = [p for p in parts if p is not None]
+  parts = [p if p is not None else
+           (np.zeros((size,) + present[0].shape[1:], dtype=present[0].dtype) if present[0].dtype != object else np.full(size, None))
+           for p, size in zip(parts, sizes, strict=True)]
+  try:
+    return np.concatenate(parts)
+  except ValueError:
+    # rows of different shapes across segments
+    return potentially_ragged_array([row for p in parts for row in p])
+
+
+def merge_time_series(series):
+  """
+    Merge time series of consecutive log segments (as returned by msgs_to_time_series) into one.
+  """
+  if len(series) == 1:
+    return series[0]
+
+  merged = {}
+  for typ in dict.fromkeys(typ for ts in series for typ in ts):
+    groups = [ts[typ] for ts in series if typ in ts]
+    sizes = [len(group["t"]) for group in groups]
+    names = dict.fromkeys(name for group in groups for name in group)
+    merged_group = {name: _concat_columns([group.get(name) for group in groups], sizes) for name in names}
+
+    t = merged_group["t"]
+    if not np.all(t[1:] >= t[:-1]):
+      order = np.argsort(t, kind='stable')
+      merged_group = {name: col[order] for name, col in merged_group.items()}
+    merged[typ] = merged_group
+  return merged
 
 
 if __name__ == "__main__":
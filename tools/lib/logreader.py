@@ -1,27 +1,38 @@
 #!/usr/bin/env python3
 import bz2
+import functools
+import hashlib
 from functools import cache, partial
 import multiprocessing
 import capnp
+import collections
 import enum
+import heapq
+import itertools
 import os
 import pathlib
+import pickle
+import struct
 import sys
 import tqdm
 import urllib.parse
 import warnings
 import zstandard as zstd
 
-from collections.abc import Callable, Iterable, Iterator
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.tools.lib.cache import cache_path_for_file_path
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
 from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
 from openpilot.tools.lib.route import Route, SegmentRange
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_time_series import UNSUPPORTED_TYPES, merge_time_series, msgs_to_time_series
+from openpilot.tools.lib.time_series_cache import TimeSeriesCache, time_series_cache_key
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
@@ -43,23 +54,142 @@ def decompress_stream(data: bytes):
   dctx = zstd.ZstdDecompressor()
   decompressed_data = b""
 
-  with dctx.stream_reader(data) as reader:
+  with dctx.stream_reader(data, read_across_frames=True) as reader:
     decompressed_data = reader.read()
 
   return decompressed_data
 
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def read_file_chunks(fn, chunk_size=STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  with FileReader(fn) as f:
+    while chunk := f.read(chunk_size):
+      yield chunk
+
+
+def decompress_chunks(chunks: Iterable[bytes], ext: str | None = None) -> Iterator[bytes]:
+  """
+    Incrementally decompress an iterable of raw file chunks, detecting the compression
+    from the extension or the magic bytes of the first chunk. Concatenated streams are supported.
+  """
+  chunks = iter(chunks)
+  first = next(chunks, b"")
+
+  if ext == ".bz2" or first.startswith(b'BZh9'):
+    new_decompressor = bz2.BZ2Decompressor
+  elif ext == ".zst" or first.startswith(b'\x28\xB5\x2F\xFD'):
+    new_decompressor = zstd.ZstdDecompressor().decompressobj
+  else:
+    yield first
+    yield from chunks
+    return
+
+  dec = new_decompressor()
+  for chunk in itertools.chain([first], chunks):
+    while chunk:
+      yield dec.decompress(chunk)
+      chunk = b""
+      if dec.eof:
+        chunk = dec.unused_data
+        dec = new_decompressor()
+
+
+def _message_spans(buf: bytes | bytearray) -> Iterator[tuple[int, int]]:
+  # walk the capnp stream framing (segment count, segment sizes) and yield (offset, size) of each complete message
+  pos, size = 0, len(buf)
+  while pos + 4 <= size:
+    num_segments = struct.unpack_from("<I", buf, pos)[0] + 1
+    header_size = (4 * (num_segments + 1) + 7) & ~7
+    if pos + header_size > size:
+      break
+    msg_size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", buf, pos + 4))
+    if pos + msg_size > size:
+      break
+    yield pos, msg_size
+    pos += msg_size
+
+
+def _complete_messages_end(buf: bytearray) -> int:
+  end = 0
+  for pos, size in _message_spans(buf):
+    end = pos + size
+  return end
+
+
+def stream_events(chunks: Iterable[bytes]) -> Iterator[capnp._DynamicStructReader]:
+  """
+    Yield capnp Events from an iterable of decompressed chunks as soon as each one is complete.
+    Only a single chunk plus an incomplete trailing message is held in memory at a time.
+  """
+  buf = bytearray()
+  try:
+    for chunk in chunks:
+      buf += chunk
+      end = _complete_messages_end(buf)
+      if end == 0:
+        continue
+      yield from capnp_log.Event.read_multiple_bytes(bytes(buf[:end]))
+      del buf[:end]
+  except capnp.KjException:
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+    return
+
+  if len(buf):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+MessageIndex = dict[str, list[tuple[int, int, int]]]
+
+INDEX_VERSION = 2
+
+
+def build_message_index(dat: bytes) -> MessageIndex:
+  """
+    Map each message type to a list of (byte offset, size, logMonoTime) of its events in the decompressed log.
+  """
+  index: MessageIndex = {}
+  try:
+    for (pos, size), ent in zip(_message_spans(dat), capnp_log.Event.read_multiple_bytes(dat), strict=False):
+      try:
+        typ = ent.which()
+      except capnp.KjException:
+        continue
+      index.setdefault(typ, []).append((pos, size, ent.logMonoTime))
+  except capnp.KjException:
+    pass
+  return index
+
+
+def _event_from_bytes(dat) -> capnp._DynamicStructReader:
+  with capnp_log.Event.from_bytes(dat) as ent:
+    return ent
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._streaming = streaming
+    self._fn = fn
+    self._dat = dat
 
-    ext = None
-    if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
+    if streaming and sort_by_time:
+      raise ValueError("sort_by_time is not supported in streaming mode")
+
+    self._ext = None
+    if fn:
+      _, self._ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+      if self._ext not in ('', '.bz2', '.zst'):
         # old rlogs weren't compressed
-        raise ValueError(f"unknown extension {ext}")
+        raise ValueError(f"unknown extension {self._ext}")
 
+    if streaming:
+      return
+
+    ext = self._ext
+    if not dat:
       with FileReader(fn) as f:
         dat = f.read()
 
@@ -69,20 +199,86 @@ class _LogFileReader:
       # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
       dat = decompress_stream(dat)
 
-    ents = capnp_log.Event.read_multiple_bytes(dat)
+    # events are only materialized on full iteration, filter() decodes just the indexed events it needs
+    self._dat = dat
+    self._sort_by_time = sort_by_time
+    self._index: MessageIndex | None = None
 
-    self._ents = []
+  @functools.cached_property
+  def _ents(self) -> list[capnp._DynamicStructReader]:
+    ents = []
     try:
-      for e in ents:
-        self._ents.append(e)
+      for e in capnp_log.Event.read_multiple_bytes(self._dat):
+        ents.append(e)
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    if self._sort_by_time:
+      ents.sort(key=lambda x: x.logMonoTime)
+    return ents
+
+  @property
+  def index(self) -> MessageIndex:
+    assert not self._streaming, "message index is not available in streaming mode"
+    if self._index is not None:
+      return self._index
+
+    # cached next to the other per-file caches, keyed by the log's path or URL
+    cache_path = cache_path_for_file_path(self._fn) + "_msg_index" if self._fn else None
+    source = self._index_source() if cache_path is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+      try:
+        with open(cache_path, "rb") as f:
+          cached = pickle.load(f)
+        if cached['version'] == INDEX_VERSION and cached['source'] == source:
+          self._index = cached['index']
+      except Exception:
+        cloudlog.exception(f"failed to load message index for {self._fn}")
+
+    if self._index is None:
+      self._index = build_message_index(self._dat)
+      if cache_path is not None:
+        with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as f:
+          pickle.dump({'version': INDEX_VERSION, 'source': source, 'index': self._index}, f, -1)
+    return self._index
+
+  def _index_source(self) -> tuple[int, int] | bytes:
+    # identifies the log an index was built from, so it's rebuilt when the file is replaced
+    try:
+      st = os.stat(self._fn)
+      return st.st_size, st.st_mtime_ns
+    except OSError:
+      # remote logs are identified by their contents
+      return hashlib.blake2b(self._dat, digest_size=16).digest()
+
+  def filter(self, msg_types: Iterable[str]) -> Iterator[capnp._DynamicStructReader]:
+    """
+      Yield only the events of the given types. Uses the message index to skip decoding every other event.
+    """
+    msg_types = set(msg_types)
+    if self._streaming:
+      yield from (ent for ent in self if ent.which() in msg_types)
+      return
+
+    index = self.index
+    entries = sorted(e for typ in msg_types for e in index.get(typ, []))
+    if self._sort_by_time:
+      entries.sort(key=lambda e: e[2])
+
+    dat = memoryview(self._dat)
+    for pos, size, _ in entries:
+      yield _event_from_bytes(dat[pos:pos + size])
+
+  def _events(self) -> Iterable[capnp._DynamicStructReader]:
+    if not self._streaming:
+      return self._ents
+
+    # decompress and parse incrementally on every iteration, nothing is kept between iterations
+    chunks = [self._dat] if self._dat else read_file_chunks(self._fn)
+    return stream_events(decompress_chunks(chunks, self._ext))
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in self._events():
       if self._only_union_types:
         try:
           ent.which()
@@ -93,6 +289,30 @@ class _LogFileReader:
         yield ent
 
 
+REORDER_WINDOW = 1000
+
+
+def reorder_by_time(events: Iterable[capnp._DynamicStructReader], window: int = REORDER_WINDOW) -> Iterator[capnp._DynamicStructReader]:
+  """
+    Sort a nearly time-ordered event stream using a bounded reorder buffer. The output is fully
+    sorted as long as no event is more than window events away from its sorted position.
+  """
+  heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+  for i, ent in enumerate(events):
+    heapq.heappush(heap, (ent.logMonoTime, i, ent))
+    if len(heap) > window:
+      yield heapq.heappop(heap)[2]
+  while heap:
+    yield heapq.heappop(heap)[2]
+
+
+def merge_by_time(streams: Iterable[Iterable[capnp._DynamicStructReader]], window: int = REORDER_WINDOW) -> Iterator[capnp._DynamicStructReader]:
+  """
+    Streaming k-way merge of nearly time-ordered event streams on logMonoTime.
+  """
+  return heapq.merge(*(reorder_by_time(s, window) for s in streams), key=lambda ent: ent.logMonoTime)
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -275,7 +495,8 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, streaming=False, prefetch: int = 0,
+               merge_by_time=False, reorder_window: int = REORDER_WINDOW):
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
@@ -284,18 +505,74 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.streaming = streaming
+    # number of segments to download and decompress ahead of the one being iterated.
+    # streaming readers only download theirs ahead, they're still decompressed while iterated
+    self.prefetch = prefetch
+    # interleave all log files in time order. all files are read at once, so memory grows with their number: a few
+    # chunks per file when streaming, otherwise every whole decompressed log. prefetch doesn't apply
+    self.merge_by_time = merge_by_time
+    self.reorder_window = reorder_window
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
+  def _load_lr(self, i, prefetch=False):
+    fn = self.logreader_identifiers[i]
+    dat = None
+    if prefetch and self.streaming:
+      with FileReader(fn) as f:
+        dat = f.read()
+    return _LogFileReader(fn, sort_by_time=self.sort_by_time, only_union_types=self.only_union_types, dat=dat,
+                          streaming=self.streaming)
+
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = self._load_lr(i)
     return self.__lrs[i]
 
+  def _iter_lrs(self, segments: Sequence[int]) -> Iterator[_LogFileReader]:
+    if self.prefetch <= 0:
+      for i in segments:
+        yield self._get_lr(i)
+      return
+
+    # segments are loaded on a thread pool while the current one is consumed. they are not kept
+    # in the reader cache, so at most prefetch + 1 segments are held in memory at once
+    executor = ThreadPoolExecutor(max_workers=self.prefetch)
+    pending: collections.deque[Future] = collections.deque()
+    next_seg = 0
+    try:
+      for _ in range(len(segments)):
+        while next_seg < len(segments) and len(pending) <= self.prefetch:
+          if segments[next_seg] in self.__lrs:
+            pending.append(Future())
+            pending[-1].set_result(self.__lrs[segments[next_seg]])
+          else:
+            pending.append(executor.submit(self._load_lr, segments[next_seg], prefetch=True))
+          next_seg += 1
+        yield pending.popleft().result()
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def _iter_events(self, events: Callable[[_LogFileReader], Iterable[capnp._DynamicStructReader]],
+                   segments: Sequence[int] | None = None) -> Iterator[capnp._DynamicStructReader]:
+    """
+      The events of every segment, as selected by events(), in segment order or merged by time.
+    """
+    if segments is None:
+      segments = range(len(self.logreader_identifiers))
+
+    if self.merge_by_time:
+      # every segment is read from concurrently, so none are loaded ahead on the prefetch pool
+      yield from merge_by_time([events(self._get_lr(i)) for i in segments], self.reorder_window)
+      return
+
+    for lr in self._iter_lrs(segments):
+      yield from events(lr)
+
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    return self._iter_events(iter)
 
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
@@ -314,18 +591,57 @@ class LogReader:
       self.logreader_identifiers.extend(self._parse_identifier(identifier))
 
   @staticmethod
-  def from_bytes(dat):
-    return _LogFileReader("", dat=dat)
+  def from_bytes(dat, streaming=False):
+    return _LogFileReader("", dat=dat, streaming=streaming)
+
+  def _filter_events(self, msg_types: Iterable[str]):
+    return self._iter_events(lambda lr: lr.filter(msg_types))
 
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    return (getattr(m, msg_type) for m in self._filter_events([msg_type]))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def _time_series_events(self, segments: Sequence[int], msg_types: Iterable[str] | None = None):
+    def events(lr):
+      if self.streaming:
+        return lr
+      # only the requested types are decoded, using the index
+      types = lr.index.keys() if msg_types is None else set(msg_types)
+      return lr.filter(types - set(UNSUPPORTED_TYPES))
+    return self._iter_events(events, segments)
+
+  def get_time_series(self, msg_types: Iterable[str] | None = None, fields: dict[str, Iterable[str]] | None = None,
+                      cache: bool | None = None):
+    """
+      Time series of the given message types (all by default), optionally restricted to a subset of their fields.
+      See msgs_to_time_series.
+
+      With cache (default from TIME_SERIES_CACHE), every segment's time series is stored on disk and
+      memory-mapped on later calls, so cached segments are neither downloaded nor decoded again.
+    """
+    msg_types = list(msg_types) if msg_types is not None else None
+    segments = range(len(self.logreader_identifiers))
+    if cache is None:
+      cache = bool(int(os.environ.get("TIME_SERIES_CACHE", "0")))
+    if not cache:
+      return msgs_to_time_series(self._time_series_events(segments, msg_types), msg_types=msg_types, fields=fields)
+
+    ts_cache = TimeSeriesCache()
+    series = []
+    for i in segments:
+      key = time_series_cache_key(self.logreader_identifiers[i], msg_types, fields)
+      ts = ts_cache.get(key)
+      if ts is None:
+        ts = msgs_to_time_series(self._time_series_events([i], msg_types), msg_types=msg_types, fields=fields)
+        ts_cache.put(key, ts)
+      series.append(ts)
+    return merge_time_series(series)
+
   @property
   def time_series(self):
-    return msgs_to_time_series(self)
+    return self.get_time_series()
 
 if __name__ == "__main__":
   import codecs
@@ -6,7 +6,8 @@ import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.download_cache import CachedFile, cache_stats, evict
+from openpilot.tools.lib.url_file import CHUNK_SIZE, URLFile
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -128,3 +129,81 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+
+class RangeTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = os.urandom(3 * CHUNK_SIZE + 1234)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+  def do_GET(self):
+    if "Range" in self.headers:
+      begin, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+      body = self.DATA[begin:end + 1]
+      self.send_response(206)
+    else:
+      body = self.DATA
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class TestConcurrentDownload:
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_multi_chunk_reads(self, cache_enabled):
+    data = RangeTestRequestHandler.DATA
+    with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+      url = f"http://{host}:{port}/test.bin"
+      for _ in range(2):
+        f = URLFile(url, cache=cache_enabled)
+        assert f.read() == data
+
+        for start, length in [(0, 10), (CHUNK_SIZE - 1, 2), (CHUNK_SIZE, CHUNK_SIZE + 5), (len(data) - 1, 10), (5, None)]:
+          f.seek(start)
+          assert f.read(length) == data[start:start + length if length is not None else None]
+
+        f.seek(123)
+        buf = bytearray(2 * CHUNK_SIZE)
+        assert f.readinto(buf) == len(buf)
+        assert buf == data[123:123 + len(buf)]
+
+
+class TestDownloadCache:
+  def test_chunks(self, tmp_path):
+    f = CachedFile("test", chunk_size=4, cache_dir=str(tmp_path))
+    assert f.get_length() is None
+    f.create(10)
+    assert f.read_chunk(0) is None
+    f.write_chunk(0, b"1234")
+    f.write_chunk(2, b"90")
+
+    # visible to other readers, e.g. in other processes
+    f2 = CachedFile("test", chunk_size=4, cache_dir=str(tmp_path))
+    assert f2.get_length() == 10
+    assert f2.read_chunk(0) == b"1234"
+    assert f2.read_chunk(1) is None
+    assert f2.read_chunk(2) == b"90"
+
+    # corrupted chunks are treated as missing
+    stats = cache_stats()
+    with open(f.data_path, "r+b") as data:
+      data.write(b"x")
+    assert f2.read_chunk(0) is None
+    assert cache_stats()["corrupted"] == stats["corrupted"] + 1
+
+  def test_eviction(self, tmp_path):
+    files = []
+    for i in range(4):
+      f = CachedFile(f"test{i}", chunk_size=64 * 1024, cache_dir=str(tmp_path))
+      f.create(64 * 1024)
+      f.write_chunk(0, os.urandom(64 * 1024))
+      os.utime(f.meta_path, (i, i))
+      files.append(f)
+
+    evict(str(tmp_path), 3 * 70 * 1024)
+    assert not os.path.exists(files[0].meta_path) and not os.path.exists(files[0].data_path)
+    assert all(os.path.exists(f.meta_path) for f in files[1:])
@@ -1,4 +1,5 @@
 import capnp
+import numpy as np
 import contextlib
 import io
 import shutil
@@ -6,12 +7,17 @@ import tempfile
 import os
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from openpilot.tools.lib.cache import cache_path_for_file_path
+from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException, \
+                                          save_log, decompress_chunks, stream_events, build_message_index, read_file_chunks
+from openpilot.tools.lib.log_time_series import msgs_to_time_series
 from openpilot.tools.lib.route import SegmentRange
+from openpilot.tools.lib.time_series_cache import TimeSeriesCache
 from openpilot.tools.lib.url_file import URLFileException
 
 NUM_SEGS = 17  # number of segments in the test route
@@ -254,3 +260,193 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("compression", ["", ".bz2", ".zst"])
+  def test_streaming(self, mocker, compression):
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_CHUNK_SIZE", 100)
+    msgs = [capnp_log.Event.new_message(logMonoTime=i, valid=True).as_reader() for i in range(1000)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog" + compression)
+      save_log(fn, msgs)
+
+      expected = [m.logMonoTime for m in LogReader(fn)]
+      lr = LogReader(fn, streaming=True)
+      assert [m.logMonoTime for m in lr] == expected == list(range(1000))
+      # streaming readers can be iterated multiple times
+      assert len(list(lr)) == len(expected)
+
+  def test_streaming_concatenated_streams(self):
+    msgs = [capnp_log.Event.new_message(logMonoTime=i) for i in range(100)]
+    dat = b"".join(zstd.compress(b"".join(m.to_bytes() for m in msgs[i:i + 10])) for i in range(0, len(msgs), 10))
+    chunks = [dat[i:i + 37] for i in range(0, len(dat), 37)]
+    assert [m.logMonoTime for m in stream_events(decompress_chunks(chunks))] == list(range(100))
+
+  def test_streaming_corrupted(self):
+    dat = b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(10))
+    with pytest.warns(RuntimeWarning, match="Corrupted events detected"):
+      msgs = list(LogReader.from_bytes(dat[:-1], streaming=True))
+    assert len(msgs) == 9
+
+  @pytest.mark.parametrize("sort_by_time", [True, False])
+  def test_message_index(self, mocker, tmp_path, sort_by_time):
+    mocker.patch("openpilot.tools.lib.logreader.cache_path_for_file_path", lambda fn: cache_path_for_file_path(fn, cache_dir=str(tmp_path)))
+    def make_msgs(v_offset):
+      msgs = []
+      for i in range(300):
+        msg = capnp_log.Event.new_message(logMonoTime=(i * 7919) % 300)
+        if i % 3 == 0:
+          msg.init('carState').vEgo = i + v_offset
+        elif i % 3 == 1:
+          msg.init('controlsState')
+        msgs.append(msg.as_reader())
+      return msgs
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog.zst")
+      save_log(fn, make_msgs(0))
+
+      build_index_mock = mocker.patch("openpilot.tools.lib.logreader.build_message_index", wraps=build_message_index)
+      for _ in range(2):
+        lr = LogReader(fn, sort_by_time=sort_by_time)
+        expected = [m.carState.vEgo for m in lr if m.which() == 'carState']
+        assert [m.vEgo for m in lr.filter('carState')] == expected
+        assert lr.first('carState').vEgo == expected[0]
+        assert len(list(lr.filter('controlsState'))) == 100
+        assert lr.first('carParams') is None
+
+      # index is built on first read and loaded from its sidecar afterwards
+      assert build_index_mock.call_count == 1
+
+      # a replaced log of the same size gets a new index
+      save_log(fn, make_msgs(1))
+      st = os.stat(fn)
+      os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + int(1e9)))
+      lr = LogReader(fn, sort_by_time=sort_by_time)
+      assert [m.vEgo for m in lr.filter('carState')] == [v + 1 for v in expected]
+      assert build_index_mock.call_count == 2
+
+  def test_time_series(self):
+    msgs = []
+    for i in range(100):
+      msg = capnp_log.Event.new_message(logMonoTime=int(1e9) * (i if i != 50 else 200), valid=i % 2 == 0)
+      if i % 2 == 0:
+        cs = msg.init('carState')
+        cs.vEgo = i
+        cs.cruiseState.speed = 2 * i
+        cs.gearShifter = 'drive'
+      else:
+        msg.init('accelerometer').init('acceleration').v = [i, i + 1, i + 2]
+      msgs.append(msg.as_reader())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog")
+      save_log(fn, msgs)
+
+      ts = LogReader(fn).time_series
+      assert set(ts) == {'carState', 'accelerometer'}
+      assert np.all(np.diff(ts['carState']['t']) > 0)
+      assert ts['carState']['t'][-1] == 200
+      assert ts['carState']['vEgo'][-1] == 50
+      assert list(ts['carState']['gearShifter'][:2]) == ['drive', 'drive']
+      assert np.all(ts['carState']['_valid'])
+      assert ts['accelerometer']['acceleration/v'].shape == (50, 3)
+
+      ts = LogReader(fn).get_time_series(['carState'], fields={'carState': ['vEgo', 'cruiseState/speed']})
+      assert set(ts) == {'carState'}
+      assert set(ts['carState']) == {'t', '_valid', 'vEgo', 'cruiseState/speed'}
+      np.testing.assert_array_equal(ts['carState']['cruiseState/speed'], 2 * ts['carState']['vEgo'])
+
+  def test_time_series_uint64(self):
+    timestamps = [2**64 - 1, 2**63, 1]
+    msgs = [capnp_log.Event.new_message(logMonoTime=i, roadCameraState={'timestampEof': t}).as_reader() for i, t in enumerate(timestamps)]
+    ts = msgs_to_time_series(msgs)
+    assert ts['roadCameraState']['timestampEof'].dtype == np.uint64
+    assert list(ts['roadCameraState']['timestampEof']) == timestamps
+
+  def test_time_series_cache(self, mocker, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setenv("COMMA_CACHE", os.path.join(tmpdir, "cache"))
+      fns = []
+      for seg in range(2):
+        fn = os.path.join(tmpdir, f"rlog{seg}")
+        save_log(fn, [capnp_log.Event.new_message(logMonoTime=seg * 100 + i, carState={'vEgo': seg * 100 + i}).as_reader() for i in range(100)])
+        fns.append(fn)
+
+      expected = LogReader(fns).get_time_series(cache=False)
+      ts = LogReader(fns).get_time_series(cache=True)
+      np.testing.assert_array_equal(ts['carState']['vEgo'], expected['carState']['vEgo'])
+      np.testing.assert_array_equal(ts['carState']['t'], expected['carState']['t'])
+
+      # cached segments are loaded without decoding the logs again
+      filter_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader.filter")
+      ts = LogReader(fns).get_time_series(cache=True)
+      assert filter_mock.call_count == 0
+      np.testing.assert_array_equal(ts['carState']['vEgo'], expected['carState']['vEgo'])
+
+      # a single segment is returned memory-mapped
+      assert isinstance(LogReader(fns[0]).get_time_series(cache=True)['carState']['vEgo'], np.memmap)
+
+      # entries are evicted once the cache grows past its budget
+      ts_cache = TimeSeriesCache(max_bytes=0)
+      ts_cache.evict()
+      assert os.listdir(ts_cache.cache_dir) == []
+
+  @pytest.mark.parametrize("prefetch", [1, 3, 10])
+  @pytest.mark.parametrize("streaming", [True, False])
+  def test_prefetch(self, mocker, prefetch, streaming):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(5):
+        fn = os.path.join(tmpdir, f"rlog{seg}.zst")
+        save_log(fn, [capnp_log.Event.new_message(logMonoTime=seg * 100 + i).as_reader() for i in range(100)])
+        fns.append(fn)
+
+      read_chunks_mock = mocker.patch("openpilot.tools.lib.logreader.read_file_chunks", wraps=read_file_chunks)
+      lr = LogReader(fns, prefetch=prefetch, streaming=streaming)
+      assert [m.logMonoTime for m in lr] == list(range(500))
+      assert next(iter(lr)).logMonoTime == 0
+      # streaming readers are handed the prefetched file instead of reading it while iterated
+      assert read_chunks_mock.call_count == 0
+
+  @pytest.mark.parametrize("streaming", [True, False])
+  def test_merge_by_time(self, mocker, streaming):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for src in range(3):
+        # each file is interleaved with the others and slightly out of order
+        times = [t * 3 + src for t in range(300)]
+        for i in range(0, len(times) - 1, 7):
+          times[i], times[i + 1] = times[i + 1], times[i]
+        fn = os.path.join(tmpdir, f"rlog{src}.zst")
+        save_log(fn, [capnp_log.Event.new_message(logMonoTime=t).as_reader() for t in times])
+        fns.append(fn)
+
+      assert [m.logMonoTime for m in LogReader(fns, merge_by_time=True, streaming=streaming)] == list(range(900))
+      # whole files aren't prefetched into memory when merging
+      load_lr_mock = mocker.patch.object(LogReader, "_load_lr", autospec=True, side_effect=LogReader._load_lr)
+      assert [m.logMonoTime for m in LogReader(fns, merge_by_time=True, streaming=streaming, prefetch=2)] == list(range(900))
+      assert all(not call.kwargs.get('prefetch') for call in load_lr_mock.call_args_list)
+      # a too small reorder window can't fix up the out of order events
+      assert [m.logMonoTime for m in LogReader(fns, merge_by_time=True, reorder_window=0)] != list(range(900))
+
+  @pytest.mark.parametrize("prefetch", [0, 2])
+  def test_filter_merge_by_time(self, prefetch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for src in range(3):
+        fn = os.path.join(tmpdir, f"rlog{src}.zst")
+        msgs = []
+        for t in range(src, 600, 3):
+          msg = capnp_log.Event.new_message(logMonoTime=t)
+          if t % 2 == 0:
+            msg.init('carState').vEgo = t
+          else:
+            msg.init('controlsState')
+          msgs.append(msg.as_reader())
+        save_log(fn, msgs)
+        fns.append(fn)
+
+      lr = LogReader(fns, merge_by_time=True, prefetch=prefetch)
+      assert [m.vEgo for m in lr.filter('carState')] == list(range(0, 600, 2))
+      assert lr.first('controlsState') is not None
+      assert list(lr.get_time_series(['carState'], cache=False)['carState']['vEgo']) == list(range(0, 600, 2))
@@ -1,11 +1,15 @@
+import fractions
 import pytest
 import requests
 import tempfile
+import time
 
 from collections import defaultdict
 import numpy as np
-from openpilot.tools.lib.framereader import FrameReader
+from openpilot.common.timeout import Timeout
+from openpilot.tools.lib.framereader import FrameReader, FrameType, StreamFrameReader, decode_gop
 from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.vidindex import HevcNalUnitType, hevc_index_array
 
 
 class TestReaders:
@@ -61,3 +65,102 @@ class TestReaders:
 
     fr_url = FrameReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true")
     _check_data(fr_url)
+
+  @pytest.mark.parametrize("block_size", [64, 1000, 4 * 1024 * 1024])
+  def test_hevc_index(self, block_size):
+    def nal_unit(nal_unit_type, slice_header=None, size=500):
+      dat = bytes([nal_unit_type << 1, 1])
+      if slice_header is not None:
+        # first_slice_segment_in_pic_flag, slice header bits, stop bit, no zero bytes
+        dat += int(slice_header + "1" + "1" * (-(len(slice_header) + 1) % 8), 2).to_bytes((len(slice_header) + 8) // 8, "big")
+      return dat + bytes(range(1, 256)) * (size // 255) + b"\xff" * (size % 255)
+
+    param_sets = [nal_unit(t, size=20) for t in (HevcNalUnitType.VPS_NUT, HevcNalUnitType.SPS_NUT, HevcNalUnitType.PPS_NUT)]
+    dat = b"\x00" + b"".join(b"\x00\x00\x01" + ps for ps in param_sets)
+    expected = []
+    for i in range(50):
+      # I frames every 10 frames, P frames otherwise, each followed by a second slice
+      if i % 10 == 0:
+        expected.append((2, len(dat)))
+        dat += b"\x00\x00\x01" + nal_unit(HevcNalUnitType.IDR_W_RADL, "1" + "0" + "1" + "011")
+      else:
+        expected.append((1, len(dat)))
+        dat += b"\x00\x00\x01" + nal_unit(HevcNalUnitType.TRAIL_R, "1" + "1" + "010")
+      dat += b"\x00\x00\x00\x01" + nal_unit(HevcNalUnitType.TRAIL_R, "0" + "1", size=100)
+    expected.append((0xFFFFFFFF, len(dat)))
+
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(dat)
+      f.flush()
+      index, prefix = hevc_index_array(f.name, block_size=block_size)
+
+    assert index.dtype == np.uint32
+    np.testing.assert_array_equal(index, np.array(expected, dtype=np.uint32))
+    assert prefix == b"".join(b"\x00\x00\x01" + ps for ps in param_sets)
+
+  @staticmethod
+  def _gop_video(f, w, h, num_frames):
+    av = pytest.importorskip("av")
+    if "libx265" not in av.codecs_available:
+      pytest.skip("libx265 not available")
+
+    enc = av.CodecContext.create("libx265", "w")
+    enc.width, enc.height, enc.pix_fmt = w, h, "yuv420p"
+    enc.time_base = fractions.Fraction(1, 20)
+    enc.options = {"x265-params": "keyint=5:min-keyint=5:bframes=0:log-level=none"}
+    dat = b""
+    for i in range(num_frames):
+      frame = av.VideoFrame.from_ndarray(np.full((h, w, 3), i * 10, dtype=np.uint8), format="rgb24").reformat(format="yuv420p")
+      frame.pts = i
+      dat += b"".join(bytes(p) for p in enc.encode(frame))
+    dat += b"".join(bytes(p) for p in enc.encode(None))
+
+    f.write(dat)
+    f.flush()
+    index, prefix = hevc_index_array(f.name)
+    return {'index': index, 'global_prefix': prefix, 'probe': {'streams': [{'width': w, 'height': h}]}}
+
+  @pytest.mark.parametrize("readahead", [False, True])
+  def test_gop_decoder_pool(self, readahead):
+    w, h, num_frames = 64, 48, 23
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      index_data = self._gop_video(f, w, h, num_frames)
+
+      # only room for one GOP of rgb frames
+      with StreamFrameReader(f.name, FrameType.h265_stream, index_data, readahead=readahead, cache_bytes=5 * w * h * 3) as fr:
+        assert fr.frame_count == num_frames
+        frames = fr.get(0, num_frames, pix_fmt="rgb24")
+        assert fr.frame_cache.nbytes <= 5 * w * h * 3
+        assert [int(np.median(f)) for f in frames] == pytest.approx([i * 10 for i in range(num_frames)], abs=2)
+
+        for num in (17, 3, 9, 22):
+          frame = fr.get(num, pix_fmt="yuv420p")[0]
+          assert frame.shape == (w * h * 3 // 2,)
+          assert np.array_equal(frame, fr.get(num, pix_fmt="yuv420p")[0])
+
+  def test_gop_decode_count(self, mocker):
+    w, h, num_frames = 64, 48, 23
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      index_data = self._gop_video(f, w, h, num_frames)
+      decode_mock = mocker.patch("openpilot.tools.lib.framereader.decode_gop", wraps=decode_gop)
+
+      # every GOP is decoded once, even when the range doesn't fit into the cache
+      with StreamFrameReader(f.name, FrameType.h265_stream, index_data, cache_bytes=5 * w * h * 3) as fr:
+        frames = fr.get(0, num_frames, pix_fmt="rgb24")
+        assert len(frames) == num_frames
+        assert decode_mock.call_count == 5
+
+  def test_gop_readahead(self, mocker):
+    w, h, num_frames = 64, 48, 23
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      index_data = self._gop_video(f, w, h, num_frames)
+      decode_mock = mocker.patch("openpilot.tools.lib.framereader.decode_gop", wraps=decode_gop)
+
+      with StreamFrameReader(f.name, FrameType.h265_stream, index_data, readahead=True) as fr:
+        # the next GOP is decoded in the background, also when it's the only one missing
+        fr.readahead_len = 5
+        fr.get(0, 5)
+        with Timeout(5, "next GOP not read ahead"):
+          while (5, "yuv420p") not in fr.frame_cache:
+            time.sleep(0.01)
+        assert decode_mock.call_count == 2
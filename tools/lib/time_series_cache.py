@@ -0,0 +1,112 @@
+import functools
+import os
+import shutil
+import tempfile
+import urllib.parse
+from hashlib import sha256
+
+import numpy as np
+
+from cereal import CEREAL_PATH
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.url_file import hash_256
+
+DEFAULT_MAX_CACHE_BYTES = int(os.getenv("TIME_SERIES_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+SCHEMA_FILES = ("log.capnp", "car.capnp", "custom.capnp", "legacy.capnp")
+CACHE_VERSION = 2  # bumped when the time series of a log change, e.g. their dtypes
+OBJECT_SUFFIX = ".obj.npy"
+
+
+@functools.cache
+def schema_version() -> str:
+  h = sha256()
+  for fn in SCHEMA_FILES:
+    with open(os.path.join(CEREAL_PATH, fn), "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+
+def time_series_cache_key(fn: str, msg_types=None, fields=None) -> str:
+  parts = [hash_256(fn), str(CACHE_VERSION), schema_version(), repr(sorted(msg_types) if msg_types is not None else None),
+           repr(sorted((k, sorted(v)) for k, v in fields.items()) if fields else None)]
+  if os.path.isfile(fn):
+    # local files can change under the same path
+    st = os.stat(fn)
+    parts += [str(st.st_size), str(st.st_mtime_ns)]
+  return sha256("|".join(parts).encode()).hexdigest()
+
+
+def _dir_size(path: str) -> int:
+  return sum(e.stat().st_size for e in os.scandir(path) if e.is_file()) + \
+         sum(_dir_size(e.path) for e in os.scandir(path) if e.is_dir())
+
+
+class TimeSeriesCache:
+  """
+    Content-addressed on-disk cache of per-segment time series. Every column is stored as its own .npy file
+    and numeric columns are memory-mapped on load. Least recently used entries are evicted when the cache
+    grows past max_bytes.
+  """
+  def __init__(self, cache_dir: str | None = None, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+    self.cache_dir = cache_dir if cache_dir is not None else os.path.join(Paths.download_cache_root(), "time_series")
+    self.max_bytes = max_bytes
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  def _entry_path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, key: str) -> dict[str, dict[str, np.ndarray]] | None:
+    path = self._entry_path(key)
+    if not os.path.isdir(path):
+      return None
+
+    ts = {}
+    try:
+      for typ in os.listdir(path):
+        group = {}
+        for fn in os.listdir(os.path.join(path, typ)):
+          col_path = os.path.join(path, typ, fn)
+          if fn.endswith(OBJECT_SUFFIX):
+            group[urllib.parse.unquote(fn[:-len(OBJECT_SUFFIX)])] = np.load(col_path, allow_pickle=True)
+          else:
+            group[urllib.parse.unquote(fn[:-len(".npy")])] = np.load(col_path, mmap_mode='r')
+        ts[typ] = group
+    except FileNotFoundError:
+      # evicted by another process while loading
+      return None
+
+    # mark as recently used
+    os.utime(path)
+    return ts
+
+  def put(self, key: str, ts: dict[str, dict[str, np.ndarray]]) -> None:
+    tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+    try:
+      for typ, group in ts.items():
+        os.mkdir(os.path.join(tmp_path, typ))
+        for name, arr in group.items():
+          suffix = OBJECT_SUFFIX if arr.dtype == object else ".npy"
+          np.save(os.path.join(tmp_path, typ, urllib.parse.quote(name, safe='') + suffix), arr, allow_pickle=arr.dtype == object)
+      os.rename(tmp_path, self._entry_path(key))
+    except OSError:
+      # another process already stored this entry
+      shutil.rmtree(tmp_path, ignore_errors=True)
+      return
+
+    self.evict()
+
+  def evict(self) -> None:
+    entries = []
+    for e in os.scandir(self.cache_dir):
+      if e.is_dir() and not e.name.startswith(".tmp_"):
+        try:
+          entries.append((e.stat().st_mtime, _dir_size(e.path), e.path))
+        except FileNotFoundError:
+          pass
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      shutil.rmtree(path, ignore_errors=True)
+      total -= size
@@ -2,16 +2,18 @@ import logging
 import os
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
 from urllib3.util import Timeout
 
-from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import CachedFile
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+DOWNLOAD_THREADS = int(os.getenv("URLFILE_DOWNLOAD_THREADS", "8"))
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -25,10 +27,19 @@ class URLFileException(Exception):
 
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _executor: ThreadPoolExecutor|None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._executor = None
+
+  @staticmethod
+  def executor() -> ThreadPoolExecutor:
+    # shared by all URLFiles for concurrent chunk downloads, sized to the connection pool
+    if URLFile._executor is None:
+      URLFile._executor = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)
+    return URLFile._executor
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -49,14 +60,17 @@ class URLFile:
     if cache is not None:
       self._force_download = not cache
 
+    self._cache: CachedFile|None = None
     if not self._force_download:
       os.makedirs(Paths.download_cache_root(), exist_ok=True)
+      self._cache = CachedFile(hash_256(url), CHUNK_SIZE)
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback) -> None:
-    pass
+    if self._cache is not None:
+      self._cache.close()
 
   def _request(self, method: str, url: str, headers: dict[str, str]|None=None) -> BaseHTTPResponse:
     return URLFile.pool_manager().request(method, url, timeout=self._timeout, headers=headers)
@@ -72,50 +86,107 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
+    if self._cache is not None:
+      self._length = self._cache.get_length()
+      if self._length is not None:
         return self._length
 
     self._length = self.get_length_online()
-    if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w", overwrite=True) as file_length:
-        file_length.write(str(self._length))
+    if self._cache is not None and self._length != -1:
+      self._cache.create(self._length)
     return self._length
 
   def read(self, ll: int|None=None) -> bytes:
-    if self._force_download:
+    length = self.get_length()
+    if self._force_download and self._pos == 0 and ll is None and length <= CHUNK_SIZE:
+      # small files are fetched with a single request
       return self.read_aux(ll=ll)
 
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+
+    size = max(0, (length if ll is None else min(self._pos + ll, length)) - self._pos)
+    buf = bytearray(size)
+    n = self.readinto(buf)
+    return bytes(memoryview(buf)[:n])
+
+  def readinto(self, b) -> int:
+    """
+      Read up to len(b) bytes from the current position into the writable buffer b.
+      Reads spanning several chunks are fetched concurrently.
+    """
+    buf = memoryview(b).cast('B')
+    length = self.get_length()
+    if length == -1:
+      raise URLFileException(f"Remote file is empty or doesn't exist: {self._url}")
+
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_end = min(file_begin + len(buf), length)
+    if file_end <= file_begin:
+      return 0
+
+    if self._force_download:
+      ranges = [(b, min(b + CHUNK_SIZE, file_end)) for b in range(file_begin, file_end, CHUNK_SIZE)]
+      fetch = self._readinto_range
+    else:
+      #  We have to align with chunks we store, from the chunk that contains file_begin to the one that contains the last byte
+      ranges = [(c * CHUNK_SIZE, (c + 1) * CHUNK_SIZE) for c in range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1)]
+      fetch = self._readinto_chunk
+
+    def fill(r):
+      return fetch(r[0], r[1], file_begin, file_end, buf)
+
+    if len(ranges) == 1:
+      fill(ranges[0])
+    else:
+      URLFile.pool_manager()
+      list(URLFile.executor().map(fill, ranges))
+
+    self._pos = file_end
+    return file_end - file_begin
+
+  def _readinto_range(self, begin: int, end: int, file_begin: int, file_end: int, buf: memoryview) -> None:
+    # download straight into the destination buffer
+    response = self._request_range(begin, end)
+    dest = buf[begin - file_begin:end - file_begin]
+    try:
+      n = 0
+      while n < len(dest):
+        r = response.readinto(dest[n:])
+        if r == 0:
+          raise URLFileException(f"Error, short read {n}/{len(dest)} in range {begin}-{end} ({self._url})")
+        n += r
+    finally:
+      response.release_conn()
+
+  def _readinto_chunk(self, chunk_begin: int, chunk_end: int, file_begin: int, file_end: int, buf: memoryview) -> None:
+    assert self._cache is not None
+    chunk_number = chunk_begin // CHUNK_SIZE
+    data = self._cache.read_chunk(chunk_number)
+    #  If we don't have the chunk, download it
+    if data is None:
+      data = self._request_range(chunk_begin, min(chunk_end, self.get_length())).data
+      self._cache.write_chunk(chunk_number, data)
+
+    begin, end = max(file_begin, chunk_begin), min(file_end, chunk_begin + len(data))
+    buf[begin - file_begin:end - file_begin] = memoryview(data)[begin - chunk_begin:end - chunk_begin]
+
+  def _request_range(self, begin: int, end: int) -> BaseHTTPResponse:
+    headers = {'Range': f"bytes={begin}-{end - 1}"}
+    if self._debug:
+      t1 = time.time()
+
+    response = URLFile.pool_manager().request('GET', self._url, timeout=self._timeout, headers=headers, preload_content=False)
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    if self._debug:
+      t2 = time.time()
+      if t2 - t1 > 0.1:
+        print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    if response.status == 416:  # Requested Range Not Satisfiable
+      raise URLFileException(f"Error, range out of bounds {response.status} {headers} ({self._url}): {repr(response.data)[:500]}")
+    if response.status != 206:  # Partial Content
+      raise URLFileException(f"Error, requested range but got unexpected response {response.status} {headers} ({self._url}): {repr(response.data)[:500]}")
+    return response
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -125,7 +196,7 @@ class URLFile:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
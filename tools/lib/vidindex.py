@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import argparse
+import mmap
 import os
-import struct
 from enum import IntEnum
 
+import numpy as np
+
 from openpilot.tools.lib.filereader import FileReader
 
 DEBUG = int(os.getenv("DEBUG", "0"))
@@ -17,6 +19,9 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+# bytes after a start code needed to parse the NAL unit header and the start of a slice segment header
+NAL_UNIT_LOOKAHEAD = 24
+INDEX_BLOCK_SIZE = 4 * 1024 * 1024
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -258,38 +263,99 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+def _read_blocks(hevc_file_name: str, block_size: int = INDEX_BLOCK_SIZE):
   with FileReader(hevc_file_name) as f:
-    dat = f.read()
-
-  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
-    raise VideoFileInvalid("data is too short")
-
-  if dat[0] != 0x00:
-    raise VideoFileInvalid("first byte must be 0x00")
+    if not hasattr(f, "fileno"):
+      while blk := f.read(block_size):
+        yield blk
+      return
+
+    # local files are memory-mapped instead of read
+    if os.fstat(f.fileno()).st_size == 0:
+      return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      for i in range(0, len(mm), block_size):
+        yield mm[i:i + block_size]
+
+def find_start_codes(buf) -> np.ndarray:
+  a = np.frombuffer(buf, dtype=np.uint8)
+  return np.flatnonzero((a[:-2] == 0) & (a[1:-1] == 0) & (a[2:] == 1))
+
+def hevc_index_array(hevc_file_name: str, allow_corrupt: bool=False, block_size: int=INDEX_BLOCK_SIZE) -> tuple[np.ndarray, bytes]:
+  """
+    Same as hevc_index, but streams the file in blocks, finds start codes with a vectorized search and returns the index
+    as an np.uint32 array of (slice_type, offset) rows, terminated by (0xFFFFFFFF, file length).
+  """
+  prefix_dat = bytearray()
+  frame_types = []
+
+  # buf holds the unprocessed bytes starting at absolute offset base, including an open parameter set NAL unit
+  buf = b""
+  base = 0
+  param_set_start: int | None = None
+  checked_first = False
+  done = False
+
+  def process(pos: int, nal: bytes) -> None:
+    nonlocal param_set_start
+    if param_set_start is not None:
+      prefix_dat.extend(buf[param_set_start - base:pos - base])
+      param_set_start = None
+
+    nal_unit_type = get_hevc_nal_unit_type(nal, 0)
+    if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+      param_set_start = pos
+    elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+      slice_type, is_first_slice = get_hevc_slice_type(nal, 0, nal_unit_type)
+      if is_first_slice:
+        frame_types.append((slice_type, pos))
+
+  blocks = _read_blocks(hevc_file_name, block_size)
+  while not done:
+    blk = next(blocks, None)
+    done = blk is None
+    buf = buf + blk if blk is not None else buf
+
+    if not checked_first:
+      if len(buf) < NAL_UNIT_START_CODE_SIZE + 1 and not done:
+        continue
+      if len(buf) < NAL_UNIT_START_CODE_SIZE + 1:
+        raise VideoFileInvalid("data is too short")
+      if buf[0] != 0x00:
+        raise VideoFileInvalid("first byte must be 0x00")
+      require_nal_unit_start(buf, 1)
+      checked_first = True
+
+    # start codes too close to the end of the buffer are handled with the next block
+    limit = len(buf) if done else len(buf) - NAL_UNIT_LOOKAHEAD
+    starts = find_start_codes(buf)
+    try:
+      for p in starts[starts < limit].tolist():
+        process(base + p, buf[p:p + NAL_UNIT_LOOKAHEAD])
+    except Exception as e:
+      if not allow_corrupt:
+        raise
+      print(f"ERROR: NAL unit skipped @ {base + p}\n", str(e))
+      param_set_start = None
+      break
+
+    keep = max(limit, 0)
+    if param_set_start is not None:
+      keep = min(keep, param_set_start - base)
+    buf = buf[keep:]
+    base += keep
+
+  if param_set_start is not None:
+    prefix_dat.extend(buf[param_set_start - base:])
+  dat_len = base + len(buf) if done else sum(len(b) for b in blocks) + base + len(buf)
+
+  index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
+  return index, bytes(prefix_dat)
 
-  prefix_dat = b""
-  frame_types = list()
-
-  i = 1 # skip past first byte 0x00
-  try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
-      nal_unit_type = get_hevc_nal_unit_type(dat, i)
-      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
-  except Exception as e:
-    if not allow_corrupt:
-      raise
-    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
-
-  return frame_types, len(dat), prefix_dat
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  index, prefix_dat = hevc_index_array(hevc_file_name, allow_corrupt)
+  frame_types = [(slice_type, pos) for slice_type, pos in index[:-1].tolist()]
+  return frame_types, int(index[-1, 1]), prefix_dat
 
 def main() -> None:
   parser = argparse.ArgumentParser()
@@ -298,14 +364,12 @@ def main() -> None:
   parser.add_argument("output_index_file", type=str)
   args = parser.parse_args()
 
-  frame_types, dat_len, prefix_dat = hevc_index(args.input_file)
+  index, prefix_dat = hevc_index_array(args.input_file)
   with open(args.output_prefix_file, "wb") as f:
     f.write(prefix_dat)
 
   with open(args.output_index_file, "wb") as f:
-    for ft, fp in frame_types:
-      f.write(struct.pack("<II", ft, fp))
-    f.write(struct.pack("<II", 0xFFFFFFFF, dat_len))
+    f.write(index.astype("<u4").tobytes())
 
 if __name__ == "__main__":
   main()